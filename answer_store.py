@@ -0,0 +1,207 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from nav_graph import load_nav_graph, normalize_name, parse_navigation
+
+# Generated by the batch job below, so it lives in the cache rather than in the repo
+ANSWER_FILE = os.getenv("ANSWER_STORE", os.path.join(".cache", "answers.jsonl"))
+BACKENDS = ("openai", "mistral", "ollama", "app", "app_mistral")
+
+
+# Append-only JSONL of precomputed answers with an in-memory key -> byte offset index.
+# A lookup is one dict access plus one seek, however many answers the file holds.
+# The apps open it read-only; only a writer (the batch job) may modify the file.
+class AnswerStore:
+    def __init__(self, path=ANSWER_FILE, graph=None, writer=False):
+        self.path = path
+        self.index_path = path + ".idx"
+        self._graph = graph
+        self.writer = writer
+        if writer:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.offsets = self._load_index()
+        self.stats = {"hits": 0, "misses": 0}
+
+    @property
+    def graph(self):
+        if self._graph is None:
+            self._graph = load_nav_graph()
+        return self._graph
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # Function to reuse the saved index when it matches the file, otherwise rebuild it by scanning
+    def _load_index(self):
+        if not os.path.exists(self.path):
+            return {}
+        size = os.path.getsize(self.path)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                saved = json.load(f)
+            if saved.get("size") == size:
+                return saved["offsets"]
+        offsets = {}
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # A crash mid-write, or a write still in progress, leaves a partial last line.
+                    # Readers skip it; the writer drops it so its appends start clean.
+                    if self.writer:
+                        f.close()
+                        os.truncate(self.path, offset)
+                    break
+                try:
+                    offsets[json.loads(line)["key"]] = offset
+                except (ValueError, KeyError):
+                    pass
+                offset += len(line)
+        return offsets
+
+    def save_index(self):
+        with self.lock:
+            payload = {"size": os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+                       "offsets": self.offsets}
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(payload, f)
+            os.replace(tmp_path, self.index_path)
+
+    # Function to key a question: the route's start/end pair for a point-to-point question, else the text
+    def key(self, backend, question):
+        endpoints = self.graph.endpoints(question)
+        if endpoints is not None:
+            return f"{backend}|pair:{endpoints[0]}>{endpoints[1]}"
+        return f"{backend}|q:{normalize_name(question)}"
+
+    def get(self, backend, question):
+        offset = self.offsets.get(self.key(backend, question))
+        if offset is None:
+            self.stats["misses"] += 1
+            return None
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            record = json.loads(f.readline())
+        self.stats["hits"] += 1
+        return record["answer"]
+
+    def put(self, backend, question, answer, **extra):
+        key = self.key(backend, question)
+        line = json.dumps(dict(extra, key=key, backend=backend, question=question, answer=answer)) + "\n"
+        with self.lock:
+            with open(self.path, "ab") as f:
+                offset = f.tell()
+                f.write(line.encode("utf-8"))
+            self.offsets[key] = offset
+        return key
+
+
+# Function to name the store partition for a backend; Mistral and Ollama answers depend on the model
+def backend_label(backend, model_name=None):
+    return f"{backend}:{model_name}" if model_name else backend
+
+
+# Function to make one question per start/end pair listed in nav.txt
+def route_questions(nav_path="nav.txt"):
+    with open(nav_path, "r") as f:
+        routes = parse_navigation(f.read())
+    pairs = {}
+    for _, start, end, _ in routes:
+        pairs.setdefault((normalize_name(start), normalize_name(end)), (start.strip(), end.strip()))
+    return [f"How do I get from {start} to {end}?" for start, end in pairs.values()]
+
+
+def read_questions(path):
+    with open(path, "r") as f:
+        return [json.loads(line)["question"] for line in f if line.strip()]
+
+
+# Function to return a callable that answers one question through the chosen backend, bypassing the store
+def backend_answerer(backend, model_name=None, top_k=4):
+    if backend in ("openai", "mistral", "ollama"):
+        import main
+        model = {"openai": "OpenAI GPT", "mistral": "Mistral AI", "ollama": "Ollama"}[backend]
+        # rephrase=True: the stored answer is the model's wording of the computed route
+        return lambda question: main.get_directions(question, model, model_name, top_k=top_k, rephrase=True,
+                                                    use_store=False)[0]
+
+    import app
+    import app_mistral
+    from retrieval import load_index, format_hits
+    from image_selection import load_map_selector
+    index = load_index()
+    selector = load_map_selector()
+
+    def inputs(question):
+        return format_hits(index.search(question, k=top_k, kind="caption")), selector.select(question)[0]
+
+    if backend == "app":
+        return lambda question: app.get_mistral_response(question, *inputs(question))
+    return lambda question: app_mistral.get_response(question, *inputs(question))[0]
+
+
+# Function to answer every question not yet in the store, appending each answer as it arrives
+def run_batch(questions, backend, store, concurrency=4, model_name=None, top_k=4, checkpoint_every=25):
+    if backend in ("mistral", "ollama"):
+        model_name = model_name or {"mistral": "mistral-medium", "ollama": "llama2"}[backend]
+    answer = backend_answerer(backend, model_name, top_k)
+    label = backend_label(backend, model_name)
+    seen = set()
+    pending = []
+    for question in questions:
+        key = store.key(label, question)
+        if key not in store.offsets and key not in seen:
+            seen.add(key)
+            pending.append(question)
+    print(f"{len(questions) - len(pending)} already answered or duplicate, {len(pending)} to go", file=sys.stderr)
+    failures = {}
+    done = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {executor.submit(answer, question): question for question in pending}
+        for future in as_completed(futures):
+            question = futures[future]
+            try:
+                store.put(label, question, future.result(), created=time.strftime("%Y-%m-%dT%H:%M:%S"))
+            except Exception as error:
+                failures[question] = str(error)
+                print(f"Failed: {question}: {error}", file=sys.stderr)
+                continue
+            done += 1
+            if done % checkpoint_every == 0:
+                store.save_index()
+                rate = done / (time.perf_counter() - started)
+                print(f"{done}/{len(pending)} answered ({rate:.1f}/s)", file=sys.stderr)
+    store.save_index()
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute answers into the FAQ answer store")
+    parser.add_argument("--backend", choices=BACKENDS, default="openai")
+    parser.add_argument("--model-name", help="Mistral or Ollama model name")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--questions", help="JSONL file with one {\"question\": ...} per line")
+    source.add_argument("--nav", default="nav.txt", help="generate one question per start/end pair in this file")
+    parser.add_argument("--output", default=ANSWER_FILE)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--top-k", type=int, default=4)
+    parser.add_argument("--limit", type=int, help="answer at most this many questions")
+    args = parser.parse_args()
+
+    questions = read_questions(args.questions) if args.questions else route_questions(args.nav)
+    if args.limit:
+        questions = questions[:args.limit]
+    store = AnswerStore(args.output, writer=True)
+    failed = run_batch(questions, args.backend, store, concurrency=args.concurrency,
+                       model_name=args.model_name, top_k=args.top_k)
+    print(f"{len(store)} answers in {args.output}", file=sys.stderr)
+    if failed:
+        raise SystemExit(f"{len(failed)} question(s) failed")
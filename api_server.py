@@ -0,0 +1,291 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+from metrics import percentile, registry, traced
+
+# Load environment variables
+load_dotenv()
+
+# Upstream calls allowed in flight per backend, and how many more may wait before we answer 429
+BACKEND_LIMITS = {
+    "openai": int(os.getenv("API_OPENAI_CONCURRENCY", 8)),
+    "mistral": int(os.getenv("API_MISTRAL_CONCURRENCY", 4)),
+    "ollama": int(os.getenv("API_OLLAMA_CONCURRENCY", 2)),
+}
+API_QUEUE_SIZE = int(os.getenv("API_QUEUE_SIZE", 16))
+API_RETRY_AFTER = int(os.getenv("API_RETRY_AFTER", 2))
+MAX_BODY_BYTES = 64 * 1024
+# Most retrieved chunks a request may ask for; each one adds to every prompt
+API_MAX_TOP_K = int(os.getenv("API_MAX_TOP_K", 12))
+# Most floor plans or tiles a vision request may attach, as in the apps' slider
+API_MAX_IMAGES = int(os.getenv("API_MAX_IMAGES", 4))
+
+MODELS = {"openai": "OpenAI GPT", "mistral": "Mistral AI", "ollama": "Ollama"}
+DEFAULT_MODEL_NAMES = {"mistral": "mistral-medium", "ollama": "llama2"}
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 429: "Too Many Requests", 500: "Internal Server Error"}
+
+
+class Overloaded(Exception):
+    pass
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# Bounds upstream calls per backend; callers beyond the queue are turned away instead of piling up
+class BackendLimiter:
+    def __init__(self, limit, queue_size=API_QUEUE_SIZE):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.slots = asyncio.Semaphore(limit)
+        self.in_flight = 0
+        self.waiting = 0
+
+    async def run(self, func, *args, **kwargs):
+        if self.in_flight >= self.limit and self.waiting >= self.queue_size:
+            raise Overloaded()
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            return await asyncio.to_thread(func, *args, **kwargs)
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+
+
+class AssistantService:
+    def __init__(self, limits=None, queue_size=API_QUEUE_SIZE):
+        limits = dict(BACKEND_LIMITS, **(limits or {}))
+        self.limiters = {backend: BackendLimiter(limit, queue_size) for backend, limit in limits.items()}
+        self.pending = {}  # coalescing key -> task answering it
+        self.started = time.time()
+        self.counters = {"requests": 0, "upstream": 0, "coalesced": 0, "rejected": 0, "errors": 0}
+        self.latencies = deque(maxlen=1000)
+        self._apps = {}
+
+    def _module(self, name):
+        # The Streamlit scripts are imported lazily so /health answers before the models load
+        if name not in self._apps:
+            self._apps[name] = __import__(name)
+        return self._apps[name]
+
+    # Function to answer through main.py's routing path (graph, retrieval, then a model)
+    def directions(self, question, backend, model_name=None, top_k=4, compact=False):
+        main = self._module("main")
+        with traced("api:directions", backend=backend):
+            answer, hits = main.get_directions(question, MODELS[backend],
+                                               model_name or DEFAULT_MODEL_NAMES.get(backend),
+                                               top_k=top_k, compact=compact)
+        return {"answer": answer, "sources": [{"title": hit["title"], "score": hit["score"]} for hit in hits]}
+
+    # Function to answer through the vision apps: one call (app.py) or the staged pipeline (app_mistral.py)
+    def vision(self, question, pipeline="single", top_k=4, max_images=None):
+        from file_cache import file_fingerprint
+        from retrieval import format_hits
+        app = self._module("app")
+        with traced(f"api:vision:{pipeline}"):
+            hits = app.initialize_retrieval(file_fingerprint("nav.txt", "captions.json")).search(
+                question, k=top_k, kind="caption")
+            # The same tile-then-map selection as the apps
+            image_paths, _, _ = app.select_images(
+                question, app.IMAGE_MAX_COUNT if max_images is None else max_images)
+            context = format_hits(hits)
+            result = {"images": [os.path.basename(path) for path in image_paths]}
+            if pipeline == "staged":
+                result["answer"], timings = self._module("app_mistral").get_response(question, context, image_paths)
+                result["timings"] = {stage: round(timing["seconds"], 3) for stage, timing in timings.items()}
+                result["depth"] = timings["total"].get("depth")
+            else:
+                result["answer"] = app.get_mistral_response(question, context, image_paths)
+        return result
+
+    # Function to run one upstream answer, sharing it with identical requests already in flight
+    async def answer(self, key, backend, func, *args):
+        self.counters["requests"] += 1
+        task = self.pending.get(key)
+        if task is not None:
+            self.counters["coalesced"] += 1
+            return await asyncio.shield(task)
+        limiter = self.limiters[backend]
+        task = asyncio.ensure_future(limiter.run(func, *args))
+        self.pending[key] = task
+        task.add_done_callback(lambda _: self.pending.pop(key, None))
+        self.counters["upstream"] += 1
+        return await asyncio.shield(task)
+
+    def health(self):
+        return {"status": "ok", "uptime": round(time.time() - self.started, 1)}
+
+    def metrics(self):
+        from response_cache import get_response_cache
+        latencies = list(self.latencies)
+        return dict(
+            self.counters,
+            in_flight={backend: limiter.in_flight for backend, limiter in self.limiters.items()},
+            waiting={backend: limiter.waiting for backend, limiter in self.limiters.items()},
+            coalescing=len(self.pending),
+            latency_p50=percentile(latencies, 50),
+            latency_p95=percentile(latencies, 95),
+            response_cache=get_response_cache().stats,
+        )
+
+    async def handle(self, method, path, body):
+        if path == "/health":
+            return 200, self.health()
+        if path == "/metrics":
+            return 200, self.metrics()
+        if path == "/metrics/prometheus":
+            return 200, registry.prometheus()
+        if path not in ("/v1/directions", "/v1/vision"):
+            raise HTTPError(404, f"unknown path {path}")
+        if method != "POST":
+            raise HTTPError(405, "use POST")
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "body must be JSON")
+        if not isinstance(request, dict):
+            raise HTTPError(400, "body must be a JSON object")
+        question = " ".join(str(request.get("question", "")).split())
+        if not question:
+            raise HTTPError(400, "question is required")
+        top_k = request.get("top_k", 4)
+        if isinstance(top_k, bool) or not isinstance(top_k, int) or not 1 <= top_k <= API_MAX_TOP_K:
+            raise HTTPError(400, f"top_k must be an integer from 1 to {API_MAX_TOP_K}")
+
+        if path == "/v1/directions":
+            backend = request.get("model", "openai")
+            if backend not in MODELS:
+                raise HTTPError(400, f"model must be one of {', '.join(MODELS)}")
+            model_name = request.get("model_name")
+            if model_name is not None and not isinstance(model_name, str):
+                raise HTTPError(400, "model_name must be a string")
+            compact = request.get("compact", False)
+            if compact not in (True, False, "all"):
+                raise HTTPError(400, "compact must be true, false or 'all'")
+            key = ("directions", question.lower(), backend, model_name, top_k, compact)
+            return 200, await self.answer(key, backend, self.directions, question, backend, model_name, top_k, compact)
+
+        pipeline = request.get("pipeline", "single")
+        if pipeline not in ("single", "staged"):
+            raise HTTPError(400, "pipeline must be 'single' or 'staged'")
+        max_images = request.get("max_images")
+        if max_images is not None and (isinstance(max_images, bool) or not isinstance(max_images, int)
+                                       or not 0 <= max_images <= API_MAX_IMAGES):
+            raise HTTPError(400, f"max_images must be an integer from 0 to {API_MAX_IMAGES}")
+        key = ("vision", question.lower(), pipeline, top_k, max_images)
+        return 200, await self.answer(key, "mistral", self.vision, question, pipeline, top_k, max_images)
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(413, "request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method, path.split("?", 1)[0], headers, body
+
+
+def write_response(writer, status, payload, extra_headers=()):
+    if isinstance(payload, str):
+        body, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4"
+    else:
+        body, content_type = json.dumps(payload).encode("utf-8"), "application/json"
+    head = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}", f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}", *extra_headers]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+
+
+# Function to serve one keep-alive connection
+async def serve_connection(service, reader, writer):
+    try:
+        while True:
+            try:
+                request = await read_request(reader)
+            except HTTPError as error:
+                write_response(writer, error.status, {"error": str(error)}, ["Connection: close"])
+                break
+            if request is None:
+                break
+            method, path, headers, body = request
+            started = time.perf_counter()
+            extra = []
+            try:
+                status, payload = await service.handle(method, path, body)
+                if path.startswith("/v1/"):
+                    service.latencies.append(time.perf_counter() - started)
+            except HTTPError as error:
+                status, payload = error.status, {"error": str(error)}
+            except Overloaded:
+                service.counters["rejected"] += 1
+                status, payload = 429, {"error": "busy, retry shortly"}
+                extra.append(f"Retry-After: {API_RETRY_AFTER}")
+            except Exception as error:
+                service.counters["errors"] += 1
+                status, payload = 500, {"error": str(error)}
+            close = headers.get("connection", "").lower() == "close"
+            if close:
+                extra.append("Connection: close")
+            write_response(writer, status, payload, extra)
+            await writer.drain()
+            if close:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+# Function to start the API on host:port; returns the asyncio server
+async def start_api_server(host="127.0.0.1", port=8080, service=None):
+    service = service or AssistantService()
+    # Model calls run in threads; size the pool to the backend limits so no backend starves another
+    workers = sum(limiter.limit for limiter in service.limiters.values()) + 4
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=workers))
+    server = await asyncio.start_server(lambda r, w: serve_connection(service, r, w), host, port)
+    server.service = service
+    return server
+
+
+async def serve(host, port):
+    server = await start_api_server(host, port)
+    print(f"Assistant API on http://{host}:{server.sockets[0].getsockname()[1]}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless HTTP API for the airport navigation assistant")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
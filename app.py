@@ -1,71 +1,53 @@
+# First, so STARTUP_PROFILE=1 can time the imports below
+from startup import mark, first_render, report_lines
 import streamlit as st
 import os
-import json
 from dotenv import load_dotenv
-from PIL import Image
-import base64
-from mistralai import Mistral
+from retrieval import load_index, format_hits, estimate_tokens
+from response_cache import get_response_cache
+from image_payloads import get_data_url, prepare_images
+from streaming import timed_stream, format_stream_stats
+import update_captions
+from file_cache import file_fingerprint, thumbnail_bytes, is_image_file
+from image_selection import load_map_selector, IMAGE_MAX_COUNT
+from tiling import load_tile_index, TILE_MANIFEST, TILE_CAPTIONS
+from caption_store import load_captions
+from answer_store import AnswerStore, ANSWER_FILE
+from providers import get_provider, warm_up
+from metrics import traced, stage, breakdown_lines
+from prompt_layout import build_messages
+from conversation import get_conversation, new_hits, with_history, hit_key, memory
 
 # Load environment variables
 load_dotenv()
 
+CAPTION_MODEL = "pixtral-12b-2409"
+CAPTION_PROMPT = "Please provide a detailed description of this airport floor plan map, including information about shops, gates, and key locations."
+
 # Function to generate captions for images using Mistral Pixtral
 def generate_captions(image_path):
-    api_key = os.getenv("MISTRAL_API_KEY")
-    client = Mistral(api_key=api_key)
-    
-    with open(image_path, "rb") as image_file:
-        base64_image = base64.b64encode(image_file.read()).decode('utf-8')
-        response = client.chat.complete(
-            model="pixtral-12b-2409",
-            messages=[
-                {"role": "user", "content": [
-                    {"type": "text", "text": "Please provide a detailed description of this airport floor plan map, including information about shops, gates, and key locations."},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
-                ]}
-            ]
-        )
-    return response.choices[0].message.content
-
-# Function to load captions from file
-def load_captions():
-    caption_file = "captions.json"
-    if os.path.exists(caption_file):
-        with open(caption_file, "r") as f:
-            return json.load(f)
-    return {}
-
-# Function to save captions to file
-def save_captions(captions):
-    caption_file = "captions.json"
-    with open(caption_file, "w") as f:
-        json.dump(captions, f)
-
-# Function to process images and generate captions
+    return get_provider("mistral").complete(
+        CAPTION_MODEL,
+        [
+            {"role": "user", "content": [
+                {"type": "text", "text": CAPTION_PROMPT},
+                {"type": "image_url", "image_url": {"url": get_data_url(image_path)}}
+            ]}
+        ]
+    )
+
+# Function to process images and generate captions with Pixtral, using the
+# concurrent, checkpointing engine from update_captions
 def process_images():
-    captions = load_captions()
-    files_folder = "files"
-    for filename in os.listdir(files_folder):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            print(f"Processing image: {filename}")  # Add this line
-            if filename not in captions:
-                image_path = os.path.join(files_folder, filename)
-                captions[filename] = generate_captions(image_path)
-    save_captions(captions)
-    return captions
-
-def get_mistral_response(user_question, context, image_paths):
-    api_key = os.getenv("MISTRAL_API_KEY")
-    client = Mistral(api_key=api_key)
-
-    messages = [
-        {"role": "system", "content": f"""
+    return update_captions.process_images(generate=generate_captions, model=CAPTION_MODEL, prompt=CAPTION_PROMPT)
+
+# Kept free of per-question text so the provider can serve it from its prompt cache; see prompt_layout.py
+NAVIGATION_SYSTEM_PROMPT = """
             You are an expert airport navigation assistant. Your task is to provide clear, step-by-step directions 
             for navigating within the airport. Use the provided floor plans and/or maps as well as the given context prompt to give accurate and helpful instructions.
             
             Look at how to move from one point to another in the airport and provide instructions on how to do so.
-            Context about the airport layout:
-            {context}
+            Context about the airport layout comes with the question.
 
             When providing navigation instructions, follow these guidelines:
             1. Identify the start and end points from the user's question.
@@ -132,65 +114,174 @@ def get_mistral_response(user_question, context, image_paths):
 
             If the user's question doesn't ask for directions or doesn't provide enough information, 
             politely ask for clarification instead of providing directions.
-        """},
-        {"role": "user", "content": [
-            {"type": "text", "text": f"Based on this user question, provide navigation instructions: '{user_question}'"}
-        ]}
-    ]
-
-    for image_path in image_paths:
-        with open(image_path, "rb") as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode('utf-8')
-            messages[1]["content"].append({
-                "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
-            })
-
-    chat_response = client.chat.complete(
-        model="pixtral-12b-2409",
-        messages=messages
-    )
-
-    return chat_response.choices[0].message.content
-
-
-# Initialize captions
-@st.cache_resource
-def initialize_captions():
-    return load_captions()
+        """
+
+def get_mistral_response(user_question, context, image_paths, stream=False):
+    provider = get_provider("mistral")
+
+    # Static instructions, then the floor plans, then this question's context and the question itself
+    messages = build_messages(NAVIGATION_SYSTEM_PROMPT,
+                              f"Based on this user question, provide navigation instructions: '{user_question}'",
+                              context=f"Context about the airport layout:\n{context}", images=image_paths)
+
+    def call():
+        return provider.complete("pixtral-12b-2409", messages)
+
+    def call_stream():
+        return provider.stream("pixtral-12b-2409", messages)
+
+    if stream:
+        return get_response_cache().fetch_stream("mistral", "pixtral-12b-2409", user_question, call_stream,
+                                                 context=context, images=image_paths, messages=messages)
+    return get_response_cache().fetch("mistral", "pixtral-12b-2409", user_question, call,
+                                      context=context, images=image_paths, messages=messages)
+
+
+# Load the captions for the images and PDFs currently in files/, looked up by content;
+# the fingerprint argument reloads them when captions.json or files/ change
+@st.cache_resource(max_entries=1)
+def initialize_captions(fingerprint):
+    return load_captions(folder="files")
+
+# Downscale and encode every floor plan once per set of image files
+@st.cache_resource(max_entries=1)
+def initialize_image_payloads(filenames, fingerprint):
+    return prepare_images([os.path.join("files", filename) for filename in filenames])
+
+# Build (or load the persisted) retrieval index over nav.txt and captions.json
+@st.cache_resource(max_entries=1)
+def initialize_retrieval(fingerprint):
+    return load_index()
+
+# Index the captioned maps by terminal, labelled locations and caption text
+@st.cache_resource(max_entries=1)
+def initialize_map_selector(fingerprint):
+    return load_map_selector()
+
+# Index the captioned map tiles (see tiling.py) by the locations they show
+@st.cache_resource(max_entries=1)
+def initialize_tile_index(fingerprint):
+    return load_tile_index()
+
+# Function to pick the images for a question: the map tiles covering its start and end points
+# when tiles are captioned, otherwise the whole maps that score well against it.
+# Returns (image_paths, tiles, map_scores); api_server.py selects through here too.
+def select_images(question, max_maps=IMAGE_MAX_COUNT):
+    with stage("image_selection"):
+        tiles = initialize_tile_index(file_fingerprint(TILE_MANIFEST, TILE_CAPTIONS)).select(
+            question, max_tiles=max_maps)
+    if tiles:
+        return [tile["path"] for tile in tiles], tiles, []
+    with stage("map_selection"):
+        image_paths, map_scores = initialize_map_selector(file_fingerprint("captions.json", "files")).select(
+            question, max_images=max_maps)
+    return image_paths, tiles, map_scores
+
+# Open the precomputed answer store (see answer_store.py); reloaded when the file grows
+@st.cache_resource(max_entries=1)
+def initialize_answer_store(fingerprint):
+    return AnswerStore()
+
+# Small preview of one floor plan, rendered only when the user opens it
+@st.cache_data(max_entries=32)
+def initialize_thumbnail(image_path, fingerprint):
+    return thumbnail_bytes(image_path)
 
 # Streamlit app
 def main():
     st.title("Airport Navigation Assistant")
+    mark("first_paint")
+    # Pixtral answers every question here; import its SDK in the background while the page renders
+    warm_up(["mistral"])
 
     # Load pre-generated captions
-    captions = initialize_captions()
-    context = "\n\n".join(captions.values())
+    captions = initialize_captions(file_fingerprint("captions.json", "files"))
+    maps = [filename for filename in captions if is_image_file(filename)]
+    initialize_image_payloads(tuple(maps), file_fingerprint("files"))
+    top_k = st.sidebar.slider("Retrieved caption chunks (k)", 1, 12, 4)
+    max_maps = st.sidebar.slider("Floor plans per question", 0, 4, IMAGE_MAX_COUNT)
+    show_metrics = st.sidebar.checkbox("Show request metrics", value=False)
+
+    # Follow-up questions carry over the locations and history of this session's earlier turns
+    conversation = get_conversation(st.session_state)
+    remember = st.sidebar.checkbox("Remember the conversation", value=True)
+    if st.sidebar.button("New conversation"):
+        conversation.reset()
 
     # User input
     user_input = st.text_input("Ask a question about the airport:")
 
     if user_input:
-        image_paths = [os.path.join("files", filename) for filename in captions.keys()]
-        response = get_mistral_response(user_input, context, image_paths)
-        st.write("Assistant:", response)
+        turn = conversation.prepare(user_input) if remember else None
+        question = turn["standalone"] if turn else user_input
+        if turn and turn["follow_up"]:
+            st.caption(f"Follow-up, read as: {question}")
+        with traced("app") as trace:
+            # Serve a precomputed answer when there is one, before any retrieval or image selection
+            with stage("answer_store"):
+                stored = initialize_answer_store(file_fingerprint(ANSWER_FILE)).get("app", question)
+            hits = []
+            if stored is not None:
+                chunks = iter([stored])
+            else:
+                # Only the top-k relevant caption chunks go into the prompt, less those sent in recent turns;
+                # the floor plans are sent again, but they sit in the cached prompt prefix
+                index = initialize_retrieval(file_fingerprint("nav.txt", "captions.json"))
+                with stage("retrieval"):
+                    hits = index.search(question, k=top_k, kind="caption")
+                    if turn:
+                        hits = new_hits(hits, turn)
+                context = format_hits(hits)
+
+                image_paths, tiles, map_scores = select_images(question, max_maps)
+
+                with st.expander("Retrieved context"):
+                    st.write(f"~{estimate_tokens(context)} of ~{index.total_tokens('caption')} caption tokens")
+                    for hit in hits:
+                        st.write(f"{hit['score']:.3f} — {hit['source']}: {hit['title']}")
+                    if tiles:
+                        for tile in tiles:
+                            st.write(f"Tile {tile['file']} covering {', '.join(tile['labels']) or 'similar caption'}")
+                    else:
+                        st.write(f"Floor plans attached: {', '.join(os.path.basename(p) for p in image_paths) or 'none'}")
+                        for filename, score, reasons in map_scores:
+                            st.write(f"{score:.2f} — {filename} ({', '.join(reasons)})")
+
+                chunks = get_mistral_response(question, with_history(context, turn) if turn else context,
+                                              image_paths, stream=True)
+            st.write("Assistant:")
+            stream_stats = {}
+            answer = st.write_stream(timed_stream(chunks, stream_stats))
+            if turn:
+                conversation.record(turn, answer, [hit_key(hit) for hit in hits])
+        st.caption(format_stream_stats(stream_stats))
         st.write("Using Mistral model: pixtral-12b-2409")
-
-    # Display images
+        stats = get_response_cache().stats
+        st.sidebar.write(f"Response cache: {stats['hits']} hits / {stats['misses']} misses")
+        if turn:
+            held = memory.stats()
+            st.sidebar.write(f"Conversation: turn {turn['number']}, ~{conversation.tokens()} history tokens · "
+                             f"{held['sessions']} sessions hold {held['bytes'] // 1024} of {held['limit'] // 1024} KB")
+        if show_metrics:
+            with st.sidebar.expander("Request metrics", expanded=True):
+                for line in breakdown_lines(trace):
+                    st.write(line)
+
+    # Display one map and its caption at a time, only when asked for
     st.subheader("Airport Map")
-    for filename, caption in captions.items():
+    if maps and st.toggle("Show floor plans"):
+        filename = st.selectbox("Floor plan", maps)
         image_path = os.path.join("files", filename)
-        image = Image.open(image_path)
-        st.image(image, caption=filename)
-        # Remove this line as we're now displaying captions separately
-        # st.write(caption)
-
-        # Display generated captions
-    st.subheader("Generated Captions")
-    for filename, caption in captions.items():
-        st.write(f"**{filename}:**")
-        st.write(caption)
-        st.write("---")
+        st.image(initialize_thumbnail(image_path, file_fingerprint(image_path)), caption=filename)
+        with st.expander("Generated caption"):
+            st.write(captions[filename])
+
+    # With STARTUP_PROFILE=1, show what this process spent on imports before the page appeared
+    report = first_render("app")
+    if report:
+        with st.sidebar.expander("Startup profile"):
+            for line in report_lines(report):
+                st.write(line)
 
 if __name__ == "__main__":
     main()
@@ -1,37 +1,63 @@
+# First, so STARTUP_PROFILE=1 can time the imports below
+from startup import mark, first_render, report_lines
 import streamlit as st
 import os
-import json
 from dotenv import load_dotenv
-from PIL import Image
-import base64
-from mistralai import Mistral  # Replace OpenAI import
+from retrieval import load_index, format_hits, estimate_tokens
+from response_cache import get_response_cache
+from image_payloads import prepare_images
+from pipeline import Stage, run_pipeline
+from streaming import timed_stream, format_stream_stats
+import asyncio
+import queue
+import threading
+from file_cache import file_fingerprint, thumbnail_bytes, is_image_file
+from image_selection import load_map_selector, IMAGE_MAX_COUNT
+from tiling import load_tile_index, TILE_MANIFEST, TILE_CAPTIONS
+from caption_store import load_captions
+from answer_store import AnswerStore, ANSWER_FILE
+from providers import get_provider, warm_up
+from location_resolver import get_location_resolver, format_resolution, classify_request, LOCATION_CONFIDENCE
+from nav_graph import get_nav_graph, format_route
+from metrics import traced, stage, breakdown_lines, current_trace, registry
+from prompt_layout import build_messages
+from conversation import get_conversation, new_hits, with_history, hit_key, memory
 
 
 
 # Load environment variables
 load_dotenv()
 
-# Function to load captions from file
-def load_captions():
-    caption_file = "captions.json"
-    if os.path.exists(caption_file):
-        with open(caption_file, "r") as f:
-            return json.load(f)
-    return {}
-
-# Function to save captions to file
-def save_captions(captions):
-    caption_file = "captions.json"
-    with open(caption_file, "w") as f:
-        json.dump(captions, f)
-
-
-def get_response(user_question, context, image_paths):
-    api_key = os.getenv("MISTRAL_API_KEY")  # Change to MISTRAL_API_KEY
-    client = Mistral(api_key=api_key)  # Use Mistral client
+# Analysis stages shown while the final instructions stream in
+STAGE_TITLES = {
+    "location": "Location Analysis",
+    "landmark": "Landmark Analysis",
+    "route": "Route Analysis",
+    "navigation": "Navigation Considerations",
+}
+
+# Function to record how deep a request went and, on the fast path, the time saved
+# against the recent average of full-analysis runs
+def record_depth(depth, reason, timings):
+    seconds = timings["total"]["seconds"]
+    full_runs = registry.samples("pipeline_seconds", depth="full")
+    saved = sum(full_runs) / len(full_runs) - seconds if depth == "fast" and full_runs else None
+    registry.sample("pipeline_seconds", seconds, depth=depth)
+    registry.count("pipeline_depth_total", depth=depth)
+    timings["total"].update(depth=depth, reason=reason, saved=saved)
+    trace = current_trace()
+    if trace is not None:
+        trace.labels.update(depth=depth, depth_reason=reason, seconds_saved=saved)
+
+# depth=None lets the request classifier choose between the single-call fast path and
+# the full analysis chain; pass "full" or "fast" to force one
+def get_response(user_question, context, image_paths, on_stage_done=None, on_token=None, depth=None):
+    provider = get_provider("mistral")
 
     # Split analysis questions into separate prompts
-    location_prompt = {"role": "system", "content": f"""
+    # The stage prompts never change, so each one is a cacheable prefix (see prompt_layout.py);
+    # the airport context and analyses travel after them with the question
+    location_prompt = """
         You are an expert airport navigation assistant. Before I let you help to provide clear, step-by-step directions 
         for navigating within the airport. You need to analyze the location aspects of this navigation request.
         
@@ -40,20 +66,19 @@ def get_response(user_question, context, image_paths):
         - What is the destination point?
         - Are both points clearly specified? If not, what clarification is needed?
         
-        Base your analysis on this airport layout context:
-        {context}
-    """}
+        Base your analysis on the airport layout context given with the request.
+    """
 
-    landmark_prompt = {"role": "system", "content": f"""
+    landmark_prompt = """
         Analyze the landmarks relevant to this navigation request:
         
         2. Landmark Analysis:
         - What are the major landmarks visible near the starting point?
         - What are the major landmarks visible near the destination?
         - What significant landmarks exist along potential routes?
-    """}
+    """
 
-    route_prompt = {"role": "system", "content": f"""
+    route_prompt = """
         Analyze the possible routes for this navigation request:
         
         3. Route Planning:
@@ -61,9 +86,9 @@ def get_response(user_question, context, image_paths):
         - Which route is most efficient considering distance and ease of navigation?
         - What potential obstacles or busy areas should be considered?
 
-    """}
+    """
 
-    navigation_considerations_prompt = {"role": "system", "content": f"""
+    navigation_considerations_prompt = """
        Analyze the practical navigation considerations:
         
         4. Navigation Considerations:
@@ -77,53 +102,50 @@ def get_response(user_question, context, image_paths):
         3. Provide clear, concise directions using landmarks and key locations.
         4. Use simple, conversational language.
 
-    """}
+    """
 
-    def get_response_with_images(prompt, question):
-        messages = [
-            prompt,
-            {"role": "user", "content": [{"type": "text", "text": question}]}
-        ]
-        
-        # Add images to the messages
-        for image_path in image_paths:
-            with open(image_path, "rb") as image_file:
-                base64_image = base64.b64encode(image_file.read()).decode('utf-8')
-                messages[1]["content"].append({
-                    "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
-                })
-        
-        return client.chat.complete(  # Change to Mistral's API format
-            model="pixtral-12b-2409",  # Use Pixtral model
-            messages=messages
-        ).choices[0].message.content
+    def get_response_with_images(prompt, question, with_images=True, on_token=None, stage_context=None):
+        stage_images = image_paths if with_images else []
+
+        messages = build_messages(prompt, question, context=stage_context, images=stage_images)
+
+        def call():
+            return provider.complete("pixtral-12b-2409", messages)
+
+        def call_stream():
+            return provider.stream("pixtral-12b-2409", messages)
 
-    # Get responses for each analysis aspect
-    location_analysis = get_response_with_images(location_prompt, user_question)
-    landmark_analysis = get_response_with_images(landmark_prompt, location_analysis)
-    route_analysis = get_response_with_images(route_prompt, landmark_analysis)
-    navigation_analysis = get_response_with_images(navigation_considerations_prompt, route_analysis)
+        # Each stage is cached on its own prompt, so repeated questions skip all five calls
+        if on_token is not None:
+            parts = []
+            for chunk in get_response_cache().fetch_stream("mistral", "pixtral-12b-2409", question, call_stream,
+                                                           context=stage_context or "", images=stage_images,
+                                                           messages=messages):
+                parts.append(chunk)
+                on_token(chunk)
+            return "".join(parts)
+        return get_response_cache().fetch("mistral", "pixtral-12b-2409", question, call,
+                                          context=stage_context or "", images=stage_images, messages=messages)
 
     # Combine analyses
-    combined_analysis = f"""
+    def combine_analyses(results):
+        return f"""
     Location Analysis:
-    {location_analysis}
+    {results["location"]}
 
     Landmark Analysis:
-    {landmark_analysis}
+    {results["landmark"]}
 
     Route Analysis:
-    {route_analysis}
+    {results["route"]}
 
     Navigation Considerations:
-    {navigation_analysis}
+    {results["navigation"]}
     """
 
-    # Final navigation instructions prompt
-    navigation_prompt = {"role": "system", "content": f"""
-        Based on this analysis:
-        {combined_analysis}
+    # Final navigation instructions prompt; the analysis it works from comes with the question
+    navigation_prompt = """
+        Base your instructions on the analysis given with the request.
 
         Now you are ready to use the provided floor plans and/or maps as well as the given context prompt to give accurate and helpful instructions.
         
@@ -180,32 +202,167 @@ def get_response(user_question, context, image_paths):
         7. Look for your specific shuttle (hotel, parking, or car rental) and wait in the designated area.
 
 
-    """}
+    """
 
-    # Get final navigation instructions
-    final_instructions = get_response_with_images(navigation_prompt, user_question)
+    # Start and end points are resolved locally in well under a millisecond;
+    # the LLM location stage only runs when the resolver is unsure
+    resolution = get_location_resolver().resolve(user_question)
+
+    if depth is None:
+        depth, reason = classify_request(user_question, resolution)
+    else:
+        reason = "requested"
+
+    if depth == "fast":
+        # One call: the resolved locations (and the computed route when nav.txt has one)
+        # stand in for the four analysis stages, which are never run
+        analysis = format_resolution(resolution)
+        if resolution["start"] and resolution["end"]:
+            hops = get_nav_graph().route(resolution["start"]["name"], resolution["end"]["name"])
+            if hops:
+                analysis += f"\n\nComputed route:\n{format_route(hops)}"
+        fast_analysis = f"""
+    Location Analysis:
+    {analysis}
+    """
+
+        def fast_stage(inputs):
+            return get_response_with_images(
+                navigation_prompt, user_question, on_token=on_token,
+                stage_context=f"Based on this analysis:\n{fast_analysis}\n    Airport layout context:\n    {context}")
+
+        stages = [Stage("final", fast_stage,
+                        fallback=lambda inputs: "Sorry, the navigation instructions took too long to generate. "
+                                                "Please try again.\n\n" + analysis)]
+        results, timings = asyncio.run(run_pipeline(stages, on_stage_done=on_stage_done))
+        record_depth(depth, reason, timings)
+        return f"""
+    Analysis of Navigation Request:
+    {fast_analysis}
 
-    # Return combined response
+    Navigation Instructions:
+    {results["final"]}
+    """, timings
+
+    def with_location(inputs):
+        return f"Question: {user_question}\n\nLocation analysis:\n{inputs['location']}"
+
+    # Location analysis and navigation considerations work from the text context alone;
+    # landmark and route analysis only need the resolved locations, so they run side by side
+    analysis_stages = [
+        Stage("location",
+              lambda inputs: (format_resolution(resolution) if resolution["confidence"] >= LOCATION_CONFIDENCE
+                              else get_response_with_images(location_prompt, user_question, with_images=False,
+                                                            stage_context=f"Airport layout context:\n{context}")),
+              fallback=lambda inputs: f"Start and end points as stated in the request: {user_question}"),
+        Stage("landmark",
+              lambda inputs: get_response_with_images(landmark_prompt, with_location(inputs)),
+              depends=["location"],
+              fallback=lambda inputs: "Landmark analysis unavailable."),
+        Stage("route",
+              lambda inputs: get_response_with_images(route_prompt, with_location(inputs)),
+              depends=["location"],
+              fallback=lambda inputs: "Route analysis unavailable."),
+        Stage("navigation",
+              lambda inputs: get_response_with_images(
+                  navigation_considerations_prompt, with_location(inputs), with_images=False,
+                  stage_context=f"Airport layout context:\n{context}"),
+              depends=["location"],
+              fallback=lambda inputs: "Navigation considerations unavailable."),
+    ]
+
+    # Get final navigation instructions
+    def final_stage(inputs):
+        return get_response_with_images(navigation_prompt, user_question, on_token=on_token,
+                                        stage_context=f"Based on this analysis:\n{combine_analyses(inputs)}")
+
+    stages = analysis_stages + [
+        Stage("final", final_stage, depends=["location", "landmark", "route", "navigation"],
+              fallback=lambda inputs: "Sorry, the navigation instructions took too long to generate. "
+                                      "Please try again.\n\n" + inputs["route"]),
+    ]
+    results, timings = asyncio.run(run_pipeline(stages, on_stage_done=on_stage_done))
+    record_depth(depth, reason, timings)
+    combined_analysis = combine_analyses(results)
+    final_instructions = results["final"]
+
+    # Return combined response and per-stage timings
     return f"""
     Analysis of Navigation Request:
     {combined_analysis}
 
     Navigation Instructions:
     {final_instructions}
-    """
-
-# Initialize captions
-@st.cache_resource
-def initialize_captions():
-    return load_captions()
+    """, timings
+
+# Load the captions for the images and PDFs currently in files/, looked up by content;
+# the fingerprint argument reloads them when captions.json or files/ change
+@st.cache_resource(max_entries=1)
+def initialize_captions(fingerprint):
+    return load_captions(folder="files")
+
+# Downscale and encode every floor plan once per set of image files
+@st.cache_resource(max_entries=1)
+def initialize_image_payloads(filenames, fingerprint):
+    return prepare_images([os.path.join("files", filename) for filename in filenames])
+
+# Build (or load the persisted) retrieval index over nav.txt and captions.json
+@st.cache_resource(max_entries=1)
+def initialize_retrieval(fingerprint):
+    return load_index()
+
+# Index the captioned maps by terminal, labelled locations and caption text
+@st.cache_resource(max_entries=1)
+def initialize_map_selector(fingerprint):
+    return load_map_selector()
+
+# Index the captioned map tiles (see tiling.py) by the locations they show
+@st.cache_resource(max_entries=1)
+def initialize_tile_index(fingerprint):
+    return load_tile_index()
+
+# Function to pick the images for a question: the map tiles covering its start and end points
+# when tiles are captioned, otherwise the whole maps that score well against it.
+# Returns (image_paths, tiles, map_scores)
+def select_images(question, max_maps=IMAGE_MAX_COUNT):
+    tiles = initialize_tile_index(file_fingerprint(TILE_MANIFEST, TILE_CAPTIONS)).select(
+        question, max_tiles=max_maps)
+    if tiles:
+        return [tile["path"] for tile in tiles], tiles, []
+    image_paths, map_scores = initialize_map_selector(file_fingerprint("captions.json", "files")).select(
+        question, max_images=max_maps)
+    return image_paths, tiles, map_scores
+
+# Open the precomputed answer store (see answer_store.py); reloaded when the file grows
+@st.cache_resource(max_entries=1)
+def initialize_answer_store(fingerprint):
+    return AnswerStore()
+
+# Small preview of one floor plan, rendered only when the user opens it
+@st.cache_data(max_entries=32)
+def initialize_thumbnail(image_path, fingerprint):
+    return thumbnail_bytes(image_path)
 
 # Streamlit app
 def main():
     st.title("Airport Navigation Assistant")
+    mark("first_paint")
+    # Pixtral answers every question here; import its SDK in the background while the page renders
+    warm_up(["mistral"])
 
     # Load pre-generated captions
-    captions = initialize_captions()
-    context = "\n\n".join(captions.values())
+    captions = initialize_captions(file_fingerprint("captions.json", "files"))
+    maps = [filename for filename in captions if is_image_file(filename)]
+    initialize_image_payloads(tuple(maps), file_fingerprint("files"))
+    top_k = st.sidebar.slider("Retrieved caption chunks (k)", 1, 12, 4)
+    max_maps = st.sidebar.slider("Floor plans per question", 0, 4, IMAGE_MAX_COUNT)
+    show_metrics = st.sidebar.checkbox("Show request metrics", value=False)
+
+    # Follow-up questions carry over the locations and history of this session's earlier turns
+    conversation = get_conversation(st.session_state)
+    remember = st.sidebar.checkbox("Remember the conversation", value=True)
+    if st.sidebar.button("New conversation"):
+        conversation.reset()
 
     # User input
     user_input = st.text_input("Ask a question about the airport:")
@@ -214,30 +371,125 @@ def main():
     show_analysis = st.checkbox("Show detailed analysis", value=False)
 
     if user_input:
-        image_paths = [os.path.join("files", filename) for filename in captions.keys()]
-        response = get_response(user_input, context, image_paths)
-        if show_analysis:
-            st.write("Assistant:", response)
-        else:
-            # Extract only the navigation instructions part
-            navigation_part = response.split("Navigation Instructions:")[1]
-            st.write("Assistant:", navigation_part)
-
-    # Display images
+        turn = conversation.prepare(user_input) if remember else None
+        question = turn["standalone"] if turn else user_input
+        if turn and turn["follow_up"]:
+            st.caption(f"Follow-up, read as: {question}")
+        # One trace for the request, finished even when the stream fails; the worker thread continues it explicitly
+        with traced("app_mistral") as trace:
+            # Serve a precomputed answer when there is one, before any retrieval or image selection
+            with stage("answer_store"):
+                stored = initialize_answer_store(file_fingerprint(ANSWER_FILE)).get("app_mistral", question)
+            events = queue.Queue()
+            hits = []
+            if stored is not None:
+                events.put(("token", stored))
+                events.put(("done", (stored, {})))
+            else:
+                # Only the top-k relevant caption chunks go into the prompt, less those sent in recent turns
+                index = initialize_retrieval(file_fingerprint("nav.txt", "captions.json"))
+                with stage("retrieval"):
+                    hits = index.search(question, k=top_k, kind="caption")
+                    if turn:
+                        hits = new_hits(hits, turn)
+                context = format_hits(hits)
+
+                image_paths, tiles, map_scores = select_images(question, max_maps)
+
+                with st.expander("Retrieved context"):
+                    st.write(f"~{estimate_tokens(context)} of ~{index.total_tokens('caption')} caption tokens")
+                    for hit in hits:
+                        st.write(f"{hit['score']:.3f} — {hit['source']}: {hit['title']}")
+                    if tiles:
+                        for tile in tiles:
+                            st.write(f"Tile {tile['file']} covering {', '.join(tile['labels']) or 'similar caption'}")
+                    else:
+                        st.write(f"Floor plans attached: {', '.join(os.path.basename(p) for p in image_paths) or 'none'}")
+                        for filename, score, reasons in map_scores:
+                            st.write(f"{score:.2f} — {filename} ({', '.join(reasons)})")
+
+                # The pipeline runs in a worker thread; the script thread renders analysis
+                # stages as they finish and streams the final instructions token by token
+                def worker():
+                    try:
+                        with traced(trace=trace):
+                            events.put(("done", get_response(
+                                question, with_history(context, turn) if turn else context, image_paths,
+                                on_stage_done=lambda name, result, timing: events.put(("stage", name, result, timing)),
+                                on_token=lambda chunk: events.put(("token", chunk)),
+                                # Showing the analysis needs every stage; otherwise the classifier decides
+                                depth="full" if show_analysis else None,
+                            )))
+                    except Exception as error:
+                        events.put(("error", error))
+
+                threading.Thread(target=worker, daemon=True).start()
+
+            stage_slots = {}
+            if show_analysis and stored is None:
+                analysis = st.expander("Analysis of Navigation Request", expanded=True)
+                stage_slots = {name: analysis.empty() for name in STAGE_TITLES}
+                for name, title in STAGE_TITLES.items():
+                    stage_slots[name].markdown(f"**{title}:** _running..._")
+            outcome = {}
+
+            def tokens():
+                while True:
+                    event = events.get()
+                    if event[0] == "stage":
+                        _, name, result, timing = event
+                        if name in stage_slots:
+                            stage_slots[name].markdown(f"**{STAGE_TITLES[name]}** ({timing['seconds']:.1f}s):\n\n{result}")
+                        if name == "final" and timing["status"] != "ok":
+                            yield result
+                    elif event[0] == "token":
+                        yield event[1]
+                    elif event[0] == "error":
+                        raise event[1]
+                    else:
+                        outcome["response"], outcome["timings"] = event[1]
+                        return
+
+            st.write("Assistant:")
+            stream_stats = {}
+            answer = st.write_stream(timed_stream(tokens(), stream_stats))
+            if turn:
+                conversation.record(turn, answer, [hit_key(hit) for hit in hits])
+        st.caption(format_stream_stats(stream_stats))
+        timings = outcome["timings"]
+        if "depth" in timings.get("total", {}):
+            total = timings["total"]
+            saved = f", ~{total['saved']:.1f}s faster than recent full runs" if total["saved"] is not None else ""
+            st.caption(f"{'Fast path' if total['depth'] == 'fast' else 'Full analysis'}: {total['reason']}{saved}")
+        with st.expander("Stage timings"):
+            for name, timing in timings.items():
+                st.write(f"{name}: started +{timing['start']:.2f}s, took {timing['seconds']:.2f}s ({timing['status']})")
+        stats = get_response_cache().stats
+        st.sidebar.write(f"Response cache: {stats['hits']} hits / {stats['misses']} misses")
+        if turn:
+            held = memory.stats()
+            st.sidebar.write(f"Conversation: turn {turn['number']}, ~{conversation.tokens()} history tokens · "
+                             f"{held['sessions']} sessions hold {held['bytes'] // 1024} of {held['limit'] // 1024} KB")
+        if show_metrics:
+            with st.sidebar.expander("Request metrics", expanded=True):
+                for line in breakdown_lines(trace):
+                    st.write(line)
+
+    # Display one map and its caption at a time, only when asked for
     st.subheader("Airport Map")
-    for filename, caption in captions.items():
+    if maps and st.toggle("Show floor plans"):
+        filename = st.selectbox("Floor plan", maps)
         image_path = os.path.join("files", filename)
-        image = Image.open(image_path)
-        st.image(image, caption=filename)
-        # Remove this line as we're now displaying captions separately
-        # st.write(caption)
-
-        # Display generated captions
-    st.subheader("Generated Captions")
-    for filename, caption in captions.items():
-        st.write(f"**{filename}:**")
-        st.write(caption)
-        st.write("---")
+        st.image(initialize_thumbnail(image_path, file_fingerprint(image_path)), caption=filename)
+        with st.expander("Generated caption"):
+            st.write(captions[filename])
+
+    # With STARTUP_PROFILE=1, show what this process spent on imports before the page appeared
+    report = first_render("app_mistral")
+    if report:
+        with st.sidebar.expander("Startup profile"):
+            for line in report_lines(report):
+                st.write(line)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,210 @@
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import percentile
+from nav_graph import parse_navigation
+from stub_llm_server import start_stub_server, stub_url
+
+SCENARIOS = ("main:openai", "main:mistral", "main:ollama", "main:compact", "app", "app_mistral")
+RESULTS_DIR = "bench_results"
+
+
+# Function to build a question corpus from nav.txt route pairs and captions.json labels
+def build_corpus(size=40, seed=7, nav_path="nav.txt", captions_path="captions.json"):
+    with open(nav_path, "r") as f:
+        routes = parse_navigation(f.read())
+    route_questions = sorted({f"How do I get from {start} to {end}?" for _, start, end, _ in routes})
+    label_questions = []
+    if os.path.exists(captions_path):
+        with open(captions_path, "r") as f:
+            captions = json.load(f)
+        labels = set()
+        for caption in captions.values():
+            labels.update(label.strip() for label in re.findall(r"\*\*([^*:]+):?\*\*", caption))
+        label_questions = sorted(f"Where is the {label}?" for label in labels)
+    rng = random.Random(seed)
+    half = size // 2
+    corpus = rng.sample(route_questions, min(half, len(route_questions)))
+    corpus += rng.sample(label_questions, min(size - len(corpus), len(label_questions)))
+    rng.shuffle(corpus)
+    return corpus
+
+
+# Function to return a callable that answers one question the way each app does
+def scenario_runner(scenario, top_k):
+    if scenario.startswith("main:"):
+        import main
+        variant = scenario.split(":", 1)[1]
+        model, model_name = {
+            "openai": ("OpenAI GPT", None),
+            "mistral": ("Mistral AI", "mistral-medium"),
+            "ollama": ("Ollama", "llama2"),
+            "compact": ("OpenAI GPT", None),
+        }[variant]
+        compact = variant == "compact"
+        # use_store=False: precomputed answers in the answer store would skip the model, like the response cache
+        return lambda question: main.get_directions(question, model, model_name, top_k=top_k, compact=compact,
+                                                    use_store=False)[0]
+
+    import app
+    import app_mistral
+    from retrieval import load_index, format_hits
+    from image_selection import load_map_selector
+    index = load_index()
+    selector = load_map_selector()
+
+    def context_for(question):
+        return format_hits(index.search(question, k=top_k, kind="caption"))
+
+    def maps_for(question):
+        return selector.select(question)[0]
+
+    if scenario == "app":
+        return lambda question: app.get_mistral_response(question, context_for(question), maps_for(question))
+    return lambda question: app_mistral.get_response(question, context_for(question), maps_for(question))[0]
+
+
+# Function to replay the corpus at one concurrency level and summarise the run
+def run_level(scenario, run, corpus, concurrency, server):
+    server.stats.reset()
+    latencies = []
+    errors = []
+
+    def timed(question):
+        started = time.perf_counter()
+        try:
+            run(question)
+        except Exception as error:
+            errors.append(f"{question}: {error}")
+            return
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, corpus))
+    wall = time.perf_counter() - started
+    upstream = server.stats.snapshot()
+    questions = len(corpus)
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "questions": questions,
+        "errors": len(errors),
+        "error_samples": errors[:3],
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "latency_mean": sum(latencies) / len(latencies) if latencies else None,
+        "throughput_qps": questions / wall if wall else None,
+        "upstream_requests": upstream["requests"],
+        "prompt_tokens": upstream["prompt_tokens"],
+        "completion_tokens": upstream["completion_tokens"],
+        "image_bytes": upstream["image_bytes"],
+        "prompt_tokens_per_question": upstream["prompt_tokens"] / questions,
+        "image_bytes_per_question": upstream["image_bytes"] / questions,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_results(results):
+    print(f"{'scenario':<14}{'conc':>5}{'p50':>8}{'p95':>8}{'p99':>8}{'qps':>8}{'prompt tok/q':>14}{'img KB/q':>10}{'err':>5}")
+    for r in results:
+        def fmt(value):
+            return f"{value:.2f}" if value is not None else "-"
+        print(f"{r['scenario']:<14}{r['concurrency']:>5}{fmt(r['latency_p50']):>8}{fmt(r['latency_p95']):>8}"
+              f"{fmt(r['latency_p99']):>8}{fmt(r['throughput_qps']):>8}{r['prompt_tokens_per_question']:>14.0f}"
+              f"{r['image_bytes_per_question'] / 1024:>10.0f}{r['errors']:>5}")
+
+
+# Function to print per-metric changes between two result files
+def compare(baseline_path, candidate_path):
+    with open(baseline_path, "r") as f:
+        baseline = {(r["scenario"], r["concurrency"]): r for r in json.load(f)["results"]}
+    with open(candidate_path, "r") as f:
+        candidate = json.load(f)["results"]
+    metrics = ("latency_p50", "latency_p95", "latency_p99", "prompt_tokens_per_question", "image_bytes_per_question")
+    for r in candidate:
+        old = baseline.get((r["scenario"], r["concurrency"]))
+        if old is None:
+            continue
+        changes = []
+        for metric in metrics:
+            if old[metric] and r[metric] is not None:
+                changes.append(f"{metric} {100 * (r[metric] - old[metric]) / old[metric]:+.1f}%")
+        print(f"{r['scenario']} @ {r['concurrency']}: " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline latency and token benchmark against a local stub LLM")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument("--questions", type=int, default=40, help="corpus size")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--top-k", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.3, help="stub seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="stub generation rate")
+    parser.add_argument("--prefill-tokens-per-second", type=float, default=5000.0, help="stub prompt processing rate")
+    parser.add_argument("--completion-tokens", type=int, default=150)
+    parser.add_argument("--output", help=f"result file (default {RESULTS_DIR}/bench-<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CANDIDATE"), help="compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    server = start_stub_server(latency=args.latency, tokens_per_second=args.tokens_per_second,
+                               prefill_tokens_per_second=args.prefill_tokens_per_second,
+                               completion_tokens=args.completion_tokens)
+    url = stub_url(server)
+    # Point every real SDK at the stub before any client is created
+    os.environ.pop("LLM_PROVIDER", None)
+    os.environ.update({
+        "OPENAI_BASE_URL": f"{url}/v1", "OPENAI_API_KEY": "stub",
+        "MISTRAL_SERVER_URL": url, "MISTRAL_API_KEY": "stub",
+        "OLLAMA_HOST": url,
+    })
+    import response_cache
+    # ttl=0 turns every lookup into a miss, so each question reaches the stub
+    response_cache._cache = response_cache.ResponseCache(
+        path=os.path.join(tempfile.mkdtemp(), "responses.sqlite"), ttl=0)
+
+    corpus = build_corpus(args.questions)
+    results = []
+    for scenario in args.scenarios:
+        run = scenario_runner(scenario, args.top_k)
+        for concurrency in args.concurrency:
+            print(f"Running {scenario} at concurrency {concurrency}...", file=sys.stderr)
+            results.append(run_level(scenario, run, corpus, concurrency, server))
+    server.shutdown()
+
+    print_results(results)
+    commit = git_commit()
+    output = args.output or os.path.join(RESULTS_DIR, f"bench-{commit}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "commit": commit,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+            "corpus": corpus,
+            "results": results,
+        }, f, indent=2)
+    print(f"Wrote {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from file_cache import file_fingerprint, is_image_file
+
+CAPTION_STORE = os.getenv("CAPTION_STORE", os.path.join(".cache", "captions.sqlite"))
+CAPTION_FILE = "captions.json"
+# Where to look for the file behind a captions.json entry when importing it
+IMPORT_FOLDERS = ("files", "files-all", os.path.join(".cache", "tiles"))
+# Captions that came from a JSON file rather than a recorded captioning run
+IMPORTED = "imported"
+
+
+# Function to name a prompt's version: the same text always gives the same version
+def prompt_version(prompt):
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+
+
+def content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Captions keyed by (content hash, model, prompt version) in SQLite. captions.json and
+# .cache/tile_captions.json are "views": name -> content hash tables exported to JSON after
+# every write, so the readers of those files are unchanged. WAL mode lets any number
+# of processes read while one writes; every caption is its own transaction, so
+# concurrent captioning runs never lose each other's results.
+class CaptionStore:
+    def __init__(self, path=CAPTION_STORE):
+        self.path = path
+        self.lock = threading.RLock()  # one connection per process; the lock also spans export()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS captions (hash TEXT, model TEXT, prompt_version TEXT, text TEXT, "
+            "created REAL, PRIMARY KEY (hash, model, prompt_version));"
+            "CREATE TABLE IF NOT EXISTS sources (view TEXT, name TEXT, hash TEXT, PRIMARY KEY (view, name));"
+            "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT);"
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);"
+        )
+
+    # Function to hash a file, re-reading it only when its size or mtime changed
+    def hash_file(self, path):
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, hash FROM files WHERE path = ?", (key,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        digest = content_hash(path)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                            (key, stat.st_size, stat.st_mtime_ns, digest))
+        return digest
+
+    # Function to return the newest caption for some content, optionally of one model and prompt version
+    def get(self, digest, model=None, version=None):
+        query = "SELECT text FROM captions WHERE hash = ?"
+        args = [digest]
+        if model is not None:
+            query += " AND model = ?"
+            args.append(model)
+        if version is not None:
+            query += " AND prompt_version = ?"
+            args.append(version)
+        with self.lock:
+            row = self.db.execute(query + " ORDER BY created DESC LIMIT 1", args).fetchone()
+        return row[0] if row else None
+
+    def put(self, view, name, digest, text, model, version):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute("INSERT OR REPLACE INTO captions VALUES (?, ?, ?, ?, ?)",
+                                (digest, model, version, text, time.time()))
+                self._link(view, name, digest)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def _link(self, view, name, digest):
+        self.db.execute("INSERT INTO sources VALUES (?, ?, ?) ON CONFLICT (view, name) DO UPDATE SET hash = excluded.hash",
+                        (view, name, digest))
+
+    # Function to point a name at content that already has a caption (a renamed or copied file)
+    def link(self, view, name, digest):
+        with self.lock:
+            self._link(view, name, digest)
+
+    # Function to return a view as {name: newest caption}, in the order names were added
+    def view(self, view):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT s.name, (SELECT c.text FROM captions c WHERE c.hash = s.hash ORDER BY c.created DESC LIMIT 1) "
+                "FROM sources s WHERE s.view = ? ORDER BY s.rowid", (view,)).fetchall()
+        return {name: text for name, text in rows if text is not None}
+
+    def names(self, view):
+        with self.lock:
+            return dict(self.db.execute("SELECT name, hash FROM sources WHERE view = ?", (view,)).fetchall())
+
+    # Function to rewrite the view's JSON file atomically. The write lock is held meanwhile,
+    # so exports from several processes land in the order their captions were stored.
+    def export(self, view, caption_file=None):
+        caption_file = caption_file or view
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                captions = self.view(view)
+                tmp_file = f"{caption_file}.{os.getpid()}.tmp"
+                with open(tmp_file, "w") as f:
+                    json.dump(captions, f)
+                os.replace(tmp_file, caption_file)
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                (f"exported:{view}", json.dumps(file_fingerprint(caption_file))))
+            finally:
+                self.db.execute("COMMIT")
+        return captions
+
+    # Function to find the file a JSON entry describes and hash it, or key it by name when it is gone
+    def _entry_hash(self, name, folders):
+        if "#page" in name:
+            from pdf_ingest import page_hashes
+            for folder in folders:
+                pdf_path = os.path.join(folder, name.split("#page")[0])
+                if os.path.exists(pdf_path):
+                    digest = page_hashes(pdf_path).get(name)
+                    if digest:
+                        return digest
+        else:
+            for folder in folders:
+                path = os.path.join(folder, name)
+                if os.path.isfile(path):
+                    return self.hash_file(path)
+        return "name:" + hashlib.sha256(name.encode("utf-8")).hexdigest()
+
+    # Function to take in entries another process or a git pull added to the JSON file.
+    # Skipped entirely when the file is exactly as this store last exported it.
+    def sync(self, view, caption_file=None, folders=IMPORT_FOLDERS):
+        caption_file = caption_file or view
+        if not os.path.exists(caption_file):
+            return 0
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (f"exported:{view}",)).fetchone()
+        if row is not None and json.loads(row[0]) == json.loads(json.dumps(file_fingerprint(caption_file))):
+            return 0
+        with open(caption_file, "r") as f:
+            entries = json.load(f)
+        current = self.view(view)
+        imported = 0
+        for name, text in entries.items():
+            if current.get(name) == text:
+                continue
+            digest = self._entry_hash(name, folders)
+            self.put(view, name, digest, text, IMPORTED, IMPORTED)
+            imported += 1
+        self.export(view, caption_file)
+        return imported
+
+    # Function to caption-check a set of files: returns ({name: caption} for files whose content
+    # has a caption, [paths that need captioning]). Renamed or copied files are linked to their
+    # existing caption instead of being captioned again; edited files get a new hash and are pending.
+    def lookup(self, paths, view=CAPTION_FILE, model=None, version=None):
+        found, pending = {}, []
+        known = self.names(view)
+        linked = False
+        for path in paths:
+            name = os.path.basename(path)
+            digest = self.hash_file(path)
+            text = self.get(digest, model, version)
+            if text is None:
+                pending.append(path)
+                continue
+            found[name] = text
+            if known.get(name) != digest:
+                self.link(view, name, digest)
+                linked = True
+        if linked:
+            self.export(view)
+        return found, pending
+
+    def stats(self):
+        with self.lock:
+            captions, contents = self.db.execute("SELECT COUNT(*), COUNT(DISTINCT hash) FROM captions").fetchone()
+            versions = self.db.execute(
+                "SELECT model, prompt_version, COUNT(*) FROM captions GROUP BY model, prompt_version").fetchall()
+        return {"captions": captions, "contents": contents, "versions": versions}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+# Function to return the process-wide caption store
+def get_caption_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = CaptionStore()
+        return _store
+
+
+# Function to load a captions view. With a folder, only the captions for the images and PDF
+# pages currently in it are returned, looked up by content rather than by file name.
+def load_captions(caption_file=CAPTION_FILE, folder=None):
+    store = get_caption_store()
+    store.sync(caption_file)
+    if folder is None:
+        return store.view(caption_file)
+    entries = sorted(os.listdir(folder))
+    found, _ = store.lookup([os.path.join(folder, name) for name in entries if is_image_file(name)], caption_file)
+    pdfs = {name for name in entries if name.lower().endswith(".pdf")}
+    for name, text in store.view(caption_file).items():
+        if name.split("#page")[0] in pdfs and "#page" in name:
+            found[name] = text
+    return found
@@ -0,0 +1,226 @@
+import os
+import re
+import threading
+import time
+import weakref
+
+from location_resolver import get_location_resolver
+from metrics import current_trace, registry
+from retrieval import estimate_tokens
+
+# History tokens sent word for word; older turns are folded into one summary line each
+CONVERSATION_TOKEN_BUDGET = int(os.getenv("CONVERSATION_TOKEN_BUDGET", 1200))
+# Longest answer gist kept in a folded turn's summary line
+CONVERSATION_GIST_TOKENS = int(os.getenv("CONVERSATION_GIST_TOKENS", 40))
+# Longest answer kept for a turn
+CONVERSATION_ANSWER_TOKENS = int(os.getenv("CONVERSATION_ANSWER_TOKENS", 300))
+# A kiosk's next traveller starts afresh after this long without a question
+CONVERSATION_IDLE_SECONDS = float(os.getenv("CONVERSATION_IDLE_SECONDS", 300))
+# Memory the conversations of all sessions may hold together in this process
+CONVERSATION_MEMORY_BYTES = int(os.getenv("CONVERSATION_MEMORY_BYTES", 16 * 1024 * 1024))
+
+# "and from there to the lounge?", "how long does that take?", "and back?"
+FOLLOW_UP = re.compile(r"\b(there|here|that|it|then|next|back|also|again)\b|^\s*(and|now|what about)\b", re.I)
+BACK = re.compile(r"\b(back|return\w*)\b", re.I)
+# Answer lines that only restate the route or head the steps, and step numbers
+ANSWER_HEADINGS = re.compile(r"^((start|end)\s+point\b.*|.*:)$", re.I)
+STEP_NUMBER = re.compile(r"^(\d+[.)]|[-*•])\s*")
+
+
+# Function to identify a retrieved chunk across turns
+def hit_key(hit):
+    return f"{hit['source']}:{hit['title']}"
+
+
+def trim(text, max_tokens):
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    return text[:max_tokens * 4].rsplit(" ", 1)[0] + " …"
+
+
+# Function to shorten an answer to its first direction, e.g. "Walk past security towards Gate 5."
+def answer_gist(answer):
+    lines = [STEP_NUMBER.sub("", line.strip()) for line in (answer or "").splitlines()]
+    text = " ".join(line for line in lines if line and not ANSWER_HEADINGS.match(line))
+    return trim(re.split(r"(?<=[.!?])\s", text, maxsplit=1)[0], CONVERSATION_GIST_TOKENS)
+
+
+# Function to fold a turn into one summary line: its question, the route it resolved and its answer's gist
+def summarize(turn):
+    line = f"- {turn['question']}"
+    if turn["end"]:
+        line += f" ({turn['start'] or '?'} → {turn['end']})"
+    gist = answer_gist(turn["answer"])
+    if gist:
+        line += f" Answered: {gist}"
+    return line
+
+
+# One session's conversation: the recent turns, a summary line per older turn (its question,
+# route and the gist of its answer), and the start and
+# end locations resolved so far. Follow-up questions are rewritten to name those locations,
+# and the context chunks already sent in the recent turns are not sent again; the earlier
+# answers in the history stand in for them.
+class Conversation:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.turns = []    # recent turns, kept word for word
+        self.summary = []  # summarize() line per older turn
+        self.start = None
+        self.end = None
+        self.last_used = time.time()
+
+    def reset(self):
+        with self.lock:
+            self._reset()
+
+    def _history(self):
+        lines = []
+        if self.summary:
+            lines.append("Earlier in the conversation:")
+            lines += self.summary
+        for turn in self.turns:
+            lines.append(f"Traveller: {turn['question']}")
+            lines.append(f"Assistant: {turn['answer']}")
+        return "\n".join(lines)
+
+    # Function to turn a question into one that stands alone, carrying over the locations
+    # resolved in earlier turns. Returns the turn to hand to record() with the answer.
+    def prepare(self, question):
+        with self.lock:
+            if self.turns and time.time() - self.last_used > CONVERSATION_IDLE_SECONDS:
+                self._reset()
+            self.last_used = time.time()
+            if self.turns and self.turns[-1]["question"] == question:
+                # A Streamlit rerun of the last question, not a new turn
+                return self.turns[-1]
+            resolution = get_location_resolver().resolve(question)
+            start = resolution["start"]["name"] if resolution["start"] else None
+            end = resolution["end"]["name"] if resolution["end"] else None
+            follow_up = bool(self.end and FOLLOW_UP.search(question) and not (start and end))
+            if follow_up:
+                if end is None and BACK.search(question):
+                    start, end = self.end, self.start
+                elif end is None:
+                    start, end = start or self.start, self.end
+                else:
+                    start = self.end
+                follow_up = end is not None
+            standalone = question
+            if follow_up:
+                standalone = f"From {start} to {end}: {question}" if start else f"To {end}: {question}"
+            return {
+                "question": question,
+                "standalone": standalone,
+                "start": start,
+                "end": end,
+                "follow_up": follow_up,
+                "number": len(self.summary) + len(self.turns) + 1,
+                "history": self._history() if follow_up else "",
+                "skip": set().union(*(turn["sent"] for turn in self.turns)) if follow_up else set(),
+                "sent": set(),
+                "answer": None,
+            }
+
+    # Function to store a turn's answer and the context chunks sent with it
+    def record(self, turn, answer, sent=()):
+        with self.lock:
+            turn["answer"] = trim(answer or "", CONVERSATION_ANSWER_TOKENS)
+            turn["sent"] = set(sent)
+            if not (self.turns and self.turns[-1] is turn):
+                if self.turns:
+                    # Only the latest turn is rerun, so only it needs the history it was asked with
+                    self.turns[-1]["history"] = ""
+                self.turns.append(turn)
+            if turn["end"]:
+                self.start, self.end = turn["start"], turn["end"]
+            # Fold the oldest turns into summary lines once the history is over budget,
+            # and drop the oldest summary lines once they take half of it
+            while len(self.turns) > 1 and estimate_tokens(self._history()) > CONVERSATION_TOKEN_BUDGET:
+                self.summary.append(summarize(self.turns.pop(0)))
+            while self.summary and estimate_tokens("\n".join(self.summary)) > CONVERSATION_TOKEN_BUDGET // 2:
+                self.summary.pop(0)
+        memory.enforce()
+
+    # Function to drop the history but keep the resolved locations
+    def forget(self):
+        with self.lock:
+            self.turns = []
+            self.summary = []
+
+    def size(self):
+        with self.lock:
+            return len(self._history().encode("utf-8")) + sum(
+                len(turn["history"]) + sum(len(key) for key in turn["sent"]) for turn in self.turns)
+
+    def tokens(self):
+        with self.lock:
+            return estimate_tokens(self._history()) if self.turns or self.summary else 0
+
+
+# Keeps the total memory of all sessions' conversations under a cap. Conversations are held
+# weakly: one goes away with its Streamlit session.
+class ConversationMemory:
+    def __init__(self, limit=CONVERSATION_MEMORY_BYTES):
+        self.limit = limit
+        self.conversations = weakref.WeakSet()
+        self.lock = threading.Lock()
+
+    def add(self, conversation):
+        with self.lock:
+            self.conversations.add(conversation)
+
+    # Function to forget the least recently used conversations' history until the total fits
+    def enforce(self):
+        with self.lock:
+            conversations = sorted(self.conversations, key=lambda conversation: conversation.last_used)
+        sizes = [conversation.size() for conversation in conversations]
+        total = sum(sizes)
+        for conversation, size in zip(conversations, sizes):
+            if total <= self.limit:
+                break
+            if size:
+                conversation.forget()
+                total -= size - conversation.size()
+                registry.count("conversation_evictions_total")
+        return total
+
+    def stats(self):
+        with self.lock:
+            conversations = list(self.conversations)
+        return {"sessions": len(conversations), "bytes": sum(c.size() for c in conversations), "limit": self.limit}
+
+
+memory = ConversationMemory()
+
+
+# Function to return the session's conversation, e.g. get_conversation(st.session_state)
+def get_conversation(state, key="conversation"):
+    if key not in state:
+        conversation = Conversation()
+        memory.add(conversation)
+        state[key] = conversation
+    return state[key]
+
+
+# Function to leave out the retrieved chunks the recent turns already sent, and note the
+# tokens that saved on the current request's trace
+def new_hits(hits, turn):
+    fresh = [hit for hit in hits if hit_key(hit) not in turn["skip"]]
+    saved = sum(estimate_tokens(hit["text"]) for hit in hits if hit_key(hit) in turn["skip"])
+    trace = current_trace()
+    if trace is not None:
+        trace.labels.update(turn=turn["number"], follow_up=turn["follow_up"], context_tokens_saved=saved)
+    if saved:
+        registry.count("context_tokens_saved_total", saved)
+    return fresh
+
+
+# Function to add the conversation so far after a request's context, before the question
+def with_history(context, turn):
+    if not turn["history"]:
+        return context
+    return f"{context}\n\nConversation so far:\n{turn['history']}"
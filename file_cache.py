@@ -0,0 +1,43 @@
+import os
+
+from image_payloads import encode_image
+
+THUMBNAIL_MAX_SIDE = int(os.getenv("THUMBNAIL_MAX_SIDE", 900))
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+# Function to fingerprint files (and the files inside folders) by size and mtime.
+# Passing the result to a Streamlit-cached function makes it recompute only when
+# one of the files changes, for the price of a few stat() calls per rerun.
+def file_fingerprint(*paths):
+    fingerprint = []
+    for path in paths:
+        entries = sorted(os.path.join(path, name) for name in os.listdir(path)) if os.path.isdir(path) else [path]
+        for entry in entries:
+            try:
+                stat = os.stat(entry)
+            except FileNotFoundError:
+                fingerprint.append((entry, None, None))
+                continue
+            fingerprint.append((entry, stat.st_size, stat.st_mtime_ns))
+    return tuple(fingerprint)
+
+
+# Function to split nav.txt into (title, body) sections for display
+def load_navigation_sections(path="nav.txt"):
+    with open(path, "r") as f:
+        text = f.read()
+    sections = []
+    for section in text.split("##")[1:]:  # Skip the first empty section
+        sections.append((section.split("\n")[0].strip(), section))
+    return sections
+
+
+# Function to render a small JPEG preview of a floor plan
+def thumbnail_bytes(path, max_side=THUMBNAIL_MAX_SIDE):
+    return encode_image(path, max_side, "JPEG", 80)
+
+
+# captions.json also holds PDF pages ("guide.pdf#page2"), which have no image to show or send
+def is_image_file(filename):
+    return filename.lower().endswith(IMAGE_EXTENSIONS)
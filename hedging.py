@@ -0,0 +1,153 @@
+import contextvars
+import os
+import queue
+import threading
+import time
+
+from metrics import registry
+from providers import StreamGroup, open_streams
+
+# Seconds to wait for the primary's first token before asking the secondary too
+HEDGE_DELAY = float(os.getenv("HEDGE_DELAY", 2.0))
+# Seconds to wait for any first token before giving up
+HEDGE_TIMEOUT = float(os.getenv("HEDGE_TIMEOUT", 30.0))
+
+
+class HedgeTimeout(TimeoutError):
+    pass
+
+
+# Races streamed answers from several backends. The primary starts at once; each
+# next backend starts when nobody has produced a first token within `delay` (or
+# straight away when the one before it fails). The first backend to produce a
+# token wins and is streamed; the others are cancelled: their HTTP streams are closed,
+# so a loser stalled before its next chunk ends and frees its provider slot.
+class Hedge:
+    def __init__(self, attempts=(), delay=HEDGE_DELAY, timeout=HEDGE_TIMEOUT):
+        self.attempts = list(attempts)  # [(label, function returning a chunk iterator)], primary first
+        self.delay = delay
+        self.timeout = timeout
+        self.events = queue.Queue()
+        self.cancelled = set()
+        self.streams = {}  # label -> StreamGroup of the streams that backend opened
+        self.winner = None
+        self.results = {}  # label -> {"status", "started", "ttft", "seconds", "error"}
+        self.started = None
+
+    def add(self, label, start):
+        self.attempts.append((label, start))
+
+    # Function to run one backend in its own thread, forwarding chunks until it is cancelled
+    def _run(self, label, start):
+        began = time.perf_counter()
+        result = self.results[label]
+        # This thread runs in its own copy of the context, so only its own streams join the group
+        open_streams.set(self.streams[label])
+        chunks = None
+        try:
+            chunks = iter(start())
+            for chunk in chunks:
+                if label in self.cancelled:
+                    break
+                if result["ttft"] is None:
+                    result["ttft"] = time.perf_counter() - began
+                self.events.put(("chunk", label, chunk))
+        except Exception as error:
+            if label not in self.cancelled:
+                # A cancelled backend fails because its stream was closed under it
+                result["error"] = str(error)
+            self.events.put(("error", label, error))
+            return
+        finally:
+            if chunks is not None and hasattr(chunks, "close"):
+                # Closing the generator closes the provider stream and skips its cache write
+                chunks.close()
+            result["seconds"] = time.perf_counter() - began
+        self.events.put(("done", label, None))
+
+    def _launch(self, index):
+        label, start = self.attempts[index]
+        self.results[label] = {"status": "running", "started": time.perf_counter() - self.started, "ttft": None,
+                               "seconds": None, "error": None}
+        self.streams[label] = StreamGroup()
+        # Copy the context so provider calls still land in the current request's trace
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(self._run, label, start), daemon=True).start()
+
+    def _cancel(self, label):
+        self.results[label]["status"] = "cancelled"
+        self.cancelled.add(label)
+        self.streams[label].close()
+
+    def _cancel_others(self):
+        for label, result in self.results.items():
+            if label != self.winner and result["status"] == "running":
+                self._cancel(label)
+
+    # Function to yield the winning backend's chunks
+    def stream(self):
+        self.started = time.perf_counter()
+        try:
+            yield from self._race()
+        finally:
+            # Also reached when the reader stops early: nothing keeps streaming in the background
+            for label, result in self.results.items():
+                if result["status"] == "running":
+                    self._cancel(label)
+
+    def _race(self):
+        launched = 1
+        failed = 0
+        self._launch(0)
+        next_launch = self.started + self.delay
+        deadline = self.started + self.timeout
+        while True:
+            now = time.perf_counter()
+            if self.winner is None:
+                if launched < len(self.attempts) and now >= next_launch:
+                    self._launch(launched)
+                    launched += 1
+                    next_launch = now + self.delay
+                if now >= deadline:
+                    raise HedgeTimeout(f"no backend answered within {self.timeout:g}s")
+                wait = min(deadline, next_launch if launched < len(self.attempts) else deadline) - now
+            else:
+                wait = None
+            try:
+                kind, label, payload = self.events.get(timeout=wait)
+            except queue.Empty:
+                continue
+            if label in self.cancelled:
+                continue
+            if kind == "error":
+                self.results[label]["status"] = "error"
+                failed += 1
+                if label == self.winner or failed == len(self.attempts):
+                    raise payload
+                if failed == launched and launched < len(self.attempts):
+                    # Everything in flight has failed; do not wait out the delay
+                    next_launch = time.perf_counter()
+                continue
+            if self.winner is None:
+                self.winner = label
+                self._cancel_others()
+                registry.count("hedge_wins_total", backend=label)
+                registry.sample("hedge_first_token_seconds", time.perf_counter() - self.started, backend=label)
+            if kind == "done":
+                self.results[label]["status"] = "won"
+                return
+            yield payload
+
+    # Function to describe the race in one line, e.g. for a caption under the answer
+    def describe(self):
+        parts = []
+        for label, result in self.results.items():
+            text = f"{label} {result['status']}"
+            if result["ttft"] is not None:
+                text += f", first token {result['ttft']:.2f}s"
+            if result["seconds"] is not None:
+                text += f", {result['seconds']:.2f}s"
+            if result["started"] >= 0.05:
+                text += f" (started +{result['started']:.1f}s)"
+            parts.append(text)
+        return "; ".join(parts)
@@ -0,0 +1,84 @@
+import base64
+import hashlib
+import io
+import os
+import threading
+
+from metrics import record_image_encoded
+
+CACHE_DIR = os.path.join(".cache", "images")
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", 1600))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()  # JPEG or WEBP
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 85))
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+_payloads = {}  # content key -> data URL
+_keys = {}      # (path, size, mtime) -> content key
+_lock = threading.Lock()
+
+
+def _content_key(path, max_side, fmt, quality):
+    stat = os.stat(path)
+    stamp = (path, stat.st_size, stat.st_mtime_ns, max_side, fmt, quality)
+    key = _keys.get(stamp)
+    if key is None:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        digest.update(f"{max_side}:{fmt}:{quality}".encode("utf-8"))
+        key = digest.hexdigest()
+        _keys[stamp] = key
+    return key
+
+
+# Function to downscale and recompress an image into upload-ready bytes
+def encode_image(path, max_side=IMAGE_MAX_SIDE, fmt=IMAGE_FORMAT, quality=IMAGE_QUALITY):
+    # Imported here, not at module load: main.py never decodes an image
+    from PIL import Image
+    with Image.open(path) as image:
+        image.load()
+        if max(image.size) > max_side:
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+        if fmt == "JPEG" and image.mode != "RGB":
+            # JPEG has no alpha channel; flatten transparent floor plans onto white
+            background = Image.new("RGB", image.size, "white")
+            rgba = image.convert("RGBA")
+            background.paste(rgba, mask=rgba.split()[-1])
+            image = background
+        buffer = io.BytesIO()
+        image.save(buffer, format=fmt, quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+# Function to return a ready-to-send data URL for an image, encoding it at most once
+def get_data_url(path, max_side=IMAGE_MAX_SIDE, fmt=IMAGE_FORMAT, quality=IMAGE_QUALITY):
+    key = _content_key(path, max_side, fmt, quality)
+    payload = _payloads.get(key)
+    if payload is not None:
+        return payload
+    with _lock:
+        payload = _payloads.get(key)
+        if payload is None:
+            cached_path = os.path.join(CACHE_DIR, f"{key}.{fmt.lower()}")
+            if os.path.exists(cached_path):
+                with open(cached_path, "rb") as f:
+                    data = f.read()
+            else:
+                data = encode_image(path, max_side, fmt, quality)
+                record_image_encoded(len(data))
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                tmp_path = cached_path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, cached_path)
+            payload = f"data:{MIME_TYPES[fmt]};base64,{base64.b64encode(data).decode('utf-8')}"
+            _payloads[key] = payload
+    return payload
+
+
+# Function to prepare payloads for every image up front (called at app startup)
+def prepare_images(paths):
+    return {path: get_data_url(path) for path in paths if os.path.exists(path)}
+
@@ -0,0 +1,103 @@
+import logging
+import os
+import re
+
+from caption_store import load_captions
+from file_cache import is_image_file
+from retrieval import TfidfVectorizer, tokenize
+
+logger = logging.getLogger(__name__)
+
+IMAGE_MAX_COUNT = int(os.getenv("IMAGE_MAX_COUNT", 2))
+IMAGE_MIN_SCORE = float(os.getenv("IMAGE_MIN_SCORE", 0.15))
+TERMINAL_WEIGHT = 1.0
+LABEL_WEIGHT = 0.5
+
+# "Terminal 2", "terminal-2", "T2", "Concourse A", "Concourse_A"
+TERMINAL_PATTERN = re.compile(r"\b(?:terminal[\s_-]*(\d+)|t(\d)\b|concourse[\s_-]*([a-d])\b)", re.I)
+# Bold caption labels such as "**Baggage Reclaim:**" and markdown headings
+LABEL_PATTERN = re.compile(r"\*\*([^*:\n]+):?\*\*|^#+\s*(.+)$", re.M)
+STOPWORDS = set("a an and are at can do from get go how i in is it me my of on the to what where which with".split())
+
+
+# Function to return the terminals/concourses a piece of text refers to, e.g. {"terminal 2"}
+def find_terminals(text):
+    terminals = set()
+    for number, short, concourse in TERMINAL_PATTERN.findall(text):
+        if concourse:
+            terminals.add(f"concourse {concourse.lower()}")
+        else:
+            terminals.add(f"terminal {number or short}")
+    return terminals
+
+
+def normalize_label(label):
+    return " ".join(t for t in tokenize(label) if t not in STOPWORDS)
+
+
+class MapSelector:
+    def __init__(self, captions, folder="files"):
+        captions = {filename: caption for filename, caption in captions.items() if is_image_file(filename)}
+        self.filenames = list(captions)
+        self.paths = [os.path.join(folder, filename) for filename in self.filenames]
+        # A map belongs to the terminals named in its filename, or else in its caption
+        self.terminals = [find_terminals(filename.replace("_", " ")) or find_terminals(caption)
+                          for filename, caption in captions.items()]
+        # Location keyword index: normalized label -> maps that show it
+        self.labels = {}
+        for i, caption in enumerate(captions.values()):
+            for bold, heading in LABEL_PATTERN.findall(caption):
+                label = normalize_label(bold or heading)
+                if label and not find_terminals(label):
+                    self.labels.setdefault(label, set()).add(i)
+        texts = [" ".join(t for t in tokenize(f"{filename} {caption}") if t not in STOPWORDS)
+                 for filename, caption in captions.items()]
+        self.vectorizer = TfidfVectorizer().fit(texts)
+        self.vectors = self.vectorizer.transform(texts)
+
+    # Function to score every map against a question; returns [(filename, score, reasons)] best first
+    def score(self, question):
+        if not self.filenames:
+            return []
+        words = [t for t in tokenize(question) if t not in STOPWORDS]
+        similarity = self.vectors @ self.vectorizer.transform([" ".join(words)])[0]
+        asked_terminals = find_terminals(question)
+        text = f" {' '.join(words)} "
+        matched_labels = [label for label in self.labels if f" {label} " in text]
+        scored = []
+        for i, filename in enumerate(self.filenames):
+            score = float(similarity[i])
+            reasons = [f"caption {score:.2f}"]
+            if asked_terminals and self.terminals[i]:
+                if asked_terminals & self.terminals[i]:
+                    score += TERMINAL_WEIGHT
+                    reasons.append("terminal match")
+                else:
+                    # A map of another terminal cannot help, however similar its caption reads
+                    score = 0.0
+                    reasons.append("other terminal")
+                    scored.append((filename, score, reasons))
+                    continue
+            for label in matched_labels:
+                if i in self.labels[label]:
+                    # Labels every map shares (restrooms, gates) say little about which map to send
+                    score += LABEL_WEIGHT / len(self.labels[label])
+                    reasons.append(f"label '{label}'")
+            scored.append((filename, score, reasons))
+        scored.sort(key=lambda item: -item[1])
+        return scored
+
+    # Function to pick the image paths worth sending with a question; none when no map scores well
+    def select(self, question, max_images=IMAGE_MAX_COUNT, min_score=IMAGE_MIN_SCORE):
+        scored = self.score(question)
+        logger.info("Map relevance for %r: %s", question,
+                    ", ".join(f"{filename}={score:.2f}" for filename, score, _ in scored))
+        chosen = [filename for filename, score, _ in scored[:max_images] if score >= min_score]
+        paths = [self.paths[self.filenames.index(filename)] for filename in chosen]
+        return paths, scored
+
+
+# Function to build a selector over the maps in folder that have a caption; captions.json
+# also lists maps kept elsewhere (files-all/), which cannot be sent from here
+def load_map_selector(captions_path="captions.json", folder="files"):
+    return MapSelector(load_captions(captions_path, folder=folder), folder)
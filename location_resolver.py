@@ -0,0 +1,349 @@
+import json
+import os
+import re
+import threading
+
+from file_cache import file_fingerprint
+from image_selection import LABEL_PATTERN, find_terminals
+from nav_graph import normalize_name, parse_navigation
+
+# Below this the app_mistral location stage falls back to the LLM
+LOCATION_CONFIDENCE = float(os.getenv("LOCATION_CONFIDENCE", 0.75))
+FUZZY_THRESHOLD = 0.55
+
+# Section headers such as "From Police Station to All Locations"
+SECTION_PLACE = re.compile(r"^from (?P<name>.+?) to (?:all|available)\b", re.I)
+
+NUMBER_WORDS = {"one": "1", "two": "2", "three": "3", "four": "4", "five": "5", "six": "6", "seven": "7",
+                "eight": "8", "nine": "9", "ten": "10", "eleven": "11", "twelve": "12", "first": "1",
+                "second": "2", "third": "3"}
+
+# What travellers say -> the name nav.txt uses
+ALIASES = {
+    "baggage": "baggage reclaim",
+    "baggage claim": "baggage reclaim",
+    "luggage": "baggage reclaim",
+    "bags": "baggage reclaim",
+    "passport": "passport control",
+    "customs": "passport control",
+    "security": "security screening",
+    "security check": "security screening",
+    "bathroom": "toilet",
+    "restroom": "toilet",
+    "restrooms": "toilet",
+    "washroom": "toilet",
+    "loo": "toilet",
+    "wc": "toilet",
+    "toilets": "toilet",
+    "mosque": "prayer room",
+    "prayer": "prayer room",
+    "money exchange": "currency exchange",
+    "forex": "currency exchange",
+    "atm": "atms",
+    "cash machine": "atms",
+    "cab": "taxi stand",
+    "taxi": "taxi stand",
+    "taxis": "taxi stand",
+    "doctor": "medical centre",
+    "clinic": "medical centre",
+    "police": "police station",
+    "info desk": "information desk",
+    "help desk": "information desk",
+    "mcdonalds": "mcdonald's",
+    "lost and found": "lost property",
+    "departures": "departure gates",
+}
+
+# Wording that asks for more than a single walk from A to B
+COMPLEX_REQUEST = re.compile(r"\b(connect\w*|transfer\w*|transit|layover|wheelchair|step.free|accessib\w+|"
+                             r"avoid\w*|via|stroller|pram|quickest|fastest|shortest)\b", re.I)
+
+STOPWORDS = set("a an and are at can do does for from get go how i in is it me my near nearest of on or the "
+                "there to what where which with way you".split())
+# A place after these is a landmark ("a toilet near Gate 3"), not where the walk starts or ends;
+# "the nearest toilet" still names the destination
+NEAR_WORDS = {"near", "by", "beside", "around", "opposite", "behind", "past"}
+NEAR_PAIRS = {("close", "to"), ("next", "to"), ("closest", "to"), ("nearest", "to")}
+# Words that can come before "to" without naming a place: "how to", "want to go to", "walk to"
+TO_LEAD_WORDS = STOPWORDS | {"want", "need", "like", "going", "walk", "head", "directions", "route", "back", "come",
+                             "take", "have", "able", "me", "us", "way", "trying", "try", "plan"}
+# A number is part of a place ("gate 6") unless it is a terminal or a quantity ("30 minutes", "2 bags")
+TERMINAL_WORDS = {"terminal", "concourse", "t"}
+QUANTITY = re.compile(r"^\d+(?:m|min|mins|h|hr|hrs|kg)?$")
+UNIT_WORDS = {"minutes", "minute", "mins", "min", "hours", "hour", "hrs", "metres", "meters", "m", "bags", "kg",
+              "people", "children", "kids", "am", "pm"}
+
+
+def trigrams(text):
+    padded = f" {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# Function to score two short strings by Jaro-Winkler similarity (kind to typos near the end)
+def jaro_winkler(a, b):
+    if a == b:
+        return 1.0
+    window = max(len(a), len(b)) // 2 - 1
+    matched_b = [False] * len(b)
+    matches_a = []
+    for i, char in enumerate(a):
+        for j in range(max(0, i - window), min(len(b), i + window + 1)):
+            if not matched_b[j] and b[j] == char:
+                matched_b[j] = True
+                matches_a.append(char)
+                break
+    if not matches_a:
+        return 0.0
+    matches_b = [b[j] for j in range(len(b)) if matched_b[j]]
+    transpositions = sum(x != y for x, y in zip(matches_a, matches_b)) / 2
+    m = len(matches_a)
+    jaro = (m / len(a) + m / len(b) + (m - transpositions) / m) / 3
+    prefix = 0
+    for x, y in zip(a[:4], b[:4]):
+        if x != y:
+            break
+        prefix += 1
+    return jaro + prefix * 0.1 * (1 - jaro)
+
+
+class LocationResolver:
+    def __init__(self, names, aliases=ALIASES):
+        self.names = dict(names)  # canonical id -> display name
+        self.exact = {}           # phrase -> (canonical id, score)
+        for key in self.names:
+            self.exact[key] = (key, 1.0)
+            # "Prayer Room (Arrival)" is also reachable as "prayer room arrival"
+            self.exact.setdefault(re.sub(r"[()]", "", key), (key, 1.0))
+        for alias, target in aliases.items():
+            if target in self.names:
+                self.exact.setdefault(alias, (target, 0.95))
+        self.max_words = max((len(phrase.split()) for phrase in self.exact), default=1)
+        # Character trigram postings over the canonical names, for typo-tolerant matching
+        self.phrases = list(self.names)
+        self.phrase_trigrams = [trigrams(phrase) for phrase in self.phrases]
+        self.postings = {}
+        for i, grams in enumerate(self.phrase_trigrams):
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(i)
+
+    def _fuzzy(self, phrase):
+        grams = trigrams(phrase)
+        counts = {}
+        for gram in grams:
+            for i in self.postings.get(gram, ()):
+                counts[i] = counts.get(i, 0) + 1
+        best, best_score = None, 0.0
+        digits = re.findall(r"\d+", phrase)
+        for i, shared in counts.items():
+            # Trigram overlap picks the candidates; "gate 6" must never resolve to "gate 5"
+            if 2 * shared / (len(grams) + len(self.phrase_trigrams[i])) < FUZZY_THRESHOLD:
+                continue
+            if re.findall(r"\d+", self.phrases[i]) != digits:
+                continue
+            score = jaro_winkler(phrase, self.phrases[i])
+            if score > best_score:
+                best, best_score = i, score
+        if best is None:
+            return None
+        # A fuzzy hit is never as certain as an exact one
+        return self.phrases[best], round(0.9 * best_score, 3)
+
+    # Function to find location mentions as (first token, last token + 1, id, score, text)
+    def _mentions(self, tokens):
+        found = []
+        covered = set()
+        for i in range(len(tokens)):
+            if i in covered or tokens[i] in STOPWORDS:
+                continue
+            for length in range(min(self.max_words, len(tokens) - i), 0, -1):
+                phrase = " ".join(tokens[i:i + length])
+                if phrase in self.exact:
+                    key, score = self.exact[phrase]
+                    found.append((i, i + length, key, score, phrase))
+                    covered.update(range(i, i + length))
+                    break
+        for i in range(len(tokens)):
+            if i in covered or tokens[i] in STOPWORDS:
+                continue
+            best = None
+            for length in range(1, 4):
+                span = tokens[i:i + length]
+                if len(span) < length or set(range(i, i + length)) & covered or span[-1] in STOPWORDS:
+                    break
+                phrase = " ".join(span)
+                if len(phrase) < 4 or (i + length < len(tokens) and tokens[i + length].isdigit()):
+                    # A number right after the span belongs to the name ("gate 6")
+                    continue
+                match = self._fuzzy(phrase)
+                if match and (best is None or match[1] >= best[3]):
+                    best = (i, i + length, match[0], match[1], phrase)
+            if best:
+                found.append(best)
+                covered.update(range(best[0], best[1]))
+        found.sort()
+        return found
+
+    # Function to resolve a question's start and end points with confidence scores. Places
+    # named as landmarks ("near Gate 3") are returned as "near", not as endpoints; confidence
+    # drops when the question names a place that could not be resolved.
+    def resolve(self, question):
+        text = normalize_name(question)
+        tokens = [NUMBER_WORDS.get(token, token) for token in text.split()]
+        found = self._mentions(tokens)
+        covered = set()
+        for mention in found:
+            covered.update(range(mention[0], mention[1]))
+        mentions = []
+        for mention in found:
+            if all(mention[2] != other[2] for other in mentions):
+                mentions.append(mention)
+
+        def previous(i):
+            # The word before token i, skipping articles
+            i -= 1
+            while i >= 0 and tokens[i] in ("a", "an", "the"):
+                i -= 1
+            return (tokens[i] if i >= 0 else "", tokens[i - 1] if i >= 1 else "")
+
+        start = end = near = None
+        endpoints = []
+        for mention in mentions:
+            before, two_before = previous(mention[0])
+            if before in NEAR_WORDS or (two_before, before) in NEAR_PAIRS:
+                near = near or mention
+            else:
+                endpoints.append((mention, before))
+        for mention, before in endpoints:
+            if before == "from" and start is None:
+                start = mention
+            elif before in ("to", "reach", "find") and end is None:
+                end = mention
+        rest = [m for m, _ in endpoints if m is not start and m is not end]
+        if start is None and end is None and len(rest) >= 2:
+            start, end = rest[0], rest[1]
+        elif end is None and rest:
+            end = rest[0]
+        elif start is None and rest:
+            start = rest[0]
+
+        def describe(mention):
+            if mention is None:
+                return None
+            return {"id": mention[2], "name": self.names[mention[2]], "score": mention[3], "matched": mention[4]}
+
+        scores = [m[3] for m in (start, end) if m is not None]
+        confidence = min(scores) if scores else 0.0
+        unresolved = self._unresolved(tokens, covered)
+        if unresolved or (start is None and "from" in tokens):
+            # The question names a place we could not place
+            confidence = min(confidence, 0.5)
+        return {
+            "start": describe(start),
+            "end": describe(end),
+            "near": describe(near),
+            "terminal": sorted(find_terminals(question)) or None,
+            "confidence": confidence,
+            "unresolved": unresolved,
+        }
+
+    # Function to list the place-like words no mention covers: a gate or other numbered place
+    # ("gate 6" when nav.txt has no Gate 6), or the word before "to" in "X to Gate 5"
+    def _unresolved(self, tokens, covered):
+        unresolved = []
+        for i, token in enumerate(tokens):
+            if i in covered or not any(char.isdigit() for char in token):
+                continue
+            before = tokens[i - 1] if i else ""
+            after = tokens[i + 1] if i + 1 < len(tokens) else ""
+            if before in TERMINAL_WORDS or re.fullmatch(r"t\d", token):
+                continue
+            if QUANTITY.match(token) and (after in UNIT_WORDS or not before or before in STOPWORDS):
+                continue
+            unresolved.append(f"{before} {token}".strip() if before and before not in STOPWORDS else token)
+        for i, token in enumerate(tokens[1:-1], 1):
+            other = tokens[i - 1]
+            if token == "to" and i + 1 in covered and i - 1 not in covered and other not in TO_LEAD_WORDS \
+                    and (other, "to") not in NEAR_PAIRS and not any(char.isdigit() for char in other):
+                unresolved.append(other)
+        return unresolved
+
+
+# Function to choose how much analysis a question needs: "fast" (one call) for "where is X"
+# and for a confidently resolved start/end pair, "full" for ambiguous or multi-terminal ones.
+# Returns (depth, reason).
+def classify_request(question, resolution):
+    if resolution["confidence"] < LOCATION_CONFIDENCE:
+        return "full", f"locations unclear (confidence {resolution['confidence']:.2f})"
+    if resolution["terminal"] and len(resolution["terminal"]) > 1:
+        return "full", f"spans terminals {', '.join(resolution['terminal'])}"
+    # Place names written out in full, such as "Transfer Desk", do not count
+    text = normalize_name(question)
+    for place in (resolution["start"], resolution["end"]):
+        if place and place["matched"] == place["id"]:
+            text = text.replace(place["matched"], " ")
+    complex_request = COMPLEX_REQUEST.search(text)
+    if complex_request:
+        return "full", f"asks about '{complex_request.group(0)}'"
+    if resolution["start"] and resolution["end"]:
+        return "fast", "known start and destination"
+    if resolution["end"]:
+        return "fast", "single destination"
+    return "full", "no destination found"
+
+
+# Function to describe a resolution in the wording of the LLM location stage
+def format_resolution(resolution):
+    lines = []
+    for role, label in (("start", "Starting point"), ("end", "Destination")):
+        place = resolution[role]
+        lines.append(f"- {label}: {place['name'] if place else 'not stated (assume the traveller’s current position)'}")
+    if resolution["terminal"]:
+        lines.append(f"- Terminal: {', '.join(resolution['terminal'])}")
+    if resolution.get("near"):
+        lines.append(f"- Near: {resolution['near']['name']}")
+    if resolution.get("unresolved"):
+        lines.append(f"- Not recognised: {', '.join(resolution['unresolved'])}")
+    lines.append("- Both points clearly specified: " + ("yes" if resolution["start"] and resolution["end"] else "no"))
+    lines.append(f"- Resolved locally with confidence {resolution['confidence']:.2f}")
+    return "\n".join(lines)
+
+
+# Function to collect location names from nav.txt routes and headers and captions.json labels
+def collect_names(nav_path="nav.txt", captions_path="captions.json"):
+    names = {}
+    with open(nav_path, "r") as f:
+        text = f.read()
+    for _, start, end, _ in parse_navigation(text):
+        for name in (start, end):
+            names.setdefault(normalize_name(name), name.strip())
+    for line in text.splitlines():
+        if line.startswith("#"):
+            place = SECTION_PLACE.match(line.strip("# :"))
+            if place:
+                names.setdefault(normalize_name(place.group("name")), place.group("name"))
+    if os.path.exists(captions_path):
+        with open(captions_path, "r") as f:
+            captions = json.load(f)
+        for caption in captions.values():
+            for bold, _ in LABEL_PATTERN.findall(caption):
+                label = bold.strip()
+                if label and len(label.split()) <= 4 and not find_terminals(label):
+                    names.setdefault(normalize_name(label), label)
+    names.pop("", None)
+    return names
+
+
+_resolver = None
+_fingerprint = None
+_lock = threading.Lock()
+
+
+# Function to return the process-wide resolver, rebuilt when nav.txt or captions.json change
+def get_location_resolver(nav_path="nav.txt", captions_path="captions.json"):
+    global _resolver, _fingerprint
+    fingerprint = file_fingerprint(nav_path, captions_path)
+    with _lock:
+        if _resolver is None or fingerprint != _fingerprint:
+            _resolver = LocationResolver(collect_names(nav_path, captions_path))
+            _fingerprint = fingerprint
+        return _resolver
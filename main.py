@@ -1,101 +1,209 @@
+# First, so STARTUP_PROFILE=1 can time the imports below
+from startup import mark, first_render, report_lines
 import streamlit as st
 import os
-import json
 from dotenv import load_dotenv
-import openai
-from PIL import Image
-import ollama
-import base64
-from mistralai import Mistral
+from providers import get_provider, warm_up
+from nav_graph import load_nav_graph, format_route
+from retrieval import load_index, format_hits, estimate_tokens
+from nav_compact import compile_navigation
+from file_cache import file_fingerprint, load_navigation_sections
+from response_cache import get_response_cache
+from answer_store import AnswerStore, ANSWER_FILE, backend_label
+from streaming import timed_stream, format_stream_stats
+from metrics import traced, stage, breakdown_lines
+from ollama_manager import get_ollama_manager, format_status, OLLAMA_PRELOAD, OLLAMA_REFRESH_SECONDS
+from hedging import Hedge, HEDGE_DELAY
+from prompt_layout import build_messages
+from conversation import get_conversation, new_hits, with_history, hit_key, memory
 
 # Load environment variables
 load_dotenv()
 
-# Set up OpenAI API key
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# Most navigation sections the retrieval slider can ask for
+MAX_TOP_K = 12
 
-# Function to load navigation data
-def load_navigation_data():
-    with open("nav.txt", "r") as f:
-        return f.read()
+# Everything derived from nav.txt and captions.json is cached per file fingerprint,
+# so reruns reuse it and an edited file is picked up on the next rerun
+def nav_fingerprint():
+    return file_fingerprint("nav.txt")
+
+def index_fingerprint():
+    return file_fingerprint("nav.txt", "captions.json")
+
+# Split nav.txt into sections for the route browser
+@st.cache_data(max_entries=1)
+def initialize_navigation_sections(fingerprint):
+    return load_navigation_sections()
+
+# Build the route graph; all-pairs routes are precomputed here
+@st.cache_resource(max_entries=1)
+def initialize_nav_graph(fingerprint):
+    return load_nav_graph()
+
+# Build (or load the persisted) retrieval index over nav.txt and captions.json
+@st.cache_resource(max_entries=1)
+def initialize_retrieval(fingerprint):
+    return load_index()
+
+# Compile nav.txt into the deduplicated route table used by the compact context mode
+@st.cache_resource(max_entries=1)
+def initialize_compact_nav(fingerprint):
+    return compile_navigation()
+
+# Start loading the OLLAMA_PRELOAD models once per process, with num_ctx sized for the
+# largest context we actually send (the whole compact table or the top MAX_TOP_K sections)
+# so later calls do not trigger a reload
+@st.cache_resource(max_entries=1)
+def initialize_ollama_manager(fingerprint):
+    manager = get_ollama_manager()
+    manager.size_for(max(estimate_tokens(initialize_compact_nav(nav_fingerprint()).render()),
+                         initialize_retrieval(fingerprint).total_tokens("nav", largest=MAX_TOP_K)))
+    manager.preload(OLLAMA_PRELOAD)
+    return manager
+
+# Open the precomputed answer store (see answer_store.py); reloaded when the file grows
+@st.cache_resource(max_entries=1)
+def initialize_answer_store(fingerprint):
+    return AnswerStore(graph=initialize_nav_graph(nav_fingerprint()))
+
+# The same instructions for every backend and question, so each provider (and Ollama's
+# KV cache) can reuse the processed system prompt; see prompt_layout.py
+NAVIGATION_SYSTEM_PROMPT = ("You are an airport navigation assistant. Use the provided navigation data to give clear, "
+                            "step-by-step directions. Provide step-by-step directions in a clear, concise format.")
+
+# Function to lay out a navigation prompt: instructions, then the navigation data, then the question
+def navigation_messages(prompt, context):
+    return build_messages(NAVIGATION_SYSTEM_PROMPT, f"Please answer the following question:\n{prompt}",
+                          context=f"Using this navigation data:\n\n{context}")
 
 # Function to get response from OpenAI GPT
-def get_openai_response(prompt, context):
-    client = openai.OpenAI()
-    messages = [
-        {"role": "system", "content": "You are an airport navigation assistant. Use the provided navigation data to give clear, step-by-step directions."},
-        {"role": "user", "content": f"""
-            Using this navigation data:
+def get_openai_response(prompt, context, stream=False):
+    provider = get_provider("openai")
+    messages = navigation_messages(prompt, context)
+
+    def call():
+        return provider.complete("gpt-4", messages, max_tokens=500)
 
-            {context}
+    def call_stream():
+        return provider.stream("gpt-4", messages, max_tokens=500)
 
-            Please answer the following question:
-            {prompt}
+    if stream:
+        return get_response_cache().fetch_stream("openai", "gpt-4", prompt, call_stream,
+                                                 context=context, messages=messages)
+    return get_response_cache().fetch("openai", "gpt-4", prompt, call, context=context, messages=messages)
 
-            Provide step-by-step directions in a clear, concise format.
-        """}
-    ]
-    
-    response = client.chat.completions.create(
-        model="gpt-4",
-        messages=messages,
-        max_tokens=500
-    )
-    return response.choices[0].message.content
+def get_mistral_response(prompt, context, model_name, stream=False):
+    provider = get_provider("mistral")
+    messages = navigation_messages(prompt, context)
 
-def get_mistral_response(prompt, context, model_name):
-    api_key = os.getenv("MISTRAL_API_KEY")
-    client = Mistral(api_key=api_key)
+    def call():
+        return provider.complete(model_name, messages)
 
-    messages = [
-        {"role": "system", "content": "You are an airport navigation assistant. Use the provided navigation data to give clear, step-by-step directions."},
-        {"role": "user", "content": f"""
-            Using this navigation data:
+    def call_stream():
+        return provider.stream(model_name, messages)
 
-            {context}
+    if stream:
+        return get_response_cache().fetch_stream("mistral", model_name, prompt, call_stream,
+                                                 context=context, messages=messages)
+    return get_response_cache().fetch("mistral", model_name, prompt, call, context=context, messages=messages)
 
-            Please answer the following question:
-            {prompt}
+def get_ollama_response(prompt, context, model_name, stream=False):
+    provider = get_provider("ollama")
+    messages = navigation_messages(prompt, context)
+    # Keep the model resident and give it a context window that fits the whole prompt
+    manager = get_ollama_manager()
+    options = manager.chat_options(model_name, messages)
 
-            Provide step-by-step directions in a clear, concise format.
-        """}
-    ]
+    def call():
+        response = provider.complete(model_name, messages, **options)
+        manager.mark_used(model_name)
+        return response
 
-    chat_response = client.chat.complete(
-        model=model_name,
-        messages=messages
-    )
+    def call_stream():
+        yield from provider.stream(model_name, messages, **options)
+        manager.mark_used(model_name)
 
-    return chat_response.choices[0].message.content
+    if stream:
+        return get_response_cache().fetch_stream("ollama", model_name, prompt, call_stream,
+                                                 context=context, messages=messages)
+    return get_response_cache().fetch("ollama", model_name, prompt, call, context=context, messages=messages)
 
-def get_ollama_response(prompt, context, model_name):
-    full_prompt = f"""You are an airport navigation assistant. Use the provided navigation data to give clear, step-by-step directions.
+# Function to answer a question: point-to-point questions come from the route
+# graph and the LLM only rephrases the computed route, or answers over the top-k
+# retrieved nav.txt sections (or the compact route table) when no path is known.
+# With fallback=(model, model_name) the answer is hedged across both backends;
+# pass a Hedge to read back which one won. With a conversation turn (see conversation.py)
+# the sections sent in recent turns are left out and the history goes in instead.
+# Returns (response, hits).
+def get_directions(user_input, model, model_name=None, top_k=4, rephrase=False, stream=False, compact=False,
+                   use_store=True, fallback=None, hedge=None, turn=None):
+    graph = initialize_nav_graph(nav_fingerprint())
+    with stage("route"):
+        routed = graph.answer(user_input)
+    hits = []
+    if routed:
+        start, end, hops = routed
+        route_text = format_route(hops)
+        if not rephrase:
+            response = f"From {start} to {end}:\n\n{route_text}"
+            return (iter([response]) if stream else response), hits
 
-    Using this navigation data:
+    backend = {"OpenAI GPT": "openai", "Ollama": "ollama"}.get(model, "mistral")
+    if use_store:
+        # Precomputed answers are served before any context is built or model called
+        with stage("answer_store"):
+            stored = initialize_answer_store(file_fingerprint(ANSWER_FILE)).get(
+                backend_label(backend, None if backend == "openai" else model_name), user_input)
+        if stored is not None:
+            return (iter([stored]) if stream else stored), hits
 
-    {context}
+    with stage("context"):
+        if routed:
+            context = f"Computed route from {start} to {end}:\n{route_text}"
+        elif compact:
+            # Only routes touching the locations named in the question, or the whole table.
+            # compact="all" always sends the whole table: the prompt is then identical up to
+            # the question, so providers serve all but the question from their prompt cache
+            locations = graph.find_locations(user_input) if compact != "all" else None
+            context = initialize_compact_nav(nav_fingerprint()).render(locations or None)
+        else:
+            hits = initialize_retrieval(index_fingerprint()).search(user_input, k=top_k, kind="nav")
+            if turn is not None:
+                hits = new_hits(hits, turn)
+            context = format_hits(hits)
+        if turn is not None:
+            context = with_history(context, turn)
 
-    Please answer the following question:
-    {prompt}
+    if fallback is None:
+        return get_model_response(model, user_input, context, model_name, stream=stream), hits
 
-    Provide step-by-step directions in a clear, concise format.
-    """
-    
-    response = ollama.chat(
-        model=model_name,
-        messages=[{'role': 'user', 'content': full_prompt}]
-    )
-    return response['message']['content']
+    # Hedged: the primary streams first and the fallback joins if no token arrives in time
+    hedge = hedge or Hedge()
+    for label, name in ((model, model_name), fallback):
+        hedge.add(label, lambda label=label, name=name: get_model_response(label, user_input, context, name,
+                                                                          stream=True))
+    chunks = hedge.stream()
+    return (chunks if stream else "".join(chunks)), hits
+
+# Function to ask one backend for an answer over the given context
+def get_model_response(model, user_input, context, model_name=None, stream=False):
+    if model == "OpenAI GPT":
+        return get_openai_response(user_input, context, stream=stream)
+    elif model == "Ollama":
+        return get_ollama_response(user_input, context, model_name, stream=stream)
+    else:  # Mistral AI
+        return get_mistral_response(user_input, context, model_name, stream=stream)
 
 # Streamlit app
 def main():
     st.title("Airport Navigation Assistant")
-
-    # Load navigation data
-    nav_context = load_navigation_data()
+    mark("first_paint")
 
     # Model selection
     model = st.radio("Select Model", ("OpenAI GPT", "Ollama", "Mistral AI"))
+    # Only the selected backend's SDK is imported, in the background while the page renders
+    warm_up([{"OpenAI GPT": "openai", "Ollama": "ollama"}.get(model, "mistral")])
 
     # User input
     user_input = st.text_input("Where would you like to go in the airport?")
@@ -103,33 +211,107 @@ def main():
     ollama_model = None
     mistral_model = "mistral-medium"
 
+    # The manager (and its model preloads and status checks) only matters when Ollama is in use
+    manager = None
+    if model == "Ollama" or OLLAMA_PRELOAD:
+        manager = initialize_ollama_manager(index_fingerprint())
     if model == "Ollama":
         ollama_model = st.selectbox("Select Ollama Model", ["llama2", "mistral", "neural-chat"])
+        # Warm the selected model while the user types
+        manager.preload([ollama_model])
+    if model == "Ollama" or OLLAMA_PRELOAD:
+        with st.sidebar.expander("Ollama models"):
+            for name, entry in manager.refresh(max_age=OLLAMA_REFRESH_SECONDS).items():
+                st.write(format_status(name, entry))
+
+    rephrase = st.checkbox("Rephrase computed routes with the selected model", value=False)
+    top_k = st.sidebar.slider("Retrieved navigation sections (k)", 1, MAX_TOP_K, 4)
+    context_modes = {"Retrieved sections": False, "Compact route table": True, "Whole route table (cached prefix)": "all"}
+    compact = context_modes[st.sidebar.radio("Navigation context", tuple(context_modes))]
+    show_metrics = st.sidebar.checkbox("Show request metrics", value=False)
+
+    # Follow-up questions carry over the locations and history of this session's earlier turns
+    conversation = get_conversation(st.session_state)
+    remember = st.sidebar.checkbox("Remember the conversation", value=True)
+    if st.sidebar.button("New conversation"):
+        conversation.reset()
+
+    # Hedging: ask a second backend too when the first is slow to start answering
+    fallback = hedge = None
+    if st.sidebar.checkbox("Hedge with a second backend", value=False):
+        others = [name for name in ("Ollama", "OpenAI GPT", "Mistral AI") if name != model]
+        fallback_model = st.sidebar.selectbox("Second backend", others)
+        hedge_delay = st.sidebar.slider("Seconds before asking it", 0.5, 10.0, HEDGE_DELAY, 0.5)
+        fallback_name = {"Ollama": ollama_model or "llama2", "Mistral AI": mistral_model}.get(fallback_model)
+        if fallback_model == "Ollama":
+            initialize_ollama_manager(index_fingerprint()).preload([fallback_name])
+        fallback = (fallback_model, fallback_name)
 
     if user_input:
-        if model == "OpenAI GPT":
-            response = get_openai_response(user_input, nav_context)
-        elif model == "Ollama":
-            response = get_ollama_response(user_input, nav_context, ollama_model)
-        else:  # Mistral AI
-            response = get_mistral_response(user_input, nav_context, mistral_model)
-        
-        st.write("Directions:", response)
+        model_name = ollama_model if model == "Ollama" else mistral_model
+        if fallback:
+            hedge = Hedge(delay=hedge_delay)
+        turn = conversation.prepare(user_input) if remember else None
+        if turn and turn["follow_up"]:
+            st.caption(f"Follow-up, read as: {turn['standalone']}")
+        # The trace stays open until the stream is drained, so provider time includes generation
+        with traced("main", model=model) as trace:
+            chunks, hits = get_directions(turn["standalone"] if turn else user_input, model, model_name, top_k=top_k,
+                                          rephrase=rephrase, stream=True, compact=compact, fallback=fallback,
+                                          hedge=hedge, turn=turn)
+            if hits:
+                context = format_hits(hits)
+                with st.expander("Retrieved context"):
+                    st.write(f"~{estimate_tokens(context)} of ~{initialize_retrieval(index_fingerprint()).total_tokens('nav')} navigation tokens")
+                    for hit in hits:
+                        st.write(f"{hit['score']:.3f} — {hit['title']}")
+
+            # Render tokens as they arrive
+            st.write("Directions:")
+            stream_stats = {}
+            answer = st.write_stream(timed_stream(chunks, stream_stats))
+            if turn:
+                conversation.record(turn, answer, [hit_key(hit) for hit in hits])
+            if hedge and hedge.winner:
+                trace.labels["hedge_winner"] = hedge.winner
+        st.caption(format_stream_stats(stream_stats))
+        if hedge and hedge.results:
+            st.caption(f"Hedged request: {hedge.describe()}")
+        if show_metrics:
+            with st.sidebar.expander("Request metrics", expanded=True):
+                for line in breakdown_lines(trace):
+                    st.write(line)
         
+        stats = get_response_cache().stats
+        st.sidebar.write(f"Response cache: {stats['hits']} hits / {stats['misses']} misses")
+        store = initialize_answer_store(file_fingerprint(ANSWER_FILE))
+        if len(store):
+            st.sidebar.write(f"Answer store: {len(store)} answers, {store.stats['hits']} served")
+        if turn:
+            held = memory.stats()
+            st.sidebar.write(f"Conversation: turn {turn['number']}, ~{conversation.tokens()} history tokens · "
+                             f"{held['sessions']} sessions hold {held['bytes'] // 1024} of {held['limit'] // 1024} KB")
+
         # Display the chosen model
         if model == "Ollama":
             st.write(f"Using Ollama model: {ollama_model}")
         elif model == "Mistral AI":
             st.write(f"Using Mistral model: {mistral_model}")
 
-    # Display navigation data sections
+    # Display navigation data sections, one at a time and only on request
     st.subheader("Available Navigation Routes")
-    sections = nav_context.split("##")
-    for section in sections[1:]:  # Skip the first empty section
-        section_title = section.split("\n")[0].strip()
-        st.write(f"**{section_title}**")
-        with st.expander("Show routes"):
-            st.write(section)
+    if st.toggle("Browse navigation routes"):
+        sections = initialize_navigation_sections(nav_fingerprint())
+        titles = [title for title, _ in sections]
+        choice = st.selectbox("Section", range(len(titles)), format_func=lambda i: titles[i])
+        st.write(sections[choice][1])
+
+    # With STARTUP_PROFILE=1, show what this process spent on imports before the page appeared
+    report = first_render("main")
+    if report:
+        with st.sidebar.expander("Startup profile"):
+            for line in report_lines(report):
+                st.write(line)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,344 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger("metrics")
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+# Per-request JSON lines, off unless a path is given, e.g. METRICS_LOG=.cache/metrics.jsonl.
+# The file is rotated to <path>.1 once it reaches METRICS_LOG_MAX_BYTES.
+METRICS_LOG = os.getenv("METRICS_LOG", "")
+METRICS_LOG_MAX_BYTES = int(os.getenv("METRICS_LOG_MAX_BYTES", 10 * 1024 * 1024))
+# Prometheus text file for a node-exporter textfile collector, rewritten at most every
+# METRICS_PROM_INTERVAL seconds while there is something new to write
+METRICS_PROM_FILE = os.getenv("METRICS_PROM_FILE", os.path.join(".cache", "metrics.prom"))
+METRICS_PROM_INTERVAL = float(os.getenv("METRICS_PROM_INTERVAL", 15))
+WINDOW = int(os.getenv("METRICS_WINDOW", 500))
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+# Function to count the image bytes carried as data URLs or base64 strings in chat messages
+def message_image_bytes(messages):
+    total = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            for part in content:
+                if part.get("type") == "image_url":
+                    url = part["image_url"]["url"] if isinstance(part["image_url"], dict) else part["image_url"]
+                    total += len(url.split(",", 1)[-1]) * 3 // 4
+        for image in message.get("images") or []:
+            total += len(image) * 3 // 4
+    return total
+
+
+# Everything one request did: stages, provider calls, cache lookups and image work
+class Trace:
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.started = time.perf_counter()
+        self.wall = None
+        self.stages = {}
+        self.calls = []
+        self.cache = {"hits": 0, "misses": 0}
+        self.images_encoded_bytes = 0
+        self.lock = threading.Lock()
+
+    def add_stage(self, name, seconds, status="ok"):
+        with self.lock:
+            self.stages[name] = {"seconds": seconds, "status": status}
+
+    def add_call(self, call):
+        with self.lock:
+            self.calls.append(call)
+
+    # Time spent waiting on providers, counting overlapping calls once
+    def provider_seconds(self):
+        intervals = sorted((c["begin"], c["end"]) for c in self.calls if c.get("end") is not None)
+        total, reach = 0.0, None
+        for begin, end in intervals:
+            if reach is None or begin > reach:
+                total += end - begin
+                reach = end
+            elif end > reach:
+                total += end - reach
+                reach = end
+        return total
+
+    def summary(self):
+        wall = self.wall if self.wall is not None else time.perf_counter() - self.started
+        provider = self.provider_seconds()
+        return {
+            "request": self.name,
+            **self.labels,
+            "wall_seconds": round(wall, 4),
+            "provider_seconds": round(provider, 4),
+            "local_seconds": round(max(0.0, wall - provider), 4),
+            "stages": {name: round(stage["seconds"], 4) for name, stage in self.stages.items()},
+            "calls": [{k: (round(v, 4) if isinstance(v, float) else v) for k, v in call.items()
+                       if k not in ("begin", "end")} for call in self.calls],
+            "prompt_tokens": sum(c.get("prompt_tokens") or 0 for c in self.calls),
+            "completion_tokens": sum(c.get("completion_tokens") or 0 for c in self.calls),
+            "cached_tokens": sum(c.get("cached_tokens") or 0 for c in self.calls),
+            "image_bytes_sent": sum(c.get("image_bytes", 0) for c in self.calls),
+            "image_bytes_encoded": self.images_encoded_bytes,
+            "cache_hits": self.cache["hits"],
+            "cache_misses": self.cache["misses"],
+        }
+
+    def finish(self):
+        if self.wall is None:
+            self.wall = time.perf_counter() - self.started
+            registry.observe(self)
+        return self.summary()
+
+
+def current_trace():
+    return _current.get()
+
+
+# Function to make a trace current for the block; a trace it creates is finished and emitted on exit.
+# Pass trace= to continue a request in a worker thread, which does not inherit context variables.
+@contextmanager
+def traced(name=None, trace=None, **labels):
+    owner = trace is None
+    if owner:
+        trace = Trace(name, **labels)
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+        if owner:
+            trace.finish()
+
+
+@contextmanager
+def stage(name):
+    trace = _current.get()
+    begin = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except Exception as error:
+        status = f"error: {error}"
+        raise
+    finally:
+        if trace is not None:
+            trace.add_stage(name, time.perf_counter() - begin, status)
+
+
+def record_stage(name, seconds, status="ok"):
+    trace = _current.get()
+    if trace is not None:
+        trace.add_stage(name, seconds, status)
+
+
+def record_cache(hit):
+    trace = _current.get()
+    if trace is not None:
+        with trace.lock:
+            trace.cache["hits" if hit else "misses"] += 1
+    registry.count("cache_hits_total" if hit else "cache_misses_total")
+
+
+def record_image_encoded(size):
+    trace = _current.get()
+    if trace is not None:
+        with trace.lock:
+            trace.images_encoded_bytes += size
+    registry.count("image_bytes_encoded_total", size)
+
+
+# Function to start timing one provider call; the provider fills in usage and calls end_call
+def begin_call(provider, model, messages, stream=False):
+    return {"provider": provider, "model": model, "stream": stream, "begin": time.perf_counter(), "end": None,
+            "ttft": None, "prompt_tokens": None, "completion_tokens": None, "cached_tokens": None,
+            "image_bytes": message_image_bytes(messages), "trace": _current.get()}
+
+
+def end_call(call, error=None):
+    call["end"] = time.perf_counter()
+    call["seconds"] = call["end"] - call["begin"]
+    if error is not None:
+        call["error"] = type(error).__name__
+    trace = call.pop("trace")
+    if trace is not None:
+        trace.add_call(call)
+    registry.observe_call(call)
+
+
+# Process-wide aggregates behind the Prometheus file and the sidebar percentiles
+class Registry:
+    def __init__(self, window=WINDOW):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.windows = {}
+        self.window = window
+        self._dirty = threading.Event()
+        self._writer = None
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def sample(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.windows.setdefault(key, deque(maxlen=self.window)).append(value)
+
+    def samples(self, name, **labels):
+        with self.lock:
+            return list(self.windows.get((name, tuple(sorted(labels.items()))), ()))
+
+    def observe_call(self, call):
+        labels = {"provider": call["provider"], "model": call["model"]}
+        self.count("provider_calls_total", **labels)
+        if "error" in call:
+            self.count("provider_errors_total", **labels)
+        self.sample("provider_call_seconds", call["seconds"], **labels)
+        if call.get("ttft") is not None:
+            self.sample("provider_ttft_seconds", call["ttft"], **labels)
+        for kind in ("prompt", "completion", "cached"):
+            if call.get(f"{kind}_tokens"):
+                self.count("tokens_total", call[f"{kind}_tokens"], kind=kind, **labels)
+        if call.get("prompt_seconds") is not None:
+            self.sample("provider_prompt_seconds", call["prompt_seconds"], **labels)
+        self.count("image_bytes_sent_total", call["image_bytes"], **labels)
+
+    def observe(self, trace):
+        if not METRICS_ENABLED:
+            return
+        summary = trace.summary()
+        self.count("requests_total", request=trace.name)
+        for field in ("wall_seconds", "provider_seconds", "local_seconds"):
+            self.sample(f"request_{field}", summary[field], request=trace.name)
+        for name, seconds in summary["stages"].items():
+            self.sample("stage_seconds", seconds, request=trace.name, stage=name)
+        line = json.dumps(summary)
+        logger.info(line)
+        if METRICS_LOG:
+            try:
+                append_log(METRICS_LOG, line)
+            except OSError as error:
+                logger.warning("Could not write metrics: %s", error)
+        if METRICS_PROM_FILE:
+            self.schedule_prometheus(METRICS_PROM_FILE)
+
+    # Function to have the Prometheus file rewritten by a background thread, at most once per
+    # interval and only after new observations, rather than on every request
+    def schedule_prometheus(self, path, interval=METRICS_PROM_INTERVAL):
+        self._dirty.set()
+        with self.lock:
+            if self._writer is not None:
+                return
+            self._writer = threading.Thread(target=self._write_loop, args=(path, interval),
+                                            name="metrics-writer", daemon=True)
+            self._writer.start()
+
+    def _write_loop(self, path, interval):
+        while True:
+            self._dirty.wait()
+            self._dirty.clear()
+            try:
+                self.write_prometheus(path)
+            except OSError as error:
+                logger.warning("Could not write metrics: %s", error)
+            time.sleep(interval)
+
+    # Function to render counters and rolling quantiles in the Prometheus text format
+    def prometheus(self):
+        def labelled(name, labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return name
+            return name + "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            windows = sorted((key, list(values)) for key, values in self.windows.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE assistant_{name} counter")
+                typed.add(name)
+            lines.append(f"{labelled('assistant_' + name, labels)} {value}")
+        for (name, labels), values in windows:
+            if name not in typed:
+                lines.append(f"# TYPE assistant_{name} summary")
+                typed.add(name)
+            for quantile in (50, 95, 99):
+                value = percentile(values, quantile)
+                lines.append(f"{labelled('assistant_' + name, labels, [('quantile', quantile / 100)])} {value:.6f}")
+            lines.append(f"{labelled('assistant_' + name + '_sum', labels)} {sum(values):.6f}")
+            lines.append(f"{labelled('assistant_' + name + '_count', labels)} {len(values)}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+
+registry = Registry()
+
+
+# Function to append a line to a log file, first moving a full file aside to <path>.1
+def append_log(path, line, max_bytes=METRICS_LOG_MAX_BYTES):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    try:
+        if os.path.getsize(path) >= max_bytes:
+            os.replace(path, path + ".1")
+    except FileNotFoundError:
+        pass
+    with open(path, "a") as f:
+        f.write(line + "\n")
+
+
+# Function to describe one request and the rolling percentiles of its kind, one line per row
+def breakdown_lines(trace):
+    summary = trace.summary()
+    lines = [
+        f"Wall {summary['wall_seconds']:.2f}s = provider {summary['provider_seconds']:.2f}s"
+        f" + local {summary['local_seconds']:.2f}s",
+    ]
+    for name, seconds in summary["stages"].items():
+        lines.append(f"Stage {name}: {seconds:.2f}s")
+    for call in summary["calls"]:
+        ttft = f", first token {call['ttft']:.2f}s" if call.get("ttft") is not None else ""
+        tokens = f", {call['prompt_tokens']} → {call['completion_tokens']} tokens" if call.get("prompt_tokens") else ""
+        if call.get("cached_tokens"):
+            tokens += f" ({call['cached_tokens']} cached)"
+        if call.get("prompt_seconds") is not None:
+            tokens += f", prompt {call['prompt_seconds']:.2f}s"
+        lines.append(f"{call['provider']}/{call['model']}: {call['seconds']:.2f}s{ttft}{tokens}, "
+                     f"{call['image_bytes'] // 1024} KB images")
+    if summary["cached_tokens"]:
+        lines.append(f"Prompt cache: {summary['cached_tokens']} of {summary['prompt_tokens']} prompt tokens "
+                     f"({summary['cached_tokens'] / summary['prompt_tokens']:.0%})")
+    lines.append(f"Cache: {summary['cache_hits']} hits / {summary['cache_misses']} misses · "
+                 f"images encoded {summary['image_bytes_encoded'] // 1024} KB")
+    walls = registry.samples("request_wall_seconds", request=trace.name)
+    if walls:
+        lines.append(f"Last {len(walls)} requests: p50 {percentile(walls, 50):.2f}s · "
+                     f"p95 {percentile(walls, 95):.2f}s · p99 {percentile(walls, 99):.2f}s")
+    return lines
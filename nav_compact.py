@@ -0,0 +1,116 @@
+import argparse
+import re
+
+from nav_graph import NavGraph, normalize_name, parse_navigation
+from retrieval import count_tokens
+
+# Sections without routes that still carry rules the model must follow
+NOTE_SECTIONS = re.compile(r"notes", re.I)
+
+FORMAT_HEADER = (
+    "Airport route table. Locations are L<n>, shared walking steps are S<n>.\n"
+    "Each route line is FROM>TO:step,step,... using step numbers; expand the steps in order.\n"
+    "In steps, @A stands for the route's start location and @B for its destination."
+)
+
+
+# Function to collect the unique rule lines from the "... Notes" sections
+def extract_notes(text):
+    notes = []
+    seen = set()
+    in_notes = False
+    for line in text.lstrip("﻿").splitlines():
+        if line.startswith("#"):
+            in_notes = bool(NOTE_SECTIONS.search(line))
+            continue
+        line = line.strip()
+        if in_notes and line.startswith(("-", "*")):
+            note = line.lstrip("-* ").strip()
+            if note.lower() not in seen:
+                seen.add(note.lower())
+                notes.append(note)
+    return notes
+
+
+class CompactNav:
+    def __init__(self, graph, notes=()):
+        self.location_ids = {key: f"L{i}" for i, key in enumerate(sorted(graph.names), 1)}
+        self.locations = {self.location_ids[key]: graph.names[key] for key in sorted(graph.names)}
+        self.step_ids = {}  # normalized step text -> step number
+        self.steps = []     # step number - 1 -> step text (first spelling seen)
+        self.routes = []    # (from id, to id, [step numbers])
+        for (a, b), steps in sorted(graph.edges.items()):
+            templated = [self._template(step, graph.names[a], graph.names[b]) for step in steps]
+            self.routes.append((self.location_ids[a], self.location_ids[b], [self._intern(step) for step in templated]))
+        self.notes = list(notes)
+
+    @staticmethod
+    def _template(step, start, end):
+        # "Exit Prayer Room" and "Exit Starbucks" both become "Exit @A"
+        for name, marker in ((start, "@A"), (end, "@B")):
+            step = re.sub(r"(?<!\w)" + re.escape(name) + r"(?!\w)", marker, step, flags=re.I)
+        return step
+
+    def _intern(self, step):
+        key = re.sub(r"\s+", " ", step.lower()).strip(" .")
+        if key not in self.step_ids:
+            self.steps.append(step)
+            self.step_ids[key] = len(self.steps)
+        return self.step_ids[key]
+
+    # Function to render the compact encoding, optionally limited to some location keys
+    def render(self, only=None):
+        routes = self.routes
+        if only is not None:
+            wanted = {self.location_ids[key] for key in only if key in self.location_ids}
+            routes = [r for r in routes if r[0] in wanted or r[1] in wanted]
+        used_locations = sorted({r[0] for r in routes} | {r[1] for r in routes}, key=lambda x: int(x[1:]))
+        used_steps = sorted({n for r in routes for n in r[2]})
+        lines = [FORMAT_HEADER, "", "LOCATIONS"]
+        lines += [f"{lid}={self.locations[lid]}" for lid in used_locations]
+        lines += ["", "STEPS"]
+        lines += [f"S{n}={self.steps[n - 1]}" for n in used_steps]
+        lines += ["", "ROUTES"]
+        lines += [f"{a}>{b}:" + ",".join(str(n) for n in steps) for a, b, steps in routes]
+        if self.notes:
+            lines += ["", "RULES"]
+            lines += [f"- {note}" for note in self.notes]
+        return "\n".join(lines)
+
+
+# Function to compile nav.txt into the compact encoding
+def compile_navigation(path="nav.txt"):
+    with open(path, "r") as f:
+        text = f.read()
+    return CompactNav(NavGraph(parse_navigation(text)), extract_notes(text))
+
+
+# Function to compare prompt tokens for the raw and compact navigation data
+def compression_report(path="nav.txt"):
+    with open(path, "r") as f:
+        raw = f.read()
+    compact = compile_navigation(path)
+    rendered = compact.render()
+    return {
+        "raw_tokens": count_tokens(raw),
+        "compact_tokens": count_tokens(rendered),
+        "locations": len(compact.locations),
+        "unique_steps": len(compact.steps),
+        "routes": len(compact.routes),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile nav.txt into a compact route table for prompts")
+    parser.add_argument("--nav", default="nav.txt")
+    parser.add_argument("--print", action="store_true", help="print the rendered encoding")
+    parser.add_argument("--only", nargs="*", help="limit routes to these location names")
+    args = parser.parse_args()
+
+    if args.print:
+        only = [normalize_name(name) for name in args.only] if args.only else None
+        print(compile_navigation(args.nav).render(only))
+    report = compression_report(args.nav)
+    saved = 100 * (1 - report["compact_tokens"] / report["raw_tokens"])
+    print(f"{report['raw_tokens']} tokens -> {report['compact_tokens']} tokens ({saved:.0f}% smaller); "
+          f"{report['locations']} locations, {report['unique_steps']} unique steps, {report['routes']} routes")
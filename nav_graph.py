@@ -0,0 +1,233 @@
+import heapq
+import re
+import threading
+
+from file_cache import file_fingerprint
+
+# Route headers look like "Starbucks → Gate 5:" or "- Gate 1 → Gate 5:"
+ROUTE_HEADER = re.compile(r"^\s*(?:-\s+)?(?P<start>[^→*]+?)\s*→\s*(?P<end>[^→]+?)\s*:\s*$")
+# Steps are written as "- step", "  * step" or "1. step"
+ROUTE_STEP = re.compile(r"^\s*(?:[-*]|\d+\.)\s+(?P<step>.+?)\s*$")
+# Steps that pass a controlled point cannot be walked backwards (see "One-Way Only Routes")
+ONE_WAY_STEP = re.compile(r"security|immigration|screening|passport|e-gate|check-in|boarding", re.I)
+# Walking a listed route backwards costs more than following one written for that direction
+REVERSE_PENALTY = 2
+# Steps whose wording only holds in the listed direction: turns, sides, "ahead", "follow ... signs"
+DIRECTIONAL_STEP = re.compile(r"\b(left|right|ahead|straight|turn\w*|follow\w*|from|towards?)\b", re.I)
+# Entering and leaving swap when a route is walked backwards
+LEAVE_STEP = re.compile(r"^(?:exit|leave)\s+(?P<place>.+)$", re.I)
+ENTER_STEP = re.compile(r"^enter\s+(?P<place>.+)$", re.I)
+ARTICLES = {"the", "a", "an"}
+
+
+# Function to normalize a location name into a lookup key
+def normalize_name(name):
+    name = name.lower().replace("’", "'")
+    name = re.sub(r"[()]", " ", name)
+    name = re.sub(r"[^a-z0-9&'\- ]", " ", name)
+    return re.sub(r"\s+", " ", name).strip()
+
+
+def is_placeholder(name):
+    # "Taxi Stand → ALL Destinations:" only introduces the routes below it
+    return normalize_name(name).startswith("all ")
+
+
+# Function to parse nav.txt into (section, start, end, steps) tuples
+def parse_navigation(text):
+    routes = []
+    section = ""
+    current = None
+    for line in text.splitlines():
+        line = line.lstrip("﻿")
+        if line.startswith("#"):
+            section = line.strip("# :").strip()
+            current = None
+            continue
+        header = ROUTE_HEADER.match(line)
+        if header:
+            current = (section, header.group("start"), header.group("end"), [])
+            routes.append(current)
+            continue
+        step = ROUTE_STEP.match(line)
+        if step and current is not None:
+            current[3].append(step.group("step"))
+        elif line.strip() and not step:
+            # Free text (numbered notes, chat remarks) ends the current route
+            current = None
+    return [r for r in routes if r[3] and not is_placeholder(r[1]) and not is_placeholder(r[2])]
+
+
+class NavGraph:
+    def __init__(self, routes):
+        self.names = {}   # key -> display name (first spelling seen)
+        self.edges = {}   # (start_key, end_key) -> list of steps
+        self.reverse = {}  # (start_key, end_key) -> steps of the listed (end, start) route
+        self.adjacency = {}
+        for _, start, end, steps in routes:
+            a, b = normalize_name(start), normalize_name(end)
+            if not a or not b or a == b:
+                continue
+            self.names.setdefault(a, start.strip())
+            self.names.setdefault(b, end.strip())
+            # nav.txt repeats some routes; keep the shortest step list
+            if (a, b) not in self.edges or len(steps) < len(self.edges[(a, b)]):
+                self.edges[(a, b)] = list(steps)
+        # Routes nav.txt only lists one way can be retraced unless they cross a one-way point
+        for (a, b), steps in list(self.edges.items()):
+            if (b, a) not in self.edges and not any(ONE_WAY_STEP.search(step) for step in steps):
+                self.reverse[(b, a)] = steps
+        for (a, b), steps in self.edges.items():
+            self.adjacency.setdefault(a, []).append((b, len(steps)))
+            self.adjacency.setdefault(b, [])
+        for (a, b), steps in self.reverse.items():
+            self.adjacency[a].append((b, len(steps) * REVERSE_PENALTY))
+        self._previous = {source: self._dijkstra(source) for source in self.names}
+        # Longest names first so "Gate 5" wins over "Gate" when scanning questions
+        self._patterns = [
+            (key, re.compile(r"(?<![a-z0-9])" + re.escape(key) + r"s?(?![a-z0-9])"))
+            for key in sorted(self.names, key=len, reverse=True)
+        ]
+
+    def _dijkstra(self, source):
+        distance = {source: 0}
+        previous = {}
+        queue = [(0, source)]
+        while queue:
+            cost, node = heapq.heappop(queue)
+            if cost > distance[node]:
+                continue
+            for neighbour, weight in self.adjacency.get(node, ()):
+                candidate = cost + weight
+                if candidate < distance.get(neighbour, float("inf")):
+                    distance[neighbour] = candidate
+                    previous[neighbour] = node
+                    heapq.heappush(queue, (candidate, neighbour))
+        return previous
+
+    def route(self, start, end):
+        a, b = normalize_name(start), normalize_name(end)
+        if a == b or a not in self._previous:
+            return None
+        previous = self._previous[a]
+        if b not in previous:
+            return None
+        path = [b]
+        while path[-1] != a:
+            path.append(previous[path[-1]])
+        path.reverse()
+        return [(self.names[x], self.names[y], self.steps(x, y)) for x, y in zip(path, path[1:])]
+
+    def steps(self, a, b):
+        if (a, b) in self.edges:
+            return self.edges[(a, b)]
+        return self.reversed_steps(a, b)
+
+    # Function to turn the listed route from b to a into steps from a to b. The steps run in
+    # reverse order, entering and leaving swap, and turns and sides are dropped since they
+    # flip when walked backwards; the first listed step, which leaves b, becomes the arrival.
+    def reversed_steps(self, a, b):
+        listed = self.reverse[(a, b)]
+        steps = [f"From {self.names[a]}, follow the signs for {self.names[b]} "
+                 f"(the listed route from {self.names[b]}, walked the other way)"]
+        for step in reversed(listed[1:-1]):
+            enter, leave = ENTER_STEP.match(step), LEAVE_STEP.match(step)
+            if enter:
+                steps.append(f"Leave {enter.group('place')}")
+            elif leave:
+                steps.append(f"Enter {leave.group('place')}")
+            elif not DIRECTIONAL_STEP.search(step):
+                steps.append(step)
+        leave = LEAVE_STEP.match(listed[0])
+        steps.append(f"Enter {leave.group('place')}" if leave else f"Arrive at {self.names[b]}")
+        return steps
+
+    # Function to return the known locations a question names as (start, end, key), in reading order
+    def _mentions(self, text):
+        taken = []
+        found = []
+        for key, pattern in self._patterns:
+            for match in pattern.finditer(text):
+                span = match.span()
+                if any(span[0] < end and start < span[1] for start, end in taken):
+                    continue
+                taken.append(span)
+                found.append((span[0], span[1], key))
+        found.sort()
+        return found
+
+    # Function to find known locations in a question, in reading order
+    def find_locations(self, question):
+        text = normalize_name(question)
+        found = self._mentions(text)
+        keys = [key for _, _, key in found]
+        # "How do I get to Gate 5 from Starbucks?" names the destination first
+        marker = text.find(" from ")
+        if len(found) >= 2 and marker != -1 and found[0][0] < marker < found[1][0]:
+            keys[0], keys[1] = keys[1], keys[0]
+        return keys
+
+    # Function to return the (start, end) keys of a point-to-point question: "from X to Y",
+    # "X to Y", "X → Y" or "get to Y from X". Questions that merely name two places ("a toilet
+    # between Starbucks and Gate 5", "a toilet near Gate 3") return None.
+    def endpoints(self, question):
+        text = normalize_name(question.replace("→", " to "))
+        found = self._mentions(text)
+        if len(found) < 2:
+            return None
+        (first_start, first_end, first), (second_start, _, second) = found[0], found[1]
+        gap = [word for word in text[first_end:second_start].split() if word not in ARTICLES]
+        before = [word for word in text[:first_start].split() if word not in ARTICLES]
+        if gap in (["to"], ["towards"]):
+            return first, second
+        if gap == ["from"] and before[-1:] == ["to"]:
+            return second, first
+        return None
+
+    # Function to answer a point-to-point question without calling an LLM
+    def answer(self, question):
+        keys = self.endpoints(question)
+        if keys is None:
+            return None
+        hops = self.route(*keys)
+        if not hops:
+            return None
+        return self.names[keys[0]], self.names[keys[1]], hops
+
+
+# Function to render a computed route as numbered directions
+def format_route(hops):
+    lines = []
+    if len(hops) > 1:
+        lines.append("Route: " + " → ".join([hops[0][0]] + [end for _, end, _ in hops]))
+        lines.append("")
+    number = 1
+    for start, end, steps in hops:
+        if len(hops) > 1:
+            lines.append(f"**{start} → {end}**")
+        for step in steps:
+            lines.append(f"{number}. {step}")
+            number += 1
+    return "\n".join(lines)
+
+
+# Function to build the route graph from nav.txt
+def load_nav_graph(path="nav.txt"):
+    with open(path, "r") as f:
+        return NavGraph(parse_navigation(f.read()))
+
+
+_graph = None
+_fingerprint = None
+_lock = threading.Lock()
+
+
+# Function to return the process-wide route graph, rebuilt when nav.txt changes
+def get_nav_graph(path="nav.txt"):
+    global _graph, _fingerprint
+    fingerprint = file_fingerprint(path)
+    with _lock:
+        if _graph is None or fingerprint != _fingerprint:
+            _graph = load_nav_graph(path)
+            _fingerprint = fingerprint
+        return _graph
@@ -0,0 +1,185 @@
+import argparse
+import os
+import threading
+import time
+
+from nav_compact import compile_navigation
+from providers import get_provider
+from retrieval import estimate_tokens
+
+# Models to load when the app starts, e.g. OLLAMA_PRELOAD=llama2,mistral on a kiosk
+OLLAMA_PRELOAD = [name.strip() for name in os.getenv("OLLAMA_PRELOAD", "").split(",") if name.strip()]
+# How long Ollama keeps an idle model in memory; -1 keeps it loaded until the server stops
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_MIN_CTX = int(os.getenv("OLLAMA_MIN_CTX", 4096))
+OLLAMA_MAX_CTX = int(os.getenv("OLLAMA_MAX_CTX", 32768))
+# Room left for the answer, and slack for the rough token estimate
+OLLAMA_RESPONSE_TOKENS = int(os.getenv("OLLAMA_RESPONSE_TOKENS", 1024))
+# Page reruns ask the server which models are loaded at most this often
+OLLAMA_REFRESH_SECONDS = float(os.getenv("OLLAMA_REFRESH_SECONDS", 15))
+CTX_STEP = 2048
+ESTIMATE_SLACK = 1.2
+
+
+# Function to size num_ctx for a prompt: estimate plus answer room, rounded up to a 2k step
+def context_length(prompt_tokens):
+    needed = int(prompt_tokens * ESTIMATE_SLACK) + OLLAMA_RESPONSE_TOKENS
+    needed = -(-needed // CTX_STEP) * CTX_STEP
+    return max(OLLAMA_MIN_CTX, min(OLLAMA_MAX_CTX, needed))
+
+
+def message_tokens(messages):
+    total = 0
+    for message in messages:
+        content = message["content"]
+        if not isinstance(content, str):
+            content = "\n".join(part["text"] for part in content if part["type"] == "text")
+        total += estimate_tokens(content)
+    return total
+
+
+# Keeps the chosen Ollama models loaded and sized for our prompts.
+# Ollama reloads a model whenever num_ctx changes, so each model's num_ctx only
+# grows: preload picks it from the largest prompt we expect and calls reuse it.
+class OllamaManager:
+    def __init__(self, keep_alive=OLLAMA_KEEP_ALIVE, num_ctx=OLLAMA_MIN_CTX):
+        self.keep_alive = keep_alive
+        self.num_ctx = num_ctx  # what new models are loaded with
+        self.lock = threading.Lock()
+        self.models = {}  # model -> {"state", "num_ctx", "load_seconds", "error", "expires_at"}
+        self.refreshed_at = None
+
+    @property
+    def provider(self):
+        return get_provider("ollama")
+
+    @property
+    def enabled(self):
+        # The offline fake provider (LLM_PROVIDER=fake) has nothing to load
+        return self.provider.name == "ollama"
+
+    def _entry(self, model):
+        return self.models.setdefault(model, {"state": "cold", "num_ctx": self.num_ctx, "load_seconds": None,
+                                              "error": None, "expires_at": None})
+
+    # Function to load a model with an empty prompt, which makes Ollama load it without generating
+    def _load(self, model, num_ctx):
+        started = time.perf_counter()
+        try:
+            self.provider.client.generate(model=model, prompt="", keep_alive=self.keep_alive,
+                                          options={"num_ctx": num_ctx})
+        except Exception as error:
+            with self.lock:
+                self.models[model].update(state="error", error=str(error))
+            return
+        with self.lock:
+            self.models[model].update(state="warm", error=None, load_seconds=time.perf_counter() - started)
+
+    # Function to size new loads for the largest prompt we expect to send
+    def size_for(self, prompt_tokens):
+        self.num_ctx = max(self.num_ctx, context_length(prompt_tokens))
+        return self.num_ctx
+
+    # Function to start loading models in the background; returns the loader threads
+    def preload(self, models):
+        if not self.enabled:
+            return []
+        threads = []
+        for model in models:
+            with self.lock:
+                entry = self._entry(model)
+                entry["num_ctx"] = max(entry["num_ctx"], self.num_ctx)
+                if entry["state"] in ("loading", "warm"):
+                    continue
+                entry["state"] = "loading"
+                size = entry["num_ctx"]
+            thread = threading.Thread(target=self._load, args=(model, size), daemon=True)
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    # Function to return the chat options for a call: keep-alive and a num_ctx that fits the prompt
+    def chat_options(self, model, messages):
+        needed = context_length(message_tokens(messages))
+        with self.lock:
+            entry = self._entry(model)
+            if needed > entry["num_ctx"]:
+                # A bigger prompt than the model was loaded for: this call reloads it
+                entry.update(num_ctx=needed, state="cold", error=None)
+            num_ctx = entry["num_ctx"]
+        return {"options": {"num_ctx": num_ctx}, "keep_alive": self.keep_alive}
+
+    # Function to mark a model warm after a successful call
+    def mark_used(self, model):
+        with self.lock:
+            self._entry(model).update(state="warm", error=None)
+
+    # Function to reconcile states with what the server has loaded (models expire after keep_alive);
+    # with max_age, a check made less than max_age seconds ago is reused
+    def refresh(self, max_age=None):
+        if not self.enabled:
+            return self.status()
+        now = time.monotonic()
+        if max_age is not None and self.refreshed_at is not None and now - self.refreshed_at < max_age:
+            return self.status()
+        self.refreshed_at = now
+        try:
+            loaded = {model.model: model for model in self.provider.client.ps().models}
+        except Exception as error:
+            with self.lock:
+                for entry in self.models.values():
+                    if entry["state"] != "loading":
+                        entry.update(state="error", error=str(error))
+            return self.status()
+        with self.lock:
+            for name, entry in self.models.items():
+                running = loaded.get(name) or loaded.get(f"{name}:latest")
+                if running is not None:
+                    entry.update(state="warm", error=None, expires_at=running.expires_at)
+                elif entry["state"] == "warm":
+                    entry.update(state="cold", expires_at=None)
+        return self.status()
+
+    def status(self):
+        with self.lock:
+            return {model: dict(entry) for model, entry in self.models.items()}
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+# Function to return the process-wide Ollama manager
+def get_ollama_manager():
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = OllamaManager()
+        return _manager
+
+
+# Function to describe one model's status in a line
+def format_status(model, entry):
+    line = f"{model}: {entry['state']}, num_ctx {entry['num_ctx']}"
+    if entry["load_seconds"] is not None:
+        line += f", loaded in {entry['load_seconds']:.1f}s"
+    if entry["expires_at"] is not None:
+        line += f", resident until {entry['expires_at']:%H:%M}"
+    if entry["error"]:
+        line += f" ({entry['error']})"
+    return line
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load Ollama models and keep them resident")
+    parser.add_argument("models", nargs="*", default=OLLAMA_PRELOAD or ["llama2"])
+    parser.add_argument("--nav", default="nav.txt", help="size num_ctx for the compact route table of this file")
+    args = parser.parse_args()
+
+    # The largest context the apps send is the whole compact table, not the raw file
+    manager = get_ollama_manager()
+    manager.size_for(estimate_tokens(compile_navigation(args.nav).render()))
+    for thread in manager.preload(args.models):
+        thread.join()
+    for model, entry in manager.refresh().items():
+        print(format_status(model, entry))
@@ -0,0 +1,199 @@
+import argparse
+import hashlib
+import importlib
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+PAGE_DIR = os.path.join(".cache", "pdf_pages")
+# Pages with fewer extracted characters than this are treated as scans and captioned from a render
+PDF_MIN_TEXT_CHARS = int(os.getenv("PDF_MIN_TEXT_CHARS", 200))
+# Share of a text layer's tokens that must read as words. Maps extract as label soup such as
+# "B18B16B14B12" or "ToiletsAirport InformationMedical", which is better captioned from a render.
+PDF_MIN_WORD_RATIO = float(os.getenv("PDF_MIN_WORD_RATIO", 0.75))
+PDF_RENDER_SCALE = float(os.getenv("PDF_RENDER_SCALE", 2.0))
+# Model and prompt version recorded for pages stored straight from their text layer
+TEXT_LAYER = "text-layer"
+
+# A word: a run of letters in one case (optionally capitalized) containing a vowel, allowing
+# hyphenated and possessive words and surrounding punctuation
+WORD_PATTERN = re.compile(r"^[(\"'‘“]*(?=[^\s]*[aeiouyAEIOUY])([A-Z]?[a-z]+|[A-Z]+)(?:['’-][A-Za-z]+)*[)\"'’”.,:;!?&-]*$")
+
+# pdfium is not thread-safe; renders are serialized, captioning calls are not
+_render_lock = threading.Lock()
+_pdf_modules = {}
+
+
+# Function to import pypdf or pypdfium2 on first use, which keeps them out of the apps' startup.
+# Returns None when it is not installed: PDFs are skipped without pypdf, and pages without a
+# text layer are skipped without pypdfium2.
+def pdf_module(name):
+    if name not in _pdf_modules:
+        try:
+            _pdf_modules[name] = importlib.import_module(name)
+        except ImportError:
+            _pdf_modules[name] = None
+    return _pdf_modules[name]
+
+
+def list_pdfs(folder):
+    return sorted(
+        os.path.join(folder, filename)
+        for filename in os.listdir(folder)
+        if filename.lower().endswith(".pdf")
+    )
+
+
+# Key a page's entry in captions.json, e.g. "Concourse_A_Guide.pdf#page2"
+def page_key(pdf_path, page_number):
+    return f"{os.path.basename(pdf_path)}#page{page_number}"
+
+
+# Function to hash what a page draws: its content stream plus the images it places
+def page_digest(page):
+    digest = hashlib.sha256()
+    contents = page.get_contents()
+    if contents is not None:
+        digest.update(contents.get_data())
+    digest.update(repr([float(v) for v in page.mediabox]).encode("utf-8"))
+    xobjects = (page.get("/Resources") or {}).get("/XObject") or {}
+    for name in sorted(xobjects):
+        digest.update(name.encode("utf-8"))
+        digest.update(xobjects[name].get_object().get_data())
+    return digest.hexdigest()
+
+
+# Function to return the share of a text's whitespace-separated tokens that are words
+def text_quality(text):
+    tokens = text.split()
+    if not tokens:
+        return 0.0
+    return sum(1 for token in tokens if WORD_PATTERN.match(token)) / len(tokens)
+
+
+# Function to decide whether a page's text layer can stand in for a caption
+def usable_text(text):
+    return len(text.strip()) >= PDF_MIN_TEXT_CHARS and text_quality(text) >= PDF_MIN_WORD_RATIO
+
+
+# Function to tidy a page's text layer into caption-style markdown
+def format_page_text(pdf_path, page_number, text):
+    lines = [re.sub(r"\s+", " ", line).strip() for line in text.splitlines()]
+    lines = [line for line in lines if len(line) > 1]
+    return f"### {os.path.basename(pdf_path)}, page {page_number}\n" + "\n".join(f"- {line}" for line in lines)
+
+
+# Function to render one page to a PNG under .cache/pdf_pages, named by page hash
+def render_page(pdf_path, page_index, digest, page_dir=PAGE_DIR):
+    path = os.path.join(page_dir, f"{digest}.png")
+    if os.path.exists(path):
+        return path
+    os.makedirs(page_dir, exist_ok=True)
+    with _render_lock:
+        document = pdf_module("pypdfium2").PdfDocument(pdf_path)
+        try:
+            image = document[page_index].render(scale=PDF_RENDER_SCALE).to_pil()
+        finally:
+            document.close()
+    tmp_path = path + ".tmp"
+    image.save(tmp_path, format="PNG")
+    os.replace(tmp_path, path)
+    return path
+
+
+# Function to split a PDF into pages whose text layer reads as text and pages that need the vision captioner
+def read_pdf(pdf_path):
+    reader = pdf_module("pypdf").PdfReader(pdf_path)
+    pages = []
+    for index, page in enumerate(reader.pages):
+        text = page.extract_text() or ""
+        pages.append({
+            "key": page_key(pdf_path, index + 1),
+            "index": index,
+            "digest": page_digest(page),
+            "text": format_page_text(pdf_path, index + 1, text) if usable_text(text) else None,
+        })
+    return pages
+
+
+# Function to map each page's captions.json key to its content hash
+def page_hashes(pdf_path):
+    pypdf = pdf_module("pypdf")
+    if pypdf is None:
+        return {}
+    reader = pypdf.PdfReader(pdf_path)
+    return {page_key(pdf_path, index + 1): page_digest(page) for index, page in enumerate(reader.pages)}
+
+
+# Function to add every PDF page to captions.json: the text layer when there is one,
+# otherwise a caption of the rendered page. Pages run in parallel and each is stored as it
+# finishes, keyed by page content, so an unchanged page is never captioned twice.
+def ingest_pdfs(pdf_paths, generate, concurrency=4, max_retries=5, force=False, caption_file="captions.json",
+                model=None, prompt=None):
+    import update_captions
+    from caption_store import get_caption_store, prompt_version
+    store = get_caption_store()
+    store.sync(caption_file)
+    if pdf_module("pypdf") is None:
+        print("pypdf is not installed; skipping PDFs")
+        return store.view(caption_file), {}
+    model = model or update_captions.CAPTION_MODEL
+    version = prompt_version(prompt or update_captions.CAPTION_PROMPT)
+    gate = update_captions.RateLimitGate()
+    failures = {}
+
+    def process(pdf_path, page):
+        if page["text"] is not None:
+            return page["text"]
+        if pdf_module("pypdfium2") is None:
+            raise RuntimeError("page has no text layer and pypdfium2 is not installed")
+        image_path = render_page(pdf_path, page["index"], page["digest"])
+        return update_captions.generate_with_retry(generate, image_path, gate, max_retries)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {}
+        for pdf_path in pdf_paths:
+            for page in read_pdf(pdf_path):
+                if not force and store.get(page["digest"]) is not None:
+                    store.link(caption_file, page["key"], page["digest"])
+                    continue
+                futures[executor.submit(process, pdf_path, page)] = page
+        for future in as_completed(futures):
+            page = futures[future]
+            try:
+                caption = future.result()
+            except Exception as error:
+                failures[page["key"]] = str(error)
+                print(f"Failed to ingest {page['key']}: {error}")
+                continue
+            if page["text"] is not None:
+                store.put(caption_file, page["key"], page["digest"], caption, TEXT_LAYER, TEXT_LAYER)
+            else:
+                store.put(caption_file, page["key"], page["digest"], caption, model, version)
+            store.export(caption_file)
+            print(f"Ingested {page['key']} ({'text layer' if page['text'] is not None else 'captioned render'})")
+    return store.export(caption_file), failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add PDF guides to captions.json")
+    parser.add_argument("--folder", default="files")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--force", action="store_true", help="re-ingest pages that already have a caption")
+    parser.add_argument("--dry-run", action="store_true", help="list which pages need a vision call")
+    args = parser.parse_args()
+
+    pdfs = list_pdfs(args.folder)
+    if pdf_module("pypdf") is None:
+        raise SystemExit("pypdf is not installed: pip install pypdf pypdfium2")
+    if args.dry_run:
+        for pdf in pdfs:
+            for entry in read_pdf(pdf):
+                print(f"{entry['key']}: {'text layer' if entry['text'] is not None else 'needs captioning'}")
+    else:
+        import update_captions
+        _, failed = ingest_pdfs(pdfs, update_captions.generate_captions, concurrency=args.concurrency,
+                                force=args.force)
+        if failed:
+            raise SystemExit(f"{len(failed)} page(s) failed: {', '.join(failed)}")
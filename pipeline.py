@@ -0,0 +1,71 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import record_stage
+from providers import LLM_TIMEOUT
+
+# A stage gives up a little after its provider call would, so the provider's own timeout
+# normally ends a slow call and the stage deadline only catches what hangs past it
+STAGE_TIMEOUT = float(os.getenv("STAGE_TIMEOUT", LLM_TIMEOUT + 5))
+
+
+class Stage:
+    def __init__(self, name, run, depends=(), timeout=STAGE_TIMEOUT, fallback=None):
+        self.name = name
+        self.run = run            # callable(inputs: dict of dependency results) -> str
+        self.depends = tuple(depends)
+        self.timeout = timeout
+        self.fallback = fallback  # callable(inputs) -> str used when the stage fails or times out
+
+
+# Function to run stages as a dependency graph; independent stages run concurrently.
+# Stages run on a pool of this call's own: a thread cannot be stopped, so a stage that
+# times out is abandoned and the pool is shut down without waiting for it, where the
+# loop's default executor would hold up asyncio.run() until the thread finished.
+async def run_pipeline(stages, on_stage_done=None):
+    by_name = {stage.name: stage for stage in stages}
+    tasks = {}
+    timings = {}
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=max(len(stages), 1), thread_name_prefix="stage")
+
+    async def execute(stage):
+        inputs = {}
+        for name in stage.depends:
+            inputs[name] = await tasks[name]
+        begin = time.perf_counter()
+        status = "ok"
+        try:
+            result = await asyncio.wait_for(loop.run_in_executor(executor, stage.run, inputs), stage.timeout)
+        except Exception as error:  # includes asyncio.TimeoutError
+            status = "timeout" if isinstance(error, asyncio.TimeoutError) else f"error: {error}"
+            result = stage.fallback(inputs) if stage.fallback else ""
+        end = time.perf_counter()
+        timings[stage.name] = {
+            "start": begin - started,
+            "seconds": end - begin,
+            "status": status,
+        }
+        record_stage(stage.name, end - begin, status)
+        if on_stage_done is not None:
+            on_stage_done(stage.name, result, timings[stage.name])
+        return result
+
+    for stage in stages:
+        missing = [name for name in stage.depends if name not in by_name]
+        if missing:
+            raise ValueError(f"Stage {stage.name} depends on unknown stages: {missing}")
+    # All tasks exist before the first one runs, so dependencies can be awaited by name
+    try:
+        for stage in stages:
+            tasks[stage.name] = asyncio.ensure_future(execute(stage))
+        results = {}
+        for name, task in tasks.items():
+            results[name] = await task
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    timings["total"] = {"start": 0.0, "seconds": time.perf_counter() - started, "status": "ok"}
+    return results, timings
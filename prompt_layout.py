@@ -0,0 +1,72 @@
+import hashlib
+import json
+import threading
+
+from image_payloads import get_data_url
+from retrieval import estimate_tokens
+
+
+# Function to build chat messages laid out for prompt-prefix caching. OpenAI and Mistral
+# reuse the processing of a prompt prefix they have seen recently, and Ollama keeps the
+# KV cache of the previous prompt, but only up to the first byte that differs. So the
+# order is: the static system prompt, then the images, then the context (identical
+# across questions when it is the whole route table), and the question always last.
+# The system prompt must not interpolate anything that varies between questions.
+def build_messages(system, question, context=None, images=()):
+    texts = [context, question] if context else [question]
+    if not images:
+        return [{"role": "system", "content": system},
+                {"role": "user", "content": "\n\n".join(texts)}]
+    parts = [{"type": "image_url", "image_url": {"url": get_data_url(path)}} for path in images]
+    parts += [{"type": "text", "text": text} for text in texts]
+    return [{"role": "system", "content": system}, {"role": "user", "content": parts}]
+
+
+# Function to split a prompt into prefix blocks: [(digest of everything up to and including
+# the block, tokens up to and including it)], one block per paragraph or image. Used by the
+# offline providers to mimic a provider-side prefix cache, which is kept per model.
+def prefix_blocks(messages, model=""):
+    digest = hashlib.sha256(model.encode("utf-8"))
+    tokens = 0
+    blocks = []
+    for message in messages:
+        content = message.get("content") or ""
+        parts = [{"type": "text", "text": content}] if isinstance(content, str) else content
+        parts = parts + [{"type": "image", "data": image} for image in message.get("images") or []]
+        digest.update(message["role"].encode("utf-8"))
+        for part in parts:
+            if part.get("type") == "text":
+                for paragraph in part["text"].split("\n\n"):
+                    digest.update(paragraph.encode("utf-8"))
+                    tokens += estimate_tokens(paragraph)
+                    blocks.append((digest.hexdigest(), tokens))
+            else:
+                digest.update(json.dumps(part, sort_keys=True).encode("utf-8"))
+                # Providers bill an image at a fixed token cost; the exact figure does not matter here
+                tokens += 256
+                blocks.append((digest.hexdigest(), tokens))
+    return blocks
+
+
+# Remembers recently seen prefixes, like a provider's prompt cache
+class PrefixCache:
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.seen = {}
+        self.lock = threading.Lock()
+
+    # Function to return how many leading prompt tokens were already cached, then remember this prompt
+    def lookup(self, messages, model=""):
+        blocks = prefix_blocks(messages, model)
+        cached = 0
+        with self.lock:
+            for digest, tokens in blocks:
+                if digest not in self.seen:
+                    break
+                cached = tokens
+            for digest, _ in blocks:
+                self.seen.pop(digest, None)
+                self.seen[digest] = True
+            while len(self.seen) > self.max_entries:
+                self.seen.pop(next(iter(self.seen)))
+        return cached
@@ -0,0 +1,348 @@
+import asyncio
+import contextvars
+import hashlib
+import importlib
+import json
+import logging
+import os
+import threading
+import time
+
+from metrics import begin_call, end_call
+from prompt_layout import PrefixCache
+
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 60))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 20))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 8))
+FAKE_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", 0.5))
+FAKE_TOKENS_PER_SECOND = float(os.getenv("FAKE_LLM_TOKENS_PER_SECOND", 50))
+# Import the selected backend's SDK and open its client in the background after the first paint
+BACKEND_WARMUP = os.getenv("BACKEND_WARMUP", "1") != "0"
+
+logger = logging.getLogger("providers")
+
+
+# The close functions of the streams opened in one context. A caller that may give up on
+# a stream from another thread (see hedging.py) sets one with open_streams.set(...) and
+# calls close() to shut the HTTP responses, so a stalled reader ends and frees its slot.
+class StreamGroup:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.closers = []
+        self.closed = False
+
+    def add(self, close):
+        with self.lock:
+            if not self.closed:
+                self.closers.append(close)
+                return
+        close()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            closers, self.closers = self.closers, []
+        for close in closers:
+            try:
+                close()
+            except Exception:
+                logger.debug("closing a stream failed", exc_info=True)
+
+
+open_streams = contextvars.ContextVar("open_streams", default=None)
+
+
+# Function to let the current context's StreamGroup (if any) close a stream that was just opened
+def track_stream(close):
+    group = open_streams.get()
+    if group is not None:
+        group.add(close)
+
+
+# The SDKs take most of a second each to import, so a provider imports its own only
+# when its client is first needed (or warmed); importing this module stays cheap
+class Provider:
+    name = "provider"
+    modules = ()  # SDK modules the client needs
+
+    def __init__(self, concurrency=LLM_CONCURRENCY, timeout=LLM_TIMEOUT):
+        self.timeout = timeout
+        # Bounds the calls this process has in flight against one provider
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        # One long-lived client per provider keeps TLS sessions and pooled connections warm
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self.create_client()
+        return self._client
+
+    def create_client(self):
+        raise NotImplementedError
+
+    # Function to pay the SDK import and client setup before the first question needs them
+    def warm(self):
+        for module in self.modules:
+            importlib.import_module(module)
+        return self.client
+
+    # Subclasses return the text and fill call["prompt_tokens"] / call["completion_tokens"] from the usage
+    def _complete(self, model, messages, call, **options):
+        raise NotImplementedError
+
+    def _stream(self, model, messages, call, **options):
+        raise NotImplementedError
+
+    # Function to return the full completion text
+    def complete(self, model, messages, **options):
+        with self.slots:
+            # Timed from here, so waiting for a slot counts as local overhead, not provider latency
+            call = begin_call(self.name, model, messages)
+            error = None
+            try:
+                return self._complete(model, messages, call, **options)
+            except Exception as exc:
+                error = exc
+                raise
+            finally:
+                end_call(call, error)
+
+    # Function to yield the completion text chunk by chunk
+    def stream(self, model, messages, **options):
+        with self.slots:
+            call = begin_call(self.name, model, messages, stream=True)
+            error = None
+            try:
+                for chunk in self._stream(model, messages, call, **options):
+                    if chunk:
+                        if call["ttft"] is None:
+                            call["ttft"] = time.perf_counter() - call["begin"]
+                        yield chunk
+            except Exception as exc:
+                error = exc
+                raise
+            finally:
+                end_call(call, error)
+
+    async def acomplete(self, model, messages, **options):
+        return await asyncio.to_thread(self.complete, model, messages, **options)
+
+
+class OpenAIProvider(Provider):
+    name = "openai"
+    modules = ("openai",)
+
+    def create_client(self):
+        import openai
+        return openai.OpenAI(timeout=self.timeout)
+
+    def _complete(self, model, messages, call, **options):
+        response = self.client.chat.completions.create(model=model, messages=messages, **options)
+        record_usage(call, response.usage)
+        return response.choices[0].message.content
+
+    def _stream(self, model, messages, call, **options):
+        stream = self.client.chat.completions.create(model=model, messages=messages, stream=True,
+                                                     stream_options={"include_usage": True}, **options)
+        track_stream(stream.close)
+        for chunk in stream:
+            record_usage(call, chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+class MistralProvider(Provider):
+    name = "mistral"
+    modules = ("httpx", "mistralai")
+
+    def create_client(self):
+        import httpx
+        from mistralai import Mistral
+        http_client = httpx.Client(
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS),
+        )
+        return Mistral(api_key=os.getenv("MISTRAL_API_KEY"), server_url=os.getenv("MISTRAL_SERVER_URL"),
+                       client=http_client, timeout_ms=int(self.timeout * 1000))
+
+    def _complete(self, model, messages, call, **options):
+        response = self.client.chat.complete(model=model, messages=messages, **options)
+        record_usage(call, response.usage)
+        return response.choices[0].message.content
+
+    def _stream(self, model, messages, call, **options):
+        stream = self.client.chat.stream(model=model, messages=messages, **options)
+        track_stream(stream.response.close)
+        for event in stream:
+            record_usage(call, event.data.usage)
+            if event.data.choices and event.data.choices[0].delta.content:
+                yield event.data.choices[0].delta.content
+
+
+# Function to copy token usage from an OpenAI or Mistral response (or final stream chunk) onto a call,
+# including how many prompt tokens the provider served from its prompt cache when it says so
+def record_usage(call, usage):
+    if usage is not None:
+        call["prompt_tokens"] = usage.prompt_tokens
+        call["completion_tokens"] = usage.completion_tokens
+        details = getattr(usage, "prompt_tokens_details", None)
+        if isinstance(details, dict):
+            cached = details.get("cached_tokens")
+        else:
+            cached = getattr(details, "cached_tokens", None)
+        if cached is None:
+            # Mistral reports it at the top level, when at all
+            cached = getattr(usage, "num_cached_tokens", None)
+        if cached is not None:
+            call["cached_tokens"] = cached
+
+
+# Function to copy Ollama's counts onto a call. Ollama reuses the KV cache of the previous
+# prompt and only evaluates what follows the shared prefix, which shows in prompt_seconds.
+def record_ollama_usage(call, response):
+    call["prompt_tokens"], call["completion_tokens"] = response["prompt_eval_count"], response["eval_count"]
+    if response.get("prompt_eval_duration") is not None:
+        call["prompt_seconds"] = response["prompt_eval_duration"] / 1e9
+
+
+# Function to convert OpenAI-style content parts into Ollama's text + images format
+def to_ollama_messages(messages):
+    converted = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            converted.append({"role": message["role"], "content": content})
+            continue
+        text = "\n".join(part["text"] for part in content if part["type"] == "text")
+        images = [part["image_url"]["url"].split(",", 1)[-1] for part in content if part["type"] == "image_url"]
+        entry = {"role": message["role"], "content": text}
+        if images:
+            entry["images"] = images
+        converted.append(entry)
+    return converted
+
+
+class OllamaProvider(Provider):
+    name = "ollama"
+    modules = ("httpx", "ollama")
+
+    def create_client(self):
+        import httpx
+        import ollama
+        # The SDK hides the streamed response inside its generator, so it is tracked when received
+        return ollama.Client(
+            host=os.getenv("OLLAMA_HOST"),
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS),
+            event_hooks={"response": [lambda response: track_stream(response.close)]},
+        )
+
+    def _complete(self, model, messages, call, **options):
+        response = self.client.chat(model=model, messages=to_ollama_messages(messages), **options)
+        record_ollama_usage(call, response)
+        return response["message"]["content"]
+
+    def _stream(self, model, messages, call, **options):
+        for chunk in self.client.chat(model=model, messages=to_ollama_messages(messages), stream=True, **options):
+            if chunk["done"]:
+                record_ollama_usage(call, chunk)
+            yield chunk["message"]["content"]
+
+
+# Deterministic offline provider: the answer depends only on model and messages
+class FakeProvider(Provider):
+    name = "fake"
+
+    def __init__(self, latency=FAKE_LATENCY, tokens_per_second=FAKE_TOKENS_PER_SECOND, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.prefixes = PrefixCache()
+
+    def create_client(self):
+        return None
+
+    def answer(self, model, messages):
+        digest = hashlib.sha256(json.dumps([model, messages], sort_keys=True).encode("utf-8")).hexdigest()
+        question = ""
+        for message in reversed(messages):
+            content = message["content"]
+            question = content if isinstance(content, str) else " ".join(
+                part["text"] for part in content if part["type"] == "text")
+            if message["role"] == "user":
+                break
+        return (f"Start point: as asked\nEnd point: as asked\n\nStep-by-step directions:\n"
+                f"1. Follow the signs for: {question.strip()[:80]}\n2. Continue straight ahead.\n"
+                f"3. Your destination is ahead (ref {digest[:8]}).")
+
+    # Reports cached tokens the way OpenAI does, so the prompt layout can be checked offline
+    def usage(self, call, messages, text):
+        call["prompt_tokens"] = len(json.dumps(messages)) // 4
+        call["completion_tokens"] = len(text.split())
+        call["cached_tokens"] = min(call["prompt_tokens"], self.prefixes.lookup(messages, call["model"]))
+
+    def _complete(self, model, messages, call, **options):
+        text = self.answer(model, messages)
+        time.sleep(self.latency + len(text.split()) / self.tokens_per_second)
+        self.usage(call, messages, text)
+        return text
+
+    # Closing the stream ends it at once, like a closed HTTP response
+    def _stream(self, model, messages, call, **options):
+        closed = threading.Event()
+        track_stream(closed.set)
+        if closed.wait(self.latency):
+            return
+        text = self.answer(model, messages)
+        self.usage(call, messages, text)
+        for word in text.split(" "):
+            if closed.wait(1 / self.tokens_per_second):
+                return
+            yield word + " "
+
+
+PROVIDERS = {"openai": OpenAIProvider, "mistral": MistralProvider, "ollama": OllamaProvider, "fake": FakeProvider}
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+# Function to return the process-wide provider for a backend
+def get_provider(name):
+    # Set LLM_PROVIDER=fake to route every backend to the offline fake provider
+    name = os.getenv("LLM_PROVIDER") or name
+    with _providers_lock:
+        if name not in _providers:
+            _providers[name] = PROVIDERS[name]()
+        return _providers[name]
+
+
+_warmed = set()
+
+
+# Function to warm backends in a background thread, once per process; returns the thread,
+# or None when there is nothing left to warm
+def warm_up(names):
+    if not BACKEND_WARMUP:
+        return None
+    with _providers_lock:
+        names = [name for name in dict.fromkeys(os.getenv("LLM_PROVIDER") or name for name in names)
+                 if name not in _warmed]
+        _warmed.update(names)
+    if not names:
+        return None
+
+    def run():
+        for name in names:
+            try:
+                get_provider(name).warm()
+            except Exception as error:
+                # A missing key or SDK surfaces again, with its real error, on the first question
+                logger.info("Could not warm %s: %s", name, error)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
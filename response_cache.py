@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from file_cache import file_fingerprint
+from metrics import record_cache
+
+CACHE_DIR = ".cache"
+# Files whose changes make every cached answer stale
+DATA_FILES = ("nav.txt", "captions.json", os.path.join(CACHE_DIR, "tile_captions.json"))
+DATA_FOLDER = "files"
+
+DEFAULT_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 7 * 24 * 3600))
+DEFAULT_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 50 * 1024 * 1024))
+DEFAULT_MEMORY_ENTRIES = int(os.getenv("RESPONSE_CACHE_MEMORY_ENTRIES", 256))
+
+
+# Function to normalize a question so trivial variations share a cache entry
+def normalize_question(question):
+    question = re.sub(r"[^\w\s&'-]", " ", question.lower())
+    return re.sub(r"\s+", " ", question).strip()
+
+
+def _digest(value):
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+# Function to fingerprint nav.txt, captions.json and files/ by size and mtime
+def data_fingerprint(files=DATA_FILES, folder=DATA_FOLDER):
+    return _digest(repr(file_fingerprint(*files, folder)))
+
+
+class ResponseCache:
+    def __init__(self, path=os.path.join(CACHE_DIR, "responses.sqlite"), ttl=DEFAULT_TTL,
+                 max_bytes=DEFAULT_MAX_BYTES, memory_entries=DEFAULT_MEMORY_ENTRIES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()  # key -> (created, value)
+        self.stats = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self.lock = threading.Lock()
+        self.version = None
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT, version TEXT, created REAL, accessed REAL, size INTEGER)"
+        )
+        self.db.commit()
+
+    # Function to build the cache key from backend, model, question, context and images, plus the
+    # messages sent when given, so a changed system prompt or message layout misses instead of
+    # returning answers written for the old one. The question is left out of the messages' digest;
+    # its normalized form above lets trivial variations share an entry.
+    def key(self, backend, model, question, context="", images=(), messages=None):
+        payload = [backend, model, normalize_question(question), _digest(context), _digest("|".join(images))]
+        if messages is not None:
+            layout = json.dumps(messages, sort_keys=True)
+            quoted = json.dumps(question)[1:-1]
+            if quoted:
+                layout = layout.replace(quoted, "{question}")
+            payload.append(_digest(layout))
+        return _digest(json.dumps(payload))
+
+    def _check_version(self):
+        # Drop everything computed against older nav.txt / captions.json / files/
+        version = data_fingerprint()
+        if version != self.version:
+            self.version = version
+            self.memory.clear()
+            self.db.execute("DELETE FROM responses WHERE version != ?", (version,))
+            self.db.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            self._check_version()
+            entry = self.memory.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.memory.move_to_end(key)
+                self.stats["hits"] += 1
+                self.stats["memory_hits"] += 1
+                record_cache(True)
+                return entry[1]
+            row = self.db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] < self.ttl:
+                self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                self.db.commit()
+                self._remember(key, row[1], row[0])
+                self.stats["hits"] += 1
+                self.stats["disk_hits"] += 1
+                record_cache(True)
+                return row[0]
+            self.stats["misses"] += 1
+            record_cache(False)
+            return None
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self._check_version()
+            self._remember(key, now, value)
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, value, self.version, now, now, len(value.encode("utf-8"))),
+            )
+            self._evict(now)
+            self.db.commit()
+
+    def _remember(self, key, created, value):
+        self.memory[key] = (created, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _evict(self, now):
+        self.db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Least recently used rows go first until the store fits again
+        for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.memory.pop(key, None)
+            total -= size
+
+    # Function to return a cached answer or compute and store it
+    def fetch(self, backend, model, question, compute, context="", images=(), messages=None):
+        key = self.key(backend, model, question, context, images, messages)
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            if value:
+                self.put(key, value)
+        return value
+
+    # Function to stream a cached answer in one chunk, or stream and store a fresh one
+    def fetch_stream(self, backend, model, question, stream, context="", images=(), messages=None):
+        key = self.key(backend, model, question, context, images, messages)
+        value = self.get(key)
+        if value is not None:
+            yield value
+            return
+        parts = []
+        chunks = stream()
+        try:
+            for chunk in chunks:
+                parts.append(chunk)
+                yield chunk
+        finally:
+            # A reader that stops early closes the provider stream now, freeing its slot
+            if hasattr(chunks, "close"):
+                chunks.close()
+        value = "".join(parts)
+        if value:
+            self.put(key, value)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+# Function to return the process-wide response cache
+def get_response_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
@@ -0,0 +1,232 @@
+import hashlib
+import importlib.util
+import json
+import os
+import re
+
+import numpy as np
+
+CACHE_DIR = ".cache"
+INDEX_VERSION = 1
+MAX_CHUNK_CHARS = 1200
+EMBEDDING_MODEL = os.getenv("RETRIEVAL_EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+
+TOKEN = re.compile(r"[a-z0-9]+")
+
+
+# Rough token estimate used to compare prompt sizes (about 4 characters per token)
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+_encoding = None
+
+
+# Exact token count with tiktoken when installed, otherwise the estimate above. tiktoken is
+# imported on first use, which keeps it out of the apps' startup.
+def count_tokens(text):
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:  # not installed, or the encoding file (downloaded on first use) is unreachable
+            _encoding = False
+    if not _encoding:
+        return estimate_tokens(text)
+    return len(_encoding.encode(text))
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Function to split text into pieces of at most MAX_CHUNK_CHARS on blank lines
+def split_blocks(text):
+    pieces, current = [], ""
+    for block in re.split(r"\n\s*\n", text):
+        block = block.strip()
+        if not block:
+            continue
+        if current and len(current) + len(block) + 2 > MAX_CHUNK_CHARS:
+            pieces.append(current)
+            current = ""
+        current = f"{current}\n\n{block}" if current else block
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+# Function to chunk nav.txt by "##" section, splitting long sections on route blocks
+def chunk_navigation(text):
+    chunks = []
+    for section in text.lstrip("﻿").split("##")[1:]:
+        title = section.split("\n")[0].strip(" :")
+        body = section[len(section.split("\n")[0]):]
+        for piece in split_blocks(body):
+            chunks.append({"kind": "nav", "source": "nav.txt", "title": title, "text": f"{title}:\n{piece}"})
+    return chunks
+
+
+# Function to chunk image captions by their markdown headings
+def chunk_captions(captions):
+    chunks = []
+    for filename, caption in captions.items():
+        parts = re.split(r"\n(?=#+ )", caption)
+        for part in parts:
+            title = part.strip().split("\n")[0].strip("# ")
+            for piece in split_blocks(part):
+                chunks.append({"kind": "caption", "source": filename, "title": title, "text": f"[{filename}] {piece}"})
+    return chunks
+
+
+def tokenize(text):
+    # Cheap plural folding so "gates" matches "gate"
+    return [t[:-1] if len(t) > 3 and t.endswith("s") else t for t in TOKEN.findall(text.lower())]
+
+
+class TfidfVectorizer:
+    method = "tfidf"
+
+    def __init__(self, vocabulary=None, idf=None):
+        self.vocabulary = vocabulary or {}
+        self.idf = idf
+
+    def fit(self, texts):
+        documents = [set(tokenize(text)) for text in texts]
+        terms = sorted(set().union(*documents)) if documents else []
+        self.vocabulary = {term: i for i, term in enumerate(terms)}
+        df = np.zeros(len(terms), dtype=np.float32)
+        for document in documents:
+            for term in document:
+                df[self.vocabulary[term]] += 1
+        self.idf = (np.log((1 + len(documents)) / (1 + df)) + 1).astype(np.float32)
+        return self
+
+    def transform(self, texts):
+        matrix = np.zeros((len(texts), len(self.vocabulary)), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for term in tokenize(text):
+                column = self.vocabulary.get(term)
+                if column is not None:
+                    matrix[row, column] += 1
+        matrix = np.log1p(matrix) * self.idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+
+# TF-IDF is used when no local embedding model is installed. Checking for one does not import
+# it: sentence_transformers pulls in torch, which takes seconds.
+def has_embeddings():
+    return importlib.util.find_spec("sentence_transformers") is not None
+
+
+class EmbeddingVectorizer:
+    method = "embedding"
+
+    def __init__(self, model_name=EMBEDDING_MODEL):
+        from sentence_transformers import SentenceTransformer
+        self.model_name = model_name
+        self.model = SentenceTransformer(model_name)
+
+    def fit(self, texts):
+        return self
+
+    def transform(self, texts):
+        vectors = self.model.encode(list(texts), normalize_embeddings=True)
+        return np.asarray(vectors, dtype=np.float32)
+
+
+class RetrievalIndex:
+    def __init__(self, chunks, vectors, vectorizer):
+        self.chunks = chunks
+        self.vectors = vectors
+        self.vectorizer = vectorizer
+        self.kinds = np.array([chunk["kind"] for chunk in chunks])
+
+    # Function to return the top-k chunks with their cosine scores
+    def search(self, query, k=4, kind=None):
+        if not self.chunks:
+            return []
+        scores = self.vectors @ self.vectorizer.transform([query])[0]
+        if kind is not None:
+            scores = np.where(self.kinds == kind, scores, -np.inf)
+        order = np.argsort(-scores)[:k]
+        return [dict(self.chunks[i], score=float(scores[i])) for i in order if np.isfinite(scores[i])]
+
+    # Function to count the tokens of all chunks, or of only the `largest` biggest ones
+    def total_tokens(self, kind=None, largest=None):
+        sizes = sorted((estimate_tokens(c["text"]) for c in self.chunks if kind is None or c["kind"] == kind), reverse=True)
+        return sum(sizes[:largest])
+
+
+# Function to join retrieved chunks into a prompt context
+def format_hits(hits):
+    return "\n\n".join(hit["text"] for hit in hits)
+
+
+def _paths(cache_dir):
+    return os.path.join(cache_dir, "retrieval.npz"), os.path.join(cache_dir, "retrieval.json")
+
+
+def _load_cached(cache_dir, fingerprint):
+    vectors_path, meta_path = _paths(cache_dir)
+    if not (os.path.exists(vectors_path) and os.path.exists(meta_path)):
+        return None
+    with open(meta_path, "r") as f:
+        meta = json.load(f)
+    if meta.get("fingerprint") != fingerprint:
+        return None
+    arrays = np.load(vectors_path)
+    if meta["method"] == "tfidf":
+        vectorizer = TfidfVectorizer(meta["vocabulary"], arrays["idf"])
+    else:
+        vectorizer = EmbeddingVectorizer(meta["model"])
+    return RetrievalIndex(meta["chunks"], arrays["vectors"], vectorizer)
+
+
+def _save_cached(cache_dir, fingerprint, index):
+    os.makedirs(cache_dir, exist_ok=True)
+    vectors_path, meta_path = _paths(cache_dir)
+    vectorizer = index.vectorizer
+    meta = {"fingerprint": fingerprint, "method": vectorizer.method, "chunks": index.chunks}
+    arrays = {"vectors": index.vectors}
+    if vectorizer.method == "tfidf":
+        meta["vocabulary"] = vectorizer.vocabulary
+        arrays["idf"] = vectorizer.idf
+    else:
+        meta["model"] = vectorizer.model_name
+    np.savez(vectors_path, **arrays)
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+
+# Function to load the retrieval index, rebuilding it when nav.txt or captions.json change
+def load_index(nav_path="nav.txt", captions_path="captions.json", cache_dir=CACHE_DIR):
+    method = "embedding:" + EMBEDDING_MODEL if has_embeddings() else "tfidf"
+    sources = {path: file_hash(path) for path in (nav_path, captions_path) if os.path.exists(path)}
+    fingerprint = {"version": INDEX_VERSION, "method": method, "chunk_chars": MAX_CHUNK_CHARS, "sources": sources}
+
+    index = _load_cached(cache_dir, fingerprint)
+    if index is not None:
+        return index
+
+    chunks = []
+    if nav_path in sources:
+        with open(nav_path, "r") as f:
+            chunks += chunk_navigation(f.read())
+    if captions_path in sources:
+        with open(captions_path, "r") as f:
+            chunks += chunk_captions(json.load(f))
+
+    vectorizer = EmbeddingVectorizer() if has_embeddings() else TfidfVectorizer()
+    texts = [chunk["text"] for chunk in chunks]
+    vectors = vectorizer.fit(texts).transform(texts)
+    index = RetrievalIndex(chunks, vectors, vectorizer)
+    _save_cached(cache_dir, fingerprint, index)
+    return index
+
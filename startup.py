@@ -0,0 +1,155 @@
+import argparse
+import builtins
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from metrics import registry
+
+# STARTUP_PROFILE=1 times every module import and the first render, shows them in the
+# sidebar and appends them to STARTUP_LOG. Import this module first in an entry script.
+STARTUP_PROFILE = os.getenv("STARTUP_PROFILE", "0") == "1"
+STARTUP_LOG = os.getenv("STARTUP_LOG", os.path.join(".cache", "startup.jsonl"))
+TOP_MODULES = 15
+
+_started = time.perf_counter()
+_marks = {}
+_first_report = None
+_imports = {}  # module -> (seconds including the modules it imported, seconds of its own)
+_local = threading.local()
+_original_import = builtins.__import__
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    stack = _local.__dict__.setdefault("stack", [])
+    stack.append(0.0)
+    began = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - began
+        children = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        _imports.setdefault(name, (elapsed, elapsed - children))
+
+
+def start():
+    if builtins.__import__ is not _timed_import:
+        builtins.__import__ = _timed_import
+
+
+# Function to start measuring afresh, e.g. once the Streamlit machinery is imported
+def restart_clock():
+    global _started, _first_report
+    _started = time.perf_counter()
+    _marks.clear()
+    _imports.clear()
+    _first_report = None
+
+
+# Function to note when something first happened, in seconds since the script started
+def mark(name):
+    return _marks.setdefault(name, time.perf_counter() - _started)
+
+
+# Function to return seconds since the process started, where /proc tells us
+def process_seconds():
+    try:
+        with open("/proc/self/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def summary(script=None, top=TOP_MODULES):
+    slowest = sorted(_imports.items(), key=lambda item: item[1][1], reverse=True)[:top]
+    return {
+        "script": script,
+        "marks": {name: round(seconds, 4) for name, seconds in _marks.items()},
+        "process_seconds": process_seconds(),
+        "import_seconds": round(sum(own for _, own in _imports.values()), 4),
+        "modules": [[name, round(total, 4), round(own, 4)] for name, (total, own) in slowest],
+    }
+
+
+# Function to record the end of a script's first run: the page is on screen. Only the first
+# call per process counts, since Streamlit reruns the script for every interaction; later
+# calls return the report taken then.
+def first_render(script):
+    global _first_report
+    if "first_render" in _marks:
+        return _first_report
+    mark("first_render")
+    if not STARTUP_PROFILE:
+        return None
+    report = _first_report = summary(script)
+    registry.sample("startup_first_render_seconds", report["marks"]["first_render"], script=script)
+    try:
+        if STARTUP_LOG:
+            os.makedirs(os.path.dirname(STARTUP_LOG) or ".", exist_ok=True)
+            with open(STARTUP_LOG, "a") as f:
+                f.write(json.dumps(report) + "\n")
+    except OSError:
+        pass
+    return report
+
+
+# Function to describe a startup report, one line per row
+def report_lines(report):
+    marks = report["marks"]
+    lines = [f"{name.replace('_', ' ').capitalize()}: {seconds:.2f}s after the script started"
+             for name, seconds in marks.items()]
+    if report.get("process_seconds") is not None:
+        lines.append(f"Process started {report['process_seconds']:.2f}s ago")
+    lines.append(f"Imports: {report['import_seconds']:.2f}s in total")
+    for name, total, own in report["modules"]:
+        lines.append(f"{name}: {own * 1000:.0f} ms ({total * 1000:.0f} ms with its imports)")
+    return lines
+
+
+if STARTUP_PROFILE:
+    start()
+
+
+# Profiles a cold start of an entry script in a fresh interpreter: Streamlit is imported
+# first, as the server does, then the script's first run is timed without a browser
+PROFILE_SNIPPET = """
+import json, sys, startup
+from streamlit.testing.v1 import AppTest
+startup.restart_clock()
+AppTest.from_file(sys.argv[1], default_timeout=120).run()
+print(json.dumps(startup.summary(sys.argv[1], int(sys.argv[2]))))
+"""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure import time and time to first render of the apps")
+    parser.add_argument("scripts", nargs="*", default=["main.py", "app.py", "app_mistral.py"])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    env = dict(os.environ, STARTUP_PROFILE="1", STARTUP_LOG="", BACKEND_WARMUP="0")
+    for script in args.scripts:
+        reports = []
+        for _ in range(args.runs):
+            result = subprocess.run([sys.executable, "-c", PROFILE_SNIPPET, os.path.abspath(script), str(args.top)],
+                                    env=env, capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)))
+            if result.returncode != 0:
+                raise SystemExit(f"{script} failed:\n{result.stderr}")
+            reports.append(json.loads(result.stdout.strip().splitlines()[-1]))
+        renders = sorted(report["marks"].get("first_render", float("nan")) for report in reports)
+        print(f"{script}: first render {renders[len(renders) // 2]:.2f}s (median of {args.runs}), "
+              f"imports {sorted(r['import_seconds'] for r in reports)[len(reports) // 2]:.2f}s")
+        for name, total, own in reports[-1]["modules"]:
+            print(f"  {name}: {own * 1000:.0f} ms ({total * 1000:.0f} ms with its imports)")
@@ -0,0 +1,20 @@
+import time
+
+
+# Function to pass a token stream through while recording time-to-first-token
+def timed_stream(chunks, stats):
+    started = time.perf_counter()
+    stats["ttft"] = None
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if stats["ttft"] is None:
+            stats["ttft"] = time.perf_counter() - started
+        yield chunk
+    stats["total"] = time.perf_counter() - started
+    if stats["ttft"] is None:
+        stats["ttft"] = stats["total"]
+
+
+def format_stream_stats(stats):
+    return f"Time to first token: {stats['ttft']:.2f}s · total: {stats['total']:.2f}s"
@@ -0,0 +1,232 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from prompt_layout import PrefixCache
+from retrieval import estimate_tokens
+
+
+# Counters shared by all requests the stub has served
+class StubStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+            self.image_bytes = 0
+
+    def record(self, prompt_tokens, completion_tokens, image_bytes):
+        with self.lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.image_bytes += image_bytes
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "image_bytes": self.image_bytes,
+            }
+
+
+# Function to measure text tokens and image bytes in OpenAI, Mistral or Ollama messages
+def measure_messages(messages):
+    text_tokens = 0
+    image_bytes = 0
+    for message in messages:
+        content = message.get("content") or ""
+        if isinstance(content, str):
+            text_tokens += estimate_tokens(content)
+        else:
+            for part in content:
+                if part.get("type") == "text":
+                    text_tokens += estimate_tokens(part["text"])
+                elif part.get("type") == "image_url":
+                    url = part["image_url"]["url"] if isinstance(part["image_url"], dict) else part["image_url"]
+                    image_bytes += len(url.split(",", 1)[-1])
+        for image in message.get("images") or []:
+            image_bytes += len(image)
+    return text_tokens, image_bytes
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "StubLLM/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_stream(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _tokens(self):
+        config = self.server.config
+        return [f"step{i} " for i in range(config["completion_tokens"])]
+
+    # Function to mimic Ollama's model residency: a model not loaded with this num_ctx pays the load time
+    def _ollama_load(self, request):
+        num_ctx = (request.get("options") or {}).get("num_ctx", 2048)
+        with self.server.stats.lock:
+            loaded = self.server.loaded.get(request.get("model")) == num_ctx
+            self.server.loaded[request.get("model")] = num_ctx
+        if not loaded:
+            time.sleep(self.server.config["load_seconds"])
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/api/ps":
+            with self.server.stats.lock:
+                loaded = dict(self.server.loaded)
+            expires = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 1800))
+            self._send_json({"models": [{"name": model, "model": model, "size": 0, "size_vram": 0,
+                                         "digest": "stub", "expires_at": expires, "context_length": num_ctx}
+                                        for model, num_ctx in loaded.items()]})
+        else:
+            self._send_json({"error": f"unknown path {self.path}"}, status=404)
+
+    def do_POST(self):
+        request = self._read_json()
+        if self.path.rstrip("/") in ("/api/chat", "/api/generate"):
+            self._ollama_load(request)
+        if self.path.rstrip("/") == "/api/generate" and not request.get("prompt"):
+            # An empty prompt only loads the model
+            self._send_json({"model": request.get("model"), "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                             "response": "", "done": True, "done_reason": "load"})
+            return
+        messages = request.get("messages", [])
+        prompt_tokens, image_bytes = measure_messages(messages)
+        config = self.server.config
+        tokens = self._tokens()
+        self.server.stats.record(prompt_tokens, len(tokens), image_bytes)
+        # Time to first token grows with the part of the prompt not already in the prefix cache,
+        # as it does on a real provider
+        cached = min(prompt_tokens, self.server.prefixes.lookup(messages, request.get("model", "")))
+        prefill = (prompt_tokens - cached) / config["prefill_tokens_per_second"]
+        time.sleep(config["latency"] + prefill)
+        if self.path.rstrip("/").endswith("/chat/completions"):
+            self._chat_completions(request, tokens, prompt_tokens, cached)
+        elif self.path.rstrip("/") == "/api/chat":
+            self._ollama_chat(request, tokens, prompt_tokens - cached, prefill)
+        else:
+            self._send_json({"error": f"unknown path {self.path}"}, status=404)
+
+    # OpenAI and Mistral share the /v1/chat/completions wire format
+    def _chat_completions(self, request, tokens, prompt_tokens, cached_tokens):
+        delay = 1 / self.server.config["tokens_per_second"]
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                 "total_tokens": prompt_tokens + len(tokens),
+                 "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+        base = {"id": "chatcmpl-stub", "created": int(time.time()), "model": request.get("model", "stub")}
+        if not request.get("stream"):
+            time.sleep(delay * len(tokens))
+            self._send_json(dict(base, object="chat.completion", usage=usage, choices=[{
+                "index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop",
+            }]))
+            return
+        self._start_stream("text/event-stream")
+        for i, token in enumerate(tokens):
+            time.sleep(delay)
+            delta = {"role": "assistant", "content": token} if i == 0 else {"content": token}
+            chunk = dict(base, object="chat.completion.chunk",
+                         choices=[{"index": 0, "delta": delta, "finish_reason": None}])
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        final = dict(base, object="chat.completion.chunk", usage=usage,
+                     choices=[{"index": 0, "delta": {"content": ""}, "finish_reason": "stop"}])
+        self._write_chunk(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._end_stream()
+
+    # Like Ollama after a KV cache hit, prompt_eval_count only counts the tokens it evaluated
+    def _ollama_chat(self, request, tokens, prompt_tokens, prefill):
+        delay = 1 / self.server.config["tokens_per_second"]
+        base = {"model": request.get("model", "stub"), "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ")}
+        done = dict(base, done=True, done_reason="stop", prompt_eval_count=prompt_tokens, eval_count=len(tokens),
+                    prompt_eval_duration=int(prefill * 1e9))
+        if request.get("stream") is False:
+            time.sleep(delay * len(tokens))
+            self._send_json(dict(done, message={"role": "assistant", "content": "".join(tokens)}))
+            return
+        self._start_stream("application/x-ndjson")
+        for token in tokens:
+            time.sleep(delay)
+            line = dict(base, done=False, message={"role": "assistant", "content": token})
+            self._write_chunk((json.dumps(line) + "\n").encode("utf-8"))
+        self._write_chunk((json.dumps(dict(done, message={"role": "assistant", "content": ""})) + "\n").encode("utf-8"))
+        self._end_stream()
+
+
+# Function to start the stub server in a background thread; returns the server
+def start_stub_server(host="127.0.0.1", port=0, latency=0.3, tokens_per_second=50.0,
+                      prefill_tokens_per_second=5000.0, completion_tokens=150, load_seconds=0.0):
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.stats = StubStats()
+    server.loaded = {}  # Ollama model -> num_ctx it is loaded with
+    server.prefixes = PrefixCache()
+    server.config = {
+        "latency": latency,
+        "tokens_per_second": tokens_per_second,
+        "prefill_tokens_per_second": prefill_tokens_per_second,
+        "completion_tokens": completion_tokens,
+        "load_seconds": load_seconds,
+    }
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stub_url(server):
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stub of the OpenAI, Mistral and Ollama chat APIs")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--prefill-tokens-per-second", type=float, default=5000.0)
+    parser.add_argument("--completion-tokens", type=int, default=150)
+    parser.add_argument("--load-seconds", type=float, default=0.0, help="Ollama model load time")
+    args = parser.parse_args()
+    server = start_stub_server(port=args.port, latency=args.latency, tokens_per_second=args.tokens_per_second,
+                               prefill_tokens_per_second=args.prefill_tokens_per_second,
+                               completion_tokens=args.completion_tokens, load_seconds=args.load_seconds)
+    url = stub_url(server)
+    print(f"Stub LLM server on {url}")
+    print(f"  OPENAI_BASE_URL={url}/v1  MISTRAL_SERVER_URL={url}  OLLAMA_HOST={url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,76 @@
+import json
+import os
+
+import pytest
+
+from answer_store import AnswerStore
+from nav_graph import NavGraph, parse_navigation
+
+NAV = """Prayer Room → Gate 5:
+- Walk to Gate 5
+"""
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "answers.jsonl")
+
+
+def store(path, writer=False):
+    return AnswerStore(path, graph=NavGraph(parse_navigation(NAV)), writer=writer)
+
+
+def test_put_and_get(path):
+    writer = store(path, writer=True)
+    writer.put("openai", "How do I get from the Prayer Room to Gate 5?", "Walk.")
+    # Questions naming the same start and end share an answer
+    assert writer.get("openai", "prayer room to gate 5") == "Walk."
+    assert writer.get("mistral", "prayer room to gate 5") is None
+    assert writer.stats == {"hits": 1, "misses": 1}
+    assert store(path).get("openai", "Prayer Room → Gate 5?") == "Walk."
+
+
+def test_saved_index_is_reused(path):
+    writer = store(path, writer=True)
+    writer.put("openai", "Where can I pray?", "Prayer Room.")
+    writer.save_index()
+    with open(path + ".idx", "r") as f:
+        assert json.load(f)["size"] == os.path.getsize(path)
+    assert len(store(path)) == 1
+
+
+def test_index_rebuilt_when_file_grew(path):
+    writer = store(path, writer=True)
+    writer.put("openai", "first question", "one")
+    writer.save_index()
+    writer.put("openai", "second question", "two")
+    reader = store(path)
+    assert len(reader) == 2
+    assert reader.get("openai", "second question") == "two"
+
+
+def test_reader_skips_partial_last_line_without_touching_file(path):
+    writer = store(path, writer=True)
+    writer.put("openai", "first question", "one")
+    with open(path, "ab") as f:
+        f.write(b'{"key": "openai|q:half')
+    size = os.path.getsize(path)
+
+    reader = store(path)
+    assert len(reader) == 1
+    assert reader.get("openai", "first question") == "one"
+    assert os.path.getsize(path) == size
+
+
+def test_writer_drops_partial_last_line(path):
+    store(path, writer=True).put("openai", "first question", "one")
+    with open(path, "ab") as f:
+        f.write(b'{"key": "openai|q:half')
+    complete = os.path.getsize(path) - len(b'{"key": "openai|q:half')
+
+    writer = store(path, writer=True)
+    assert os.path.getsize(path) == complete
+    writer.put("openai", "second question", "two")
+    reader = store(path)
+    assert reader.get("openai", "first question") == "one"
+    assert reader.get("openai", "second question") == "two"
@@ -0,0 +1,91 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+import api_server
+import providers
+import response_cache
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def fake(monkeypatch, tmp_path):
+    # Every backend answers through the offline fake provider, with a fresh response cache
+    monkeypatch.chdir(REPO)
+    monkeypatch.setenv("LLM_PROVIDER", "fake")
+    provider = providers.FakeProvider(latency=0.3, tokens_per_second=10000)
+    monkeypatch.setitem(providers._providers, "fake", provider)
+    monkeypatch.setattr(response_cache, "_cache", response_cache.ResponseCache(path=str(tmp_path / "r.sqlite")))
+    return provider
+
+
+def post(service, body, path="/v1/directions"):
+    return service.handle("POST", path, json.dumps(body).encode("utf-8"))
+
+
+@pytest.mark.parametrize("body, message", [
+    ([1, 2], "body must be a JSON object"),
+    ({}, "question is required"),
+    ({"question": "where?", "top_k": "4"}, "top_k must be an integer"),
+    ({"question": "where?", "top_k": 500}, "top_k must be an integer"),
+    ({"question": "where?", "model": "gpt"}, "model must be one of"),
+    ({"question": "where?", "model_name": ["a"]}, "model_name must be a string"),
+    ({"question": "where?", "compact": "yes"}, "compact must be"),
+])
+def test_bad_requests_are_400(body, message):
+    with pytest.raises(api_server.HTTPError) as error:
+        asyncio.run(post(api_server.AssistantService(), body))
+    assert error.value.status == 400
+    assert message in str(error.value)
+
+
+def test_bad_vision_requests_are_400():
+    service = api_server.AssistantService()
+    for body in ({"question": "where?", "pipeline": "fast"}, {"question": "where?", "max_images": 9}):
+        with pytest.raises(api_server.HTTPError) as error:
+            asyncio.run(post(service, body, "/v1/vision"))
+        assert error.value.status == 400
+
+
+def test_identical_requests_are_coalesced(fake):
+    service = api_server.AssistantService()
+
+    async def burst():
+        body = {"question": "Is there anywhere quiet to rest?", "model": "openai"}
+        return await asyncio.gather(*(post(service, body) for _ in range(5)))
+
+    responses = asyncio.run(burst())
+    assert [status for status, _ in responses] == [200] * 5
+    assert len({payload["answer"] for _, payload in responses}) == 1
+    assert service.counters["upstream"] == 1
+    assert service.counters["coalesced"] == 4
+
+
+def test_requests_beyond_the_queue_get_429(fake):
+    async def run():
+        server = await api_server.start_api_server(
+            port=0, service=api_server.AssistantService(limits={"openai": 1}, queue_size=0))
+        port = server.sockets[0].getsockname()[1]
+
+        async def call(question):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            body = json.dumps({"question": question, "model": "openai"}).encode("utf-8")
+            writer.write(b"POST /v1/directions HTTP/1.1\r\nConnection: close\r\n"
+                         + f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+            status_line = await reader.readline()
+            await reader.read()
+            writer.close()
+            return int(status_line.split()[1])
+
+        first = asyncio.ensure_future(call("Is there anywhere quiet to rest?"))
+        await asyncio.sleep(0.1)
+        second = await call("Where can I buy a coffee?")
+        statuses = [await first, second]
+        server.close()
+        await server.wait_closed()
+        return statuses
+
+    assert asyncio.run(run()) == [200, 429]
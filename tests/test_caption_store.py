@@ -0,0 +1,59 @@
+import json
+import os
+
+from caption_store import CaptionStore, IMPORTED, prompt_version
+
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+
+def test_put_get_and_export(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store = CaptionStore(path=str(tmp_path / "captions.sqlite"))
+    version = prompt_version("Describe this map")
+    store.put("captions.json", "a.png", "hash-a", "Gate A map", "gpt-4o", version)
+    store.put("captions.json", "a.png", "hash-a", "Gate A map, newer", "gpt-4o", prompt_version("other"))
+    assert store.get("hash-a") == "Gate A map, newer"
+    assert store.get("hash-a", "gpt-4o", version) == "Gate A map"
+    assert store.get("hash-a", "llava") is None
+    assert store.export("captions.json") == {"a.png": "Gate A map, newer"}
+    assert json.load(open("captions.json")) == {"a.png": "Gate A map, newer"}
+
+
+def test_lookup_links_renamed_files_and_reports_edited_ones(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store = CaptionStore(path=str(tmp_path / "captions.sqlite"))
+    first = write(tmp_path / "a.png", b"map one")
+    store.put("captions.json", "a.png", store.hash_file(first), "Map one", "gpt-4o", "v1")
+
+    renamed = write(tmp_path / "b.png", b"map one")
+    edited = write(tmp_path / "c.png", b"map two")
+    found, pending = store.lookup([renamed, edited])
+    assert found == {"b.png": "Map one"}
+    assert pending == [edited]
+    # The renamed file now appears in the exported view under its new name
+    assert json.load(open("captions.json")) == {"a.png": "Map one", "b.png": "Map one"}
+
+
+def test_sync_imports_entries_added_to_the_json_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store = CaptionStore(path=str(tmp_path / "captions.sqlite"))
+    os.makedirs("files")
+    write(tmp_path / "files" / "a.png", b"map one")
+    with open("captions.json", "w") as f:
+        json.dump({"a.png": "Map one", "gone.png": "No file"}, f)
+    assert store.sync("captions.json") == 2
+    assert store.view("captions.json") == {"a.png": "Map one", "gone.png": "No file"}
+    assert store.get(store.hash_file("files/a.png"), IMPORTED, IMPORTED) == "Map one"
+    # Unchanged since the store exported it: nothing to do
+    assert store.sync("captions.json") == 0
+
+    entries = json.load(open("captions.json"))
+    entries["gone.png"] = "Edited by hand"
+    with open("captions.json", "w") as f:
+        json.dump(entries, f)
+    assert store.sync("captions.json") == 1
+    assert store.view("captions.json")["gone.png"] == "Edited by hand"
@@ -0,0 +1,73 @@
+import pytest
+
+import conversation
+from conversation import Conversation, ConversationMemory, answer_gist
+from location_resolver import LocationResolver
+
+NAMES = {"gate 5": "Gate 5", "starbucks": "Starbucks", "toilet": "Toilet", "prayer room": "Prayer Room"}
+ANSWER = ("Start point: {start}\nEnd point: {end}\n\nStep-by-step directions:\n"
+          "1. Walk straight past the shops towards {end}. Then keep left.\n2. {end} is on your right.")
+
+
+@pytest.fixture(autouse=True)
+def resolver(monkeypatch):
+    resolver = LocationResolver(NAMES)
+    monkeypatch.setattr(conversation, "get_location_resolver", lambda: resolver)
+
+
+def ask(chat, question, sent=()):
+    turn = chat.prepare(question)
+    chat.record(turn, ANSWER.format(start=turn["start"], end=turn["end"]), sent)
+    return turn
+
+
+def test_follow_ups_are_rewritten_with_earlier_locations():
+    chat = Conversation()
+    first = ask(chat, "How do I get from Starbucks to Gate 5?", sent=["nav.txt:Starbucks"])
+    assert not first["follow_up"] and first["standalone"] == first["question"]
+
+    turn = ask(chat, "and from there to the toilet?")
+    assert (turn["start"], turn["end"]) == ("Gate 5", "Toilet")
+    assert turn["standalone"] == "From Gate 5 to Toilet: and from there to the toilet?"
+    assert turn["skip"] == {"nav.txt:Starbucks"}
+    assert "Traveller: How do I get from Starbucks to Gate 5?" in turn["history"]
+
+    turn = chat.prepare("and back?")
+    assert (turn["start"], turn["end"]) == ("Toilet", "Gate 5")
+
+    # A question naming both places stands alone
+    turn = chat.prepare("How do I get from the toilet to the prayer room?")
+    assert not turn["follow_up"] and turn["history"] == ""
+
+
+def test_old_turns_are_folded_into_summary_lines(monkeypatch):
+    monkeypatch.setattr(conversation, "CONVERSATION_TOKEN_BUDGET", 120)
+    chat = Conversation()
+    ask(chat, "How do I get from Starbucks to Gate 5?")
+    ask(chat, "and from there to the toilet?")
+    ask(chat, "and from there to the prayer room?")
+    assert chat.summary[0] == ("- How do I get from Starbucks to Gate 5? (Starbucks → Gate 5) "
+                               "Answered: Walk straight past the shops towards Gate 5.")
+    assert len(chat.turns) < 3
+    assert chat.tokens() <= 120
+
+
+def test_answer_gist_skips_headings_and_step_numbers():
+    assert answer_gist(ANSWER.format(start="A", end="B")) == "Walk straight past the shops towards B."
+    assert answer_gist("") == ""
+
+
+def test_memory_cap_forgets_the_least_recently_used_history():
+    memory = ConversationMemory(limit=1)
+    old, recent = Conversation(), Conversation()
+    memory.add(old)
+    memory.add(recent)
+    ask(old, "How do I get from Starbucks to Gate 5?")
+    ask(recent, "How do I get from the toilet to Gate 5?")
+    old.last_used -= 10
+    memory.limit = recent.size()
+    assert memory.enforce() == recent.size()
+    assert old.turns == [] and recent.turns
+    # The forgotten conversation still knows where the traveller was going
+    assert old.end == "Gate 5"
+    assert memory.stats()["sessions"] == 2
@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+from hedging import Hedge
+from providers import FakeProvider
+
+MESSAGES = [{"role": "user", "content": "How do I get to gate 5?"}]
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_stalled_primary_is_closed_and_frees_its_slot():
+    stalled = FakeProvider(latency=60, concurrency=1)
+    fast = FakeProvider(latency=0, tokens_per_second=10000)
+    hedge = Hedge(delay=0.05, timeout=5)
+    hedge.add("primary", lambda: stalled.stream("m", MESSAGES))
+    hedge.add("secondary", lambda: fast.stream("m", MESSAGES))
+    began = time.time()
+    text = "".join(hedge.stream())
+    assert time.time() - began < 2
+    assert text.startswith("Start point")
+    assert hedge.winner == "secondary"
+    assert hedge.results["primary"]["status"] == "cancelled"
+    # The primary's thread has ended and released the provider's only slot
+    assert wait_for(lambda: hedge.results["primary"]["seconds"] is not None)
+    assert stalled.slots.acquire(timeout=1)
+
+
+def test_reader_stopping_early_closes_the_winner():
+    slow = FakeProvider(latency=0, tokens_per_second=5, concurrency=1)
+    hedge = Hedge(delay=5, timeout=5)
+    hedge.add("primary", lambda: slow.stream("m", MESSAGES))
+    chunks = hedge.stream()
+    next(chunks)
+    chunks.close()
+    assert hedge.results["primary"]["status"] == "cancelled"
+    assert wait_for(lambda: hedge.results["primary"]["seconds"] is not None)
+    assert slow.slots.acquire(timeout=1)
+
+
+def test_both_backends_failing_raises_the_last_error():
+    def fail(message):
+        def start():
+            raise ConnectionError(message)
+        return start
+
+    hedge = Hedge(delay=5, timeout=5)
+    hedge.add("primary", fail("primary down"))
+    hedge.add("secondary", fail("secondary down"))
+    began = time.time()
+    with pytest.raises(ConnectionError, match="secondary down"):
+        list(hedge.stream())
+    # The secondary starts as soon as the primary fails, without waiting out the delay
+    assert time.time() - began < 1
+    assert {label: result["status"] for label, result in hedge.results.items()} == {"primary": "error",
+                                                                                 "secondary": "error"}
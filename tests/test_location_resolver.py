@@ -0,0 +1,83 @@
+import pytest
+
+from location_resolver import LOCATION_CONFIDENCE, LocationResolver, classify_request, format_resolution, jaro_winkler
+
+NAMES = {"gate 5": "Gate 5", "gate 3": "Gate 3", "starbucks": "Starbucks", "toilet": "Toilet",
+         "prayer room": "Prayer Room", "taxi stand": "Taxi Stand", "transfer desk": "Transfer Desk"}
+
+
+@pytest.fixture(scope="module")
+def resolver():
+    return LocationResolver(NAMES)
+
+
+def endpoints(resolution):
+    return tuple(place and place["name"] for place in (resolution["start"], resolution["end"]))
+
+
+def test_from_to(resolver):
+    resolution = resolver.resolve("How do I get from Starbucks to Gate 5?")
+    assert endpoints(resolution) == ("Starbucks", "Gate 5")
+    assert resolution["confidence"] == 1.0
+    assert classify_request("How do I get from Starbucks to Gate 5?", resolution)[0] == "fast"
+
+
+def test_destination_first(resolver):
+    assert endpoints(resolver.resolve("How do I get to Gate 5 from Starbucks?")) == ("Starbucks", "Gate 5")
+    assert endpoints(resolver.resolve("Starbucks to the taxi stand")) == ("Starbucks", "Taxi Stand")
+
+
+def test_aliases_numbers_and_typos(resolver):
+    assert endpoints(resolver.resolve("Where is the nearest restroom?")) == (None, "Toilet")
+    assert endpoints(resolver.resolve("from gate five to the prayer room")) == ("Gate 5", "Prayer Room")
+    resolution = resolver.resolve("where is the prayr room")
+    assert resolution["end"]["name"] == "Prayer Room"
+    assert resolution["end"]["score"] < 1.0
+
+
+def test_unknown_gate_lowers_confidence(resolver):
+    resolution = resolver.resolve("gate 6 to gate 5")
+    assert endpoints(resolution) == (None, "Gate 5")
+    assert resolution["unresolved"] == ["gate 6"]
+    assert resolution["confidence"] < LOCATION_CONFIDENCE
+    assert classify_request("gate 6 to gate 5", resolution)[0] == "full"
+
+
+def test_unknown_place_before_to_lowers_confidence(resolver):
+    resolution = resolver.resolve("the xyzzy lounge to gate 5")
+    assert resolution["unresolved"] == ["lounge"]
+    assert resolution["confidence"] < LOCATION_CONFIDENCE
+
+
+def test_unknown_start_after_from_lowers_confidence(resolver):
+    assert resolver.resolve("from the spa to gate 5")["confidence"] < LOCATION_CONFIDENCE
+
+
+def test_terminals_and_quantities_are_not_places(resolver):
+    for question in ("Where is gate 5 in terminal 2?", "I have 30 minutes, how do I get to gate 5?",
+                     "I want to go to gate 5"):
+        resolution = resolver.resolve(question)
+        assert resolution["unresolved"] == [], question
+        assert resolution["confidence"] == 1.0, question
+
+
+def test_near_is_a_landmark_not_an_endpoint(resolver):
+    for question in ("Where can I find a toilet near gate 3?", "Is there a toilet close to gate 3?"):
+        resolution = resolver.resolve(question)
+        assert endpoints(resolution) == (None, "Toilet"), question
+        assert resolution["near"]["name"] == "Gate 3", question
+    assert "Near: Gate 3" in format_resolution(resolver.resolve("a toilet near gate 3"))
+
+
+def test_complex_requests_take_the_full_path(resolver):
+    question = "What is the fastest way from Starbucks to Gate 5?"
+    assert classify_request(question, resolver.resolve(question))[0] == "full"
+    # A place name that happens to contain a complex word does not count
+    question = "How do I get from Starbucks to the Transfer Desk?"
+    assert classify_request(question, resolver.resolve(question))[0] == "fast"
+
+
+def test_jaro_winkler():
+    assert jaro_winkler("prayer room", "prayer room") == 1.0
+    assert jaro_winkler("prayr room", "prayer room") > 0.9
+    assert jaro_winkler("abc", "xyz") == 0.0
@@ -0,0 +1,37 @@
+import os
+import time
+
+from metrics import Registry, append_log, percentile
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile(range(1, 101), 95) == 95
+
+
+def test_log_is_rotated(tmp_path):
+    path = str(tmp_path / "metrics.jsonl")
+    for _ in range(30):
+        append_log(path, "x" * 99, max_bytes=1000)
+    assert sorted(os.listdir(tmp_path)) == ["metrics.jsonl", "metrics.jsonl.1"]
+    assert os.path.getsize(path) <= 1000
+    assert os.path.getsize(path + ".1") == 1000
+
+
+def test_prometheus_file_is_written_in_the_background_at_most_once_per_interval(tmp_path):
+    path = str(tmp_path / "metrics.prom")
+    registry = Registry()
+    registry.count("requests_total")
+    registry.schedule_prometheus(path, interval=0.3)
+    deadline = time.time() + 2
+    while not os.path.exists(path) and time.time() < deadline:
+        time.sleep(0.01)
+    assert "assistant_requests_total 1" in open(path).read()
+
+    registry.count("requests_total")
+    registry.schedule_prometheus(path, interval=0.3)
+    time.sleep(0.1)
+    assert "assistant_requests_total 1" in open(path).read()
+    time.sleep(0.4)
+    assert "assistant_requests_total 2" in open(path).read()
@@ -0,0 +1,107 @@
+import os
+
+from nav_graph import NavGraph, format_route, load_nav_graph, normalize_name, parse_navigation
+
+NAV = """## From Prayer Room to All Locations:
+
+Prayer Room → Currency Exchange:
+- Exit Prayer Room
+- Turn left into main concourse
+- Walk 30m
+- Currency Exchange on right
+
+Currency Exchange → Gate 5:
+- Walk past duty free
+- Gate 5 ahead
+
+## Departures
+
+Check-in → Gate 5:
+- Pass security screening
+- Gate 5 on left
+
+Taxi Stand → ALL Destinations:
+- Follow the signs
+"""
+
+
+def graph():
+    return NavGraph(parse_navigation(NAV))
+
+
+def test_parse_navigation_skips_placeholders():
+    routes = parse_navigation(NAV)
+    assert [(start, end) for _, start, end, _ in routes] == [
+        ("Prayer Room", "Currency Exchange"), ("Currency Exchange", "Gate 5"), ("Check-in", "Gate 5")]
+    assert routes[0][0] == "From Prayer Room to All Locations"
+    assert routes[0][3][0] == "Exit Prayer Room"
+
+
+def test_normalize_name():
+    assert normalize_name("  McDonald’s (Level 2) ") == "mcdonald's level 2"
+
+
+def test_route_joins_listed_routes():
+    hops = graph().route("prayer room", "Gate 5")
+    assert [(start, end) for start, end, _ in hops] == [("Prayer Room", "Currency Exchange"),
+                                                        ("Currency Exchange", "Gate 5")]
+    assert hops[0][2] == ["Exit Prayer Room", "Turn left into main concourse", "Walk 30m",
+                          "Currency Exchange on right"]
+
+
+def test_reversed_route_is_rewritten():
+    hops = graph().route("Currency Exchange", "Prayer Room")
+    assert len(hops) == 1
+    steps = hops[0][2]
+    assert steps[0].startswith("From Currency Exchange, follow the signs for Prayer Room")
+    # Listed steps run backwards, turns and sides are dropped, and leaving becomes entering
+    assert steps[1:] == ["Walk 30m", "Enter Prayer Room"]
+    assert not any("left" in step.lower() or "right" in step.lower() for step in steps)
+
+
+def test_one_way_route_is_not_reversed():
+    g = graph()
+    assert g.route("Check-in", "Gate 5") is not None
+    assert g.route("Gate 5", "Check-in") is None
+
+
+def test_unknown_locations_have_no_route():
+    assert graph().route("Prayer Room", "Nowhere") is None
+
+
+def test_find_locations_reads_from_before_to():
+    g = graph()
+    assert g.find_locations("How do I get from the Prayer Room to Gate 5?") == ["prayer room", "gate 5"]
+    assert g.find_locations("How do I get to Gate 5 from the Prayer Room?") == ["prayer room", "gate 5"]
+
+
+def test_answer_and_format_route():
+    start, end, hops = graph().answer("Prayer Room to Gate 5 please")
+    assert (start, end) == ("Prayer Room", "Gate 5")
+    text = format_route(hops)
+    assert text.startswith("Route: Prayer Room → Currency Exchange → Gate 5")
+    assert "**Currency Exchange → Gate 5**" in text
+    assert "6. Gate 5 ahead" in text
+
+
+def test_nav_txt_parses():
+    g = load_nav_graph(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "nav.txt"))
+    assert g.names and g.edges
+
+
+def test_point_to_point_phrasings():
+    g = graph()
+    for question in ("How do I get from the Prayer Room to Gate 5?", "Prayer Room to Gate 5",
+                     "Prayer Room → Gate 5", "How do I get to Gate 5 from the Prayer Room?"):
+        assert g.endpoints(question) == ("prayer room", "gate 5"), question
+        assert g.answer(question)[:2] == ("Prayer Room", "Gate 5"), question
+
+
+def test_questions_naming_two_places_are_not_routes():
+    g = graph()
+    for question in ("Is there a currency exchange between the Prayer Room and Gate 5?",
+                     "Where can I find a currency exchange near Gate 5?",
+                     "Is the Prayer Room close to Gate 5?",
+                     "Does the Prayer Room open before Gate 5 boards?"):
+        assert g.endpoints(question) is None, question
+        assert g.answer(question) is None, question
@@ -0,0 +1,39 @@
+from types import SimpleNamespace
+
+from ollama_manager import OllamaManager, context_length, OLLAMA_MIN_CTX, OLLAMA_MAX_CTX
+
+
+class FakeClient:
+    def __init__(self):
+        self.ps_calls = 0
+
+    def ps(self):
+        self.ps_calls += 1
+        return SimpleNamespace(models=[])
+
+
+def test_context_length_is_clamped_and_rounded():
+    assert context_length(0) == OLLAMA_MIN_CTX
+    assert context_length(10 ** 7) == OLLAMA_MAX_CTX
+    assert context_length(6000) % 2048 == 0 and context_length(6000) >= 6000
+
+
+def test_chat_options_only_grow_num_ctx():
+    manager = OllamaManager()
+    small = [{"role": "user", "content": "hi"}]
+    large = [{"role": "user", "content": "word " * 20000}]
+    assert manager.chat_options("llama2", small)["options"]["num_ctx"] == OLLAMA_MIN_CTX
+    grown = manager.chat_options("llama2", large)["options"]["num_ctx"]
+    assert grown > OLLAMA_MIN_CTX
+    assert manager.chat_options("llama2", small)["options"]["num_ctx"] == grown
+
+
+def test_refresh_reuses_a_recent_check(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(OllamaManager, "provider", property(lambda self: SimpleNamespace(name="ollama", client=client)))
+    manager = OllamaManager()
+    manager.refresh(max_age=60)
+    manager.refresh(max_age=60)
+    assert client.ps_calls == 1
+    manager.refresh()
+    assert client.ps_calls == 2
@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+import pytest
+
+from pipeline import Stage, run_pipeline
+
+
+def run(stages):
+    return asyncio.run(run_pipeline(stages))
+
+
+def sleeper(seconds, result):
+    def stage(inputs):
+        time.sleep(seconds)
+        return result
+    return stage
+
+
+def test_dependencies_receive_results():
+    results, timings = run([
+        Stage("a", lambda inputs: "A"),
+        Stage("b", lambda inputs: inputs["a"] + "B", depends=["a"]),
+    ])
+    assert results == {"a": "A", "b": "AB"}
+    assert timings["a"]["status"] == timings["b"]["status"] == "ok"
+    assert timings["b"]["start"] >= timings["a"]["start"] + timings["a"]["seconds"]
+
+
+def test_independent_stages_run_concurrently():
+    started = time.perf_counter()
+    results, _ = run([Stage("a", sleeper(0.3, "A")), Stage("b", sleeper(0.3, "B"))])
+    assert results == {"a": "A", "b": "B"}
+    assert time.perf_counter() - started < 0.55
+
+
+def test_timeout_returns_fallback_without_waiting_for_the_stage():
+    started = time.perf_counter()
+    results, timings = run([
+        Stage("slow", sleeper(2, "late"), timeout=0.2, fallback=lambda inputs: "fallback"),
+        Stage("next", lambda inputs: inputs["slow"] + "!", depends=["slow"]),
+    ])
+    elapsed = time.perf_counter() - started
+    assert results == {"slow": "fallback", "next": "fallback!"}
+    assert timings["slow"]["status"] == "timeout"
+    assert elapsed < 1
+    # The reported times are the time actually spent
+    assert timings["slow"]["seconds"] == pytest.approx(0.2, abs=0.15)
+    assert timings["total"]["seconds"] == pytest.approx(elapsed, abs=0.1)
+
+
+def test_error_uses_fallback():
+    def fail(inputs):
+        raise RuntimeError("boom")
+
+    results, timings = run([Stage("a", fail, fallback=lambda inputs: "fallback")])
+    assert results["a"] == "fallback"
+    assert timings["a"]["status"] == "error: boom"
+
+
+def test_error_without_fallback_gives_empty_result():
+    results, _ = run([Stage("a", lambda inputs: 1 / 0)])
+    assert results["a"] == ""
+
+
+def test_unknown_dependency_is_rejected():
+    with pytest.raises(ValueError):
+        run([Stage("a", lambda inputs: "A", depends=["missing"])])
+
+
+def test_on_stage_done_sees_every_stage():
+    done = []
+    asyncio.run(run_pipeline([Stage("a", lambda inputs: "A"), Stage("b", lambda inputs: "B", depends=["a"])],
+                             on_stage_done=lambda name, result, timing: done.append((name, result))))
+    assert done == [("a", "A"), ("b", "B")]
@@ -0,0 +1,48 @@
+from prompt_layout import build_messages
+from response_cache import ResponseCache, normalize_question
+
+
+def cache(tmp_path, **options):
+    return ResponseCache(path=str(tmp_path / "responses.sqlite"), **options)
+
+
+def test_normalize_question():
+    assert normalize_question("  Where is GATE 5?? ") == "where is gate 5"
+
+
+def test_key_follows_the_messages(tmp_path):
+    responses = cache(tmp_path)
+
+    def key(question, system="Be brief."):
+        return responses.key("openai", "gpt-4", question, "context",
+                             messages=build_messages(system, f"Question:\n{question}", context="context"))
+
+    assert key("Where is Gate 5?") == key("where is gate 5")
+    assert key("Where is Gate 5?") != key("Where is Gate 6?")
+    assert key("Where is Gate 5?") != key("Where is Gate 5?", system="Be thorough.")
+
+
+def test_fetch_computes_once(tmp_path):
+    responses = cache(tmp_path)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return "answer"
+
+    assert responses.fetch("openai", "gpt-4", "Where is Gate 5?", compute) == "answer"
+    assert responses.fetch("openai", "gpt-4", "where is gate 5", compute) == "answer"
+    assert len(calls) == 1
+    assert responses.stats["hits"] == 1
+
+
+def test_fetch_stream_stores_the_joined_answer(tmp_path):
+    responses = cache(tmp_path)
+    assert list(responses.fetch_stream("openai", "gpt-4", "q", lambda: iter(["a", "b"]))) == ["a", "b"]
+    assert list(responses.fetch_stream("openai", "gpt-4", "q", lambda: iter(["x"]))) == ["ab"]
+
+
+def test_expired_entries_miss(tmp_path):
+    responses = cache(tmp_path, ttl=0)
+    responses.put("key", "value")
+    assert responses.get("key") is None
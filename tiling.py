@@ -0,0 +1,201 @@
+import argparse
+import hashlib
+import json
+import os
+from functools import partial
+
+from file_cache import is_image_file
+from image_selection import LABEL_PATTERN, STOPWORDS, find_terminals, normalize_label
+from retrieval import TfidfVectorizer, tokenize
+
+TILE_FOLDERS = ("files", "files-all")
+TILE_DIR = os.path.join(".cache", "tiles")
+# Both are generated, so they live in the cache with the tiles rather than in the repo
+TILE_MANIFEST = os.path.join(".cache", "tiles.json")
+TILE_CAPTIONS = os.path.join(".cache", "tile_captions.json")
+# Each map is cut into an n x n grid for every n listed here (coarse to fine)
+TILE_GRIDS = tuple(int(n) for n in os.getenv("TILE_GRIDS", "2,4").split(","))
+TILE_OVERLAP = float(os.getenv("TILE_OVERLAP", 0.15))
+TILE_MIN_SIDE = int(os.getenv("TILE_MIN_SIDE", 320))
+TILE_MAX_SIDE = int(os.getenv("TILE_MAX_SIDE", 1024))
+TILE_MAX_COUNT = int(os.getenv("TILE_MAX_COUNT", 3))
+
+TILE_PROMPT = (
+    "This image is one region cropped from a larger airport floor plan, so paths may continue past its edges. "
+    "List every location, gate, shop, service and sign you can read in it, each as a bold label "
+    "(e.g. **Gate B12:**) followed by how to walk to it from the other labelled locations in this region. "
+    "Mention which edge a corridor leaves the region by. Do not guess at labels you cannot read."
+)
+
+
+def _map_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:10]
+
+
+# Function to compute overlapping tile boxes for an n x n grid over a width x height map
+def tile_boxes(width, height, grid, overlap=TILE_OVERLAP):
+    boxes = []
+    step_x, step_y = width / grid, height / grid
+    pad_x, pad_y = step_x * overlap, step_y * overlap
+    for row in range(grid):
+        for col in range(grid):
+            boxes.append((row, col, (
+                max(0, int(col * step_x - pad_x)),
+                max(0, int(row * step_y - pad_y)),
+                min(width, int((col + 1) * step_x + pad_x)),
+                min(height, int((row + 1) * step_y + pad_y)),
+            )))
+    return boxes
+
+
+# Function to crop one tile to disk (downscaled to TILE_MAX_SIDE) unless it is already there
+def write_tile(record, tile_dir=TILE_DIR):
+    path = os.path.join(tile_dir, record["file"])
+    if not os.path.exists(path):
+        os.makedirs(tile_dir, exist_ok=True)
+        from PIL import Image
+        with Image.open(record["map"]) as image:
+            tile = image.crop(tuple(record["box"]))
+            tile.thumbnail((TILE_MAX_SIDE, TILE_MAX_SIDE), Image.LANCZOS)
+            tmp_path = path + ".tmp"
+            tile.convert("RGB").save(tmp_path, format="JPEG", quality=90)
+            os.replace(tmp_path, path)
+    return path
+
+
+# Function to cut one map into tiles at every grid size that keeps tiles legible
+def tile_map(map_path, grids=TILE_GRIDS, overlap=TILE_OVERLAP, tile_dir=TILE_DIR):
+    from PIL import Image
+    with Image.open(map_path) as image:
+        width, height = image.size
+    stem = os.path.splitext(os.path.basename(map_path))[0].replace(" ", "-")
+    digest = _map_digest(map_path)
+    records = []
+    for grid in grids:
+        if min(width, height) / grid < TILE_MIN_SIDE:
+            continue
+        for row, col, box in tile_boxes(width, height, grid, overlap):
+            # Same map content gives the same tile names, so copies in files-all/ collapse
+            record = {"file": f"{digest}-{stem}-g{grid}-r{row}-c{col}.jpg", "map": map_path,
+                      "grid": grid, "row": row, "col": col, "box": list(box)}
+            write_tile(record, tile_dir)
+            records.append(record)
+    return records
+
+
+# Function to tile every map in the folders and write the tile manifest
+def tile_folders(folders=TILE_FOLDERS, manifest_path=TILE_MANIFEST, tile_dir=TILE_DIR):
+    manifest = {}
+    for folder in folders:
+        if not os.path.isdir(folder):
+            continue
+        for filename in sorted(os.listdir(folder)):
+            if is_image_file(filename):
+                for record in tile_map(os.path.join(folder, filename), tile_dir=tile_dir):
+                    manifest.setdefault(record["file"], record)
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+    return manifest
+
+
+def load_manifest(manifest_path=TILE_MANIFEST):
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+    return {}
+
+
+# Function to caption every tile through update_captions' concurrent, checkpointing engine
+def caption_tiles(manifest, concurrency=4, max_retries=5, force=False, tile_dir=TILE_DIR):
+    import update_captions
+    paths = [write_tile(record, tile_dir) for record in manifest.values()]
+    generate = partial(update_captions.generate_captions, prompt=TILE_PROMPT)
+    return update_captions.caption_images(paths, generate, concurrency=concurrency, max_retries=max_retries,
+                                          force=force, caption_file=TILE_CAPTIONS, prompt=TILE_PROMPT)
+
+
+class TileIndex:
+    def __init__(self, manifest, captions, tile_dir=TILE_DIR):
+        self.tile_dir = tile_dir
+        self.tiles = [manifest[name] for name in sorted(captions) if name in manifest]
+        texts = [captions[tile["file"]] for tile in self.tiles]
+        self.terminals = [find_terminals(os.path.basename(tile["map"]).replace("_", " ")) for tile in self.tiles]
+        # Location index: normalized label -> tiles whose caption names it
+        self.locations = {}
+        for i, text in enumerate(texts):
+            for bold, heading in LABEL_PATTERN.findall(text):
+                label = normalize_label(bold or heading)
+                if label:
+                    self.locations.setdefault(label, set()).add(i)
+        texts = [" ".join(t for t in tokenize(text) if t not in STOPWORDS) for text in texts]
+        self.vectorizer = TfidfVectorizer().fit(texts)
+        self.vectors = self.vectorizer.transform(texts) if self.tiles else None
+
+    def __len__(self):
+        return len(self.tiles)
+
+    # Function to pick the few tiles covering the locations a question names
+    def select(self, question, max_tiles=TILE_MAX_COUNT):
+        if not self.tiles:
+            return []
+        words = [t for t in tokenize(question) if t not in STOPWORDS]
+        text = f" {' '.join(words)} "
+        asked_terminals = find_terminals(question)
+        allowed = {i for i, terminals in enumerate(self.terminals)
+                   if not asked_terminals or not terminals or asked_terminals & terminals}
+        # Longest labels first, so "gate b12" wins over "gate"
+        wanted = []
+        for label in sorted(self.locations, key=len, reverse=True):
+            if f" {label} " in text and not any(f" {label} " in f" {other} " for other in wanted):
+                wanted.append(label)
+        covers = {i: {label for label in wanted if i in self.locations[label]} for i in allowed}
+        chosen = []
+        missing = set(wanted)
+        # Greedy cover of the start and end points: most labels per tile, then the finest grid
+        while missing and covers and len(chosen) < max_tiles:
+            best = max(covers, key=lambda i: (len(covers[i] & missing), self.tiles[i]["grid"]))
+            if not covers[best] & missing:
+                break
+            chosen.append(best)
+            missing -= covers[best]
+        if not chosen:
+            # No label matched: fall back to the tiles whose captions read closest to the question
+            similarity = self.vectors @ self.vectorizer.transform([" ".join(words)])[0]
+            ranked = sorted(allowed, key=lambda i: -similarity[i])
+            chosen = [i for i in ranked[:max_tiles] if similarity[i] > 0]
+        return [dict(self.tiles[i], path=write_tile(self.tiles[i], self.tile_dir),
+                     labels=sorted(covers.get(i, ()))) for i in chosen]
+
+
+# Function to load the tile index from the manifest and tile captions
+def load_tile_index(manifest_path=TILE_MANIFEST, captions_path=TILE_CAPTIONS):
+    from caption_store import load_captions
+    return TileIndex(load_manifest(manifest_path), load_captions(captions_path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cut floor plans into overlapping multi-resolution tiles")
+    parser.add_argument("--folders", nargs="+", default=list(TILE_FOLDERS))
+    parser.add_argument("--caption", action="store_true", help="caption tiles that have no caption yet")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--force", action="store_true", help="re-caption tiles that already have a caption")
+    parser.add_argument("--dry-run", action="store_true", help="estimate the captioning cost only")
+    args = parser.parse_args()
+
+    tiles = tile_folders(args.folders)
+    print(f"{len(tiles)} tiles from {len({t['map'] for t in tiles.values()})} maps written to {TILE_DIR}")
+    tile_paths = [os.path.join(TILE_DIR, name) for name in tiles]
+    if args.dry_run:
+        import update_captions
+        update_captions.estimate_run(tile_paths, force=args.force, caption_file=TILE_CAPTIONS, prompt=TILE_PROMPT)
+    elif args.caption:
+        _, failed = caption_tiles(tiles, concurrency=args.concurrency, force=args.force)
+        if failed:
+            raise SystemExit(f"{len(failed)} tile(s) failed: {', '.join(failed)}")
@@ -1,59 +1,192 @@
 import os
-import json
-import base64
-from openai import OpenAI
+import argparse
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from providers import get_provider
 from dotenv import load_dotenv
+from image_payloads import get_data_url, IMAGE_MAX_SIDE
+from file_cache import IMAGE_EXTENSIONS
+from metrics import traced
+from pdf_ingest import ingest_pdfs, list_pdfs
+from caption_store import get_caption_store, prompt_version
 
 # Load environment variables
 load_dotenv()
 
-def load_captions():
-    caption_file = "captions.json"
-    if os.path.exists(caption_file):
-        with open(caption_file, "r") as f:
-            return json.load(f)
-    return {}
-
-def save_captions(captions):
-    caption_file = "captions.json"
-    with open(caption_file, "w") as f:
-        json.dump(captions, f)
-
-def generate_captions(image_path):
-    client = OpenAI()  # Remove the api_key parameter as it will be read from environment
-    
-    with open(image_path, "rb") as image_file:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "Please provide a detailed description of this airport floor plan map, focusing on practical navigation directions. Describe locations in terms of walking directions (e.g., 'walk straight ahead', 'turn left/right') and distances from entry points or major intersections. Avoid using image-relative positions like 'top right' or 'bottom left'. Include information about shops, gates, and key locations, describing how to reach them from main entrances or central points."},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64.b64encode(image_file.read()).decode('utf-8')}"
-                            }
+CAPTION_MODEL = "gpt-4o"
+CAPTION_MAX_TOKENS = 1000
+# USD per million tokens, used by --dry-run to estimate the cost of a run
+INPUT_PRICE = float(os.getenv("CAPTION_INPUT_PRICE", 2.50))
+OUTPUT_PRICE = float(os.getenv("CAPTION_OUTPUT_PRICE", 10.00))
+CAPTION_PROMPT = "Please provide a detailed description of this airport floor plan map, focusing on practical navigation directions. Describe locations in terms of walking directions (e.g., 'walk straight ahead', 'turn left/right') and distances from entry points or major intersections. Avoid using image-relative positions like 'top right' or 'bottom left'. Include information about shops, gates, and key locations, describing how to reach them from main entrances or central points."
+
+# Function to caption one image; tiling.py passes its own prompt for map tiles
+def generate_captions(image_path, prompt=CAPTION_PROMPT):
+    return get_provider("openai").complete(
+        CAPTION_MODEL,
+        [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": get_data_url(image_path)
                         }
-                    ]
-                }
-            ],
-            max_tokens=1000
-        )
-    return response.choices[0].message.content
-
-def process_images():
-    captions = load_captions()
-    files_folder = "files"
-    for filename in os.listdir(files_folder):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            print(f"Processing image: {filename}")
-            if filename not in captions:
-                image_path = os.path.join(files_folder, filename)
-                captions[filename] = generate_captions(image_path)
-    save_captions(captions)
+                    }
+                ]
+            }
+        ],
+        max_tokens=CAPTION_MAX_TOKENS
+    )
+
+# Shared back-off gate: a 429 on one worker pauses every worker until the limit resets
+class RateLimitGate:
+    def __init__(self):
+        self.resume_at = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+def retry_after(error):
+    # OpenAI and Mistral errors carry the HTTP response; honour its Retry-After header
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def is_rate_limited(error):
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status == 429 or type(error).__name__ == "RateLimitError"
+
+# Function to call the captioner with exponential backoff and jitter
+def generate_with_retry(generate, image_path, gate, max_retries=5, base_delay=1.0):
+    for attempt in range(max_retries + 1):
+        gate.wait()
+        try:
+            with traced("caption", image=os.path.basename(image_path), attempt=attempt):
+                return generate(image_path)
+        except Exception as error:
+            if attempt == max_retries:
+                raise
+            delay = base_delay * (2 ** attempt) * (1 + random.random())
+            if is_rate_limited(error):
+                delay = retry_after(error) or delay
+                gate.pause(delay)
+            print(f"Retrying {image_path} in {delay:.1f}s ({error})")
+            time.sleep(delay)
+
+# Function to estimate input tokens for one image (OpenAI high-detail tiling)
+def estimate_image_tokens(image_path):
+    from PIL import Image
+    with Image.open(image_path) as image:
+        width, height = image.size
+    scale = min(1.0, IMAGE_MAX_SIDE / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = -(-int(width) // 512) * -(-int(height) // 512)
+    return 85 + 170 * tiles
+
+def list_images(folder):
+    return sorted(
+        os.path.join(folder, filename)
+        for filename in os.listdir(folder)
+        if filename.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+# Function to decide which images need a caption: those whose content has none yet (renamed
+# or copied images reuse theirs), or with stale=True none from this model and prompt version
+def pending_images(image_paths, force=False, stale=False, caption_file="captions.json", model=CAPTION_MODEL,
+                   prompt=CAPTION_PROMPT):
+    store = get_caption_store()
+    store.sync(caption_file)
+    if force:
+        return list(image_paths)
+    if stale:
+        return store.lookup(image_paths, caption_file, model, prompt_version(prompt))[1]
+    return store.lookup(image_paths, caption_file)[1]
+
+# Function to caption many images concurrently, storing each caption as soon as it arrives
+def caption_images(image_paths, generate=generate_captions, concurrency=4, max_retries=5, force=False,
+                   caption_file="captions.json", model=CAPTION_MODEL, prompt=CAPTION_PROMPT, stale=False):
+    store = get_caption_store()
+    pending = pending_images(image_paths, force, stale, caption_file, model, prompt)
+    version = prompt_version(prompt)
+    gate = RateLimitGate()
+    failures = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {executor.submit(generate_with_retry, generate, path, gate, max_retries): path for path in pending}
+        for future in as_completed(futures):
+            path = futures[future]
+            filename = os.path.basename(path)
+            try:
+                caption = future.result()
+            except Exception as error:
+                failures[filename] = str(error)
+                print(f"Failed to caption {filename}: {error}")
+                continue
+            store.put(caption_file, filename, store.hash_file(path), caption, model, version)
+            store.export(caption_file)
+            print(f"Captioned image: {filename}")
+    return store.view(caption_file), failures
+
+# Function to report what a run would caption and roughly what it would cost
+def estimate_run(image_paths, force=False, caption_file="captions.json", stale=False, prompt=CAPTION_PROMPT):
+    pending = pending_images(image_paths, force, stale, caption_file, prompt=prompt)
+    input_tokens = sum(estimate_image_tokens(path) + 120 for path in pending)
+    output_tokens = CAPTION_MAX_TOKENS * len(pending)
+    cost = (input_tokens * INPUT_PRICE + output_tokens * OUTPUT_PRICE) / 1_000_000
+    for path in pending:
+        print(f"Would caption: {path}")
+    print(f"{len(pending)} of {len(image_paths)} images, ~{input_tokens} input tokens, "
+          f"up to {output_tokens} output tokens, at most ${cost:.2f} with {CAPTION_MODEL}")
+    return {"images": len(pending), "input_tokens": input_tokens, "output_tokens": output_tokens, "cost": cost}
+
+# Function to caption the floor plans in a folder and add its PDF guides page by page
+def process_images(files_folder="files", generate=generate_captions, concurrency=4, force=False,
+                   model=CAPTION_MODEL, prompt=CAPTION_PROMPT):
+    caption_images(list_images(files_folder), generate, concurrency=concurrency, force=force, model=model,
+                   prompt=prompt)
+    captions, _ = ingest_pdfs(list_pdfs(files_folder), generate, concurrency=concurrency, force=force,
+                              model=model, prompt=prompt)
     return captions
 
 if __name__ == "__main__":
-    process_images()
+    parser = argparse.ArgumentParser(description="Generate captions for airport floor plans")
+    parser.add_argument("--folder", default="files", help="folder with the floor plan images")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of captioning calls in flight")
+    parser.add_argument("--retries", type=int, default=5, help="retries per image before giving up")
+    parser.add_argument("--force", action="store_true", help="re-caption images that already have a caption")
+    parser.add_argument("--stale", action="store_true",
+                        help="re-caption images captioned by another model or prompt version")
+    parser.add_argument("--dry-run", action="store_true", help="list pending images and estimate cost only")
+    args = parser.parse_args()
+
+    images = list_images(args.folder)
+    if args.dry_run:
+        estimate_run(images, force=args.force, stale=args.stale)
+    else:
+        _, failed = caption_images(images, concurrency=args.concurrency, max_retries=args.retries, force=args.force,
+                                   stale=args.stale)
+        _, failed_pages = ingest_pdfs(list_pdfs(args.folder), generate_captions, concurrency=args.concurrency,
+                                      max_retries=args.retries, force=args.force)
+        failed.update(failed_pages)
+        if failed:
+            raise SystemExit(f"{len(failed)} image(s) or page(s) failed: {', '.join(failed)}")